@@ -1,6 +1,6 @@
 #! /usr/bin/python3
 import logging
-import yaml
+import msmconfig
 import requests
 from pprint import pprint
 import json
@@ -11,24 +11,10 @@ def main():
     logging.basicConfig(level=logging.INFO)
     
     # Load membership configuration
-    try:
-        with open("config-msmmembership.yaml", 'r') as stream:
-            try:
-                msmMembershipConfig=yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                print(exc)
-    except IOError:
-        print("Could not read config-msmmembership.yaml file")
+    msmMembershipConfig = msmconfig.loadConfig('msmmembership')
     
     # Load listmonk configuration
-    try:
-        with open("config-listmonk.yaml", 'r') as stream:
-            try:
-                msmListmonkConfig=yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                print(exc)
-    except IOError:
-        print("Could not read config-listmonk.yaml file")
+    msmListmonkConfig = msmconfig.loadConfig('listmonk')
     
     listmonkBaseURL = msmListmonkConfig['listmonkBaseURL']
     listmonkUser = msmListmonkConfig['listmonkUser']
@@ -8,19 +8,12 @@ from dateutil import tz
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy import create_engine
 
-import yaml
+import msmconfig
 
 logging.basicConfig(level=logging.INFO)
 
 # Load configuration
-try:
-    with open("config-msmsquare.yaml", 'r') as stream:
-        try:
-            msmSquareConfig=yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-except IOError:
-    print("Could not read config-msmsquare.yaml file")
+msmSquareConfig = msmconfig.loadConfig('msmsquare')
 
 applicationID = msmSquareConfig['squareApplicationID']
 accessToken = msmSquareConfig['squareApplicationAccessToken']
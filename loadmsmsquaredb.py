@@ -1,103 +1,163 @@
 #! /usr/bin/python3
+# Loads the full history of Square data into the local database
+# The history is split into monthly windows for each location and entity which are fetched concurrently,
+# completed windows are recorded so an interrupted load can be rerun and will pick up where it left off
 import logging
 import msmsquare
 from datetime import datetime, timedelta, timezone
 from dateutil import tz
-from collections import Counter
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 from pprint import pprint
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy import create_engine
-
-import yaml
-
-logging.basicConfig(level=logging.INFO)
-
-# Load configuration
-try:
-    with open("config-msmsquare.yaml", 'r') as stream:
-        try:
-            msmSquareConfig=yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-except IOError:
-    print("Could not read config-msmsquare.yaml file")
-
-applicationID = msmSquareConfig['squareApplicationID']
-accessToken = msmSquareConfig['squareApplicationAccessToken']
-
-# Timezone stuff
-UTC_tzone = tz.gettz('UTC')
-LOCAL_tzone = tz.gettz(msmSquareConfig['localTimezone'])
-
-headers = {"Authorization":"Bearer "+ accessToken, 'Square-Version':msmSquareConfig['squareAPIVersion']}
-
-#connect to the squareData cache database, setup SQLAlchemy stuff
-db_string = msmSquareConfig['postgresConnection']
-db = create_engine(db_string, connect_args={'sslmode':'disable'})
-Session = sessionmaker(db)  # Create a session class associated with the database engine
-
-db_session = Session() # create a working database session for version 2
-
-def loadPayments(locations, db_session, headers, beginTimeDT, endTimeDT):
-	#Load all payments from all locations since Nov 1, 2018 (MSM Square Inception Date) into the database
-	for location in locations:
-		endTime=endTimeDT.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ')
-		beginTime=beginTimeDT.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ')
-		payments = msmsquare.getPaymentsByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers)
-	return
-
-def loadRefunds(locations, db_session, headers, beginTimeDT, endTimeDT):
-	#Load all refunds from all locations since Nov 1, 2018 (MSM Square Inception Date) into the database
-	for location in locations:
-		endTime=endTimeDT.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ')
-		beginTime=beginTimeDT.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ')
-		msmsquare.getRefundsByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers)
-	return
-
-def loadPayoutEntries(locations, db_session, headers, beginTimeDT, endTimeDT):
-	#Load all payouts and payout entries from all locations since Nov 1, 2018 (MSM Square Inception Date) into the database
-	for location in locations:
-		endTime=endTimeDT.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ')
-		beginTime=beginTimeDT.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ')
-		msmsquare.getPayoutEntriesByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers)
-	return
-
-def loadOrders(locations, db_session, headers, beginTimeDT, endTimeDT):
-	#Load all orders from all locations since Nov 1, 2018 (MSM Square Inception Date) into the database
-	for location in locations:
-		endTime=endTimeDT.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ')
-		beginTime=beginTimeDT.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ')
-		msmsquare.getOrdersByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers)
-	return
-
-#True inception is Nov. 1, 2018
-beginTime=datetime(2024,5,1,0,0,0,tzinfo=LOCAL_tzone)
-endTime=datetime.now(timezone.utc)
-#endTime=datetime(2023,1,1,0,0,0,tzinfo=LOCAL_tzone)
-
-#Get all of the location IDs from square into the database api v2
-logging.info('Getting Locations')
-locations = msmsquare.getLocationsFromSquare(db_session,headers)
-
-#Get all of the catalog objects from square into the database api v2
-logging.info('Getting Catalog Objects')
-msmsquare.getCatalogFromSquare(db_session, headers)
-
-#Get all of the payments from square into the database api v2
-logging.info('Getting Payments')
-loadPayments(locations, db_session, headers, beginTime, endTime)
-
-#Get all of the orders from square into the database api v2
-logging.info('Getting Orders')
-loadOrders(locations, db_session, headers, beginTime, endTime)
-
-#Get all of the refunds from square into the database api v2
-logging.info('Getting Refunds')
-loadRefunds(locations, db_session, headers, beginTime, endTime)
-
-#Get all of the payouts and payout entries from square into the database api v2
-logging.info('Getting Payouts and Payout Entries')
-loadPayoutEntries(locations, db_session, headers, beginTime, endTime)
-
-logging.info('DB Load Complete')
\ No newline at end of file
+import argparse
+
+import msmconfig
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b","--startdate", help="Start Date YYYY-MM-DD, defaults to Nov 1, 2018 (MSM Square Inception Date)", type=str, default="2018-11-01")
+    parser.add_argument("-e","--stopdate", help="Stop Date YYYY-MM-DD, defaults to now", type=str)
+    parser.add_argument("-w","--workers", help="Number of windows to fetch from Square at the same time", type=int, default=4)
+    parser.add_argument("-f","--force", help="Fetch windows again even if they have already been loaded", action="store_true")
+    parser.add_argument("--bulk", help="Load the catalog, payments, orders, and refunds with COPY instead of one object at a time, for first time loads", action="store_true")
+    parser.add_argument("--file", help="Bulk load a JSON lines file of Square objects into --table instead of fetching from Square", type=str)
+    parser.add_argument("--table", help="Table to bulk load --file into", choices=sorted(msmsquare.BULK_TABLES), type=str)
+    parser.add_argument("--migrate", help="Only make the database schema changes, trying again any that failed before", action="store_true")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Load configuration
+    msmSquareConfig = msmconfig.loadConfig('msmsquare')
+
+    applicationID = msmSquareConfig['squareApplicationID']
+    accessToken = msmSquareConfig['squareApplicationAccessToken']
+
+    # Timezone stuff
+    UTC_tzone = tz.gettz('UTC')
+    LOCAL_tzone = tz.gettz(msmSquareConfig['localTimezone'])
+
+    headers = {"Authorization":"Bearer "+ accessToken, 'Square-Version':msmSquareConfig['squareAPIVersion']}
+
+    #connect to the squareData cache database, setup SQLAlchemy stuff
+    #each worker thread has its own session and holds two advisory locks on connections of their own, so the pool needs three connections per worker
+    #plus the main thread's session and lock
+    db_string = msmSquareConfig['postgresConnection']
+    db = create_engine(db_string, connect_args={'sslmode':'disable'}, pool_size=arguments.workers*3+2)
+    msmsquare.initDB(db)  # Create any new tables
+    if arguments.migrate:
+        msmsquare.migrateDB(db, retryFailed=True)
+        return
+    Session = sessionmaker(db)  # Create a session class associated with the database engine
+
+    db_session = Session() # create a working database session for version 2
+
+    beginTime = datetime.strptime(arguments.startdate, "%Y-%m-%d").replace(tzinfo=LOCAL_tzone)
+    if arguments.stopdate:
+        endTime = datetime.strptime(arguments.stopdate, "%Y-%m-%d").replace(tzinfo=LOCAL_tzone)
+    else:
+        endTime = datetime.now(timezone.utc)
+
+    if arguments.file and not arguments.table:
+        parser.error('--file needs --table')
+
+    msmsquare.startSyncLedger('load', db)
+    try:
+        runLoad(Session, db_session, headers, beginTime, endTime, arguments)
+    except:
+        msmsquare.finishSyncLedger('failed')
+        raise
+    msmsquare.finishSyncLedger()
+
+    return
+
+def runLoad(Session, db_session, headers, beginTime, endTime, arguments):
+    if arguments.file:
+        with msmsquare.syncStage(arguments.table+' file'):
+            msmsquare.bulkLoadJSONLinesFile(arguments.table, arguments.file, db_session)
+        return
+
+    #Get all of the location IDs from square into the database api v2
+    logging.info('Getting Locations')
+    with msmsquare.syncStage('locations'), msmsquare.advisoryLock('locations', db_session, mode='wait'):
+        locations = msmsquare.getLocationsFromSquare(db_session,headers)
+
+    #Get all of the catalog objects from square into the database api v2
+    logging.info('Getting Catalog Objects')
+    with msmsquare.syncStage('catalog'), msmsquare.advisoryLock('catalog', db_session, mode='wait'):
+        if arguments.bulk:
+            catalogCount = msmsquare.bulkLoad('catalog', msmsquare.iterCatalogFromSquare(db_session, headers, save=False), db_session)
+        else:
+            catalogCount = sum(1 for _ in msmsquare.iterCatalogFromSquare(db_session, headers))
+    logging.info('Loaded %s catalog objects', catalogCount)
+    msmsquare.logIngestMemory(db_session, 'Catalog Objects')
+
+    #Get all of the payments, orders, refunds, and payouts with payout entries from square into the database api v2
+    loadWindows(Session, db_session, headers, locations, beginTime, endTime, arguments.workers, arguments.force, arguments.bulk)
+
+    logging.info('DB Load Complete')
+    return
+
+def loadWindows(Session, db_session, headers, locations, beginTime, endTime, workers, force, bulk):
+    # Each entity is loaded for every location and window before moving on to the next, since orders need their payments and refunds need their orders
+    # Bulk loads do not classify orders as they are saved, so order_financials is rebuilt for the loaded windows at the end
+    # Windows ending within the last 3 days may still change in Square so they are loaded but not recorded as complete
+    windows = msmsquare.backfillWindowsForDates(beginTime, endTime)
+    recordBefore = datetime.now(timezone.utc) - timedelta(days = 3)
+    threadSessions = threading.local()
+    sessions = []
+    sessionsLock = threading.Lock()
+
+    def threadSession():
+        # Each worker thread has its own database session
+        if not hasattr(threadSessions, 'db_session'):
+            threadSessions.db_session = Session()
+            with sessionsLock:
+                sessions.append(threadSessions.db_session)
+        return threadSessions.db_session
+
+    def loadWindow(entity, locationID, windowStart, windowEnd):
+        with msmsquare.syncStage(entity+' '+locationID):
+            return msmsquare.backfillWindow(entity, locationID, windowStart, windowEnd, threadSession(), headers, record=windowEnd < recordBefore, bulk=bulk)
+
+    def materializeWindow(locationID, windowStart, windowEnd):
+        with msmsquare.syncStage('order_financials '+locationID), msmsquare.advisoryLock('reports '+locationID, db_session, mode='wait'):
+            msmsquare.materializeOrderFinancialsForDateRange(windowStart, windowEnd, locationID, threadSession(), headers)
+        msmsquare.endIngestBatch(threadSession())
+        return 0
+
+    loadedWindows = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entity, fetcher in msmsquare.BACKFILL_ENTITIES:
+            logging.info('Getting %s', entity)
+            futures = []
+            skipped = 0
+            for location in locations:
+                completed = set() if force else msmsquare.completedBackfillWindows(entity, location['id'], db_session)
+                for windowStart, windowEnd in windows:
+                    if (windowStart, windowEnd) in completed:
+                        skipped += 1
+                        continue
+                    futures.append(executor.submit(loadWindow, entity, location['id'], windowStart, windowEnd))
+                    loadedWindows.append((location['id'], windowStart, windowEnd))
+            loaded = 0
+            for future in as_completed(futures):
+                loaded += future.result()
+            logging.info('Loaded %s %s in %s windows, skipped %s windows that were already loaded', loaded, entity, len(futures), skipped)
+            msmsquare.logIngestMemory(db_session, entity)
+        if bulk:
+            logging.info('Classifying bulk loaded orders')
+            futures = [executor.submit(materializeWindow, locationID, windowStart, windowEnd) for locationID, windowStart, windowEnd in set(loadedWindows)]
+            for future in as_completed(futures):
+                future.result()
+            msmsquare.logIngestMemory(db_session, 'order_financials')
+    for session in sessions:
+        session.close()
+    return
+
+if __name__ == "__main__":
+    main()
@@ -3,18 +3,11 @@ import requests
 import uuid
 import json
 from datetime import datetime, timedelta
-import yaml
+import msmconfig
 from pprint import pprint
 
 # Load configuration
-try:
-    with open("config-msmcharters.yaml", 'r') as stream:
-        try:
-            charterConfig=yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-except IOError:
-    print("Could not read config-msmcharters.yaml file")
+charterConfig = msmconfig.loadConfig('msmcharters')
 
 charter_catalog_object_id=charterConfig['charterObjectID']
 application_id=charterConfig['applicationID']
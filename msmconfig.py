@@ -0,0 +1,20 @@
+#! /usr/bin/python3
+# Loads the config-<name>.yaml files, each file is read and parsed once per process no matter how many modules use it
+import logging
+import yaml
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def loadConfig(name):
+    # Returns the parsed config-<name>.yaml, or an empty dict if it cannot be read
+    # The same dict is shared by every caller so it must not be changed
+    filename = 'config-{}.yaml'.format(name)
+    try:
+        with open(filename, 'r') as stream:
+            try:
+                return yaml.safe_load(stream) or {}
+            except yaml.YAMLError as exc:
+                logging.error('Could not parse %s: %s', filename, exc)
+    except IOError:
+        logging.error('Could not read %s file', filename)
+    return {}
@@ -1,20 +1,13 @@
 #!/usr/bin/python3
 import requests
 import json
-import yaml
+import msmconfig
 import logging
 
 log = logging.getLogger(__name__)
 
 # Load configuration
-try:
-    with open("config-msmevents.yaml", 'r') as stream:
-        try:
-            eventsConfig=yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-except IOError:
-    print("Could not read config-msmevents.yaml file")
+eventsConfig = msmconfig.loadConfig('msmevents')
 
 #eventsConfig['wcConsumerKey']
 #eventsConfig['wcConsumerSecret']
@@ -1,18 +1,11 @@
 import requests
 import json
-import yaml
+import msmconfig
 import csv
 import io
 
 # Load configuration
-try:
-    with open("config-msmmembership.yaml", 'r') as stream:
-        try:
-            msmMembershipDBConfig=yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-except IOError:
-    print("Could not read config-msmmembership.yaml file")
+msmMembershipDBConfig = msmconfig.loadConfig('msmmembership')
 
 def getTCLComplimentaryAddresses():
     headers = {
@@ -6,7 +6,7 @@ from collections import Counter
 from pprint import pprint
 from datetime import datetime, timedelta, date, time, timezone
 from dateutil import tz
-import yaml
+import msmconfig
 from sqlalchemy import desc
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy import create_engine
@@ -18,19 +18,16 @@ def main():
     parser.add_argument("-b","--startdate", help="Start Date YYYY-MM-DD", type=str)
     parser.add_argument("-e","--stopdate", help="Stop Date YYYY-MM-DD", type=str)
     parser.add_argument("-l","--locationid", help="Location ID", type=str)
+    parser.add_argument("-g","--engine", help="Report engine, python, sql, or materialized", type=str)
+    parser.add_argument("-c","--compare", help="Compare the python report engine with the sql (or --engine) report engine instead of generating reports", action="store_true")
+    parser.add_argument("-r","--rollups", help="Recalculate the week, month, and fiscal year rollups for the date range without regenerating daily reports", action="store_true")
+    parser.add_argument("-m","--materialize", help="Rebuild the stored order financials for the date range before generating reports", action="store_true")
     arguments = parser.parse_args()
     
     logging.basicConfig(level=logging.INFO)
     
     # Load configuration
-    try:
-        with open("config-msmsquare.yaml", 'r') as stream:
-            try:
-                msmSquareConfig=yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                print(exc)
-    except IOError:
-        print("Could not read config-msmsquare.yaml file")
+    msmSquareConfig = msmconfig.loadConfig('msmsquare')
 
     applicationID = msmSquareConfig['squareApplicationID']
     accessToken = msmSquareConfig['squareApplicationAccessToken']
@@ -52,8 +49,24 @@ def main():
     beginTime = datetime.strptime(arguments.startdate, "%Y-%m-%d").replace(tzinfo=LOCAL_tzone)
     endTime = datetime.strptime(arguments.stopdate, "%Y-%m-%d").replace(tzinfo=LOCAL_tzone)
 
+    if arguments.materialize:
+        #reclassify every payment and refund in the date range into order_financials
+        msmsquare.materializeOrderFinancialsForDateRange(beginTime, endTime + timedelta(days=1), locationID, db_session, headers)
+
+    if arguments.rollups:
+        #rebuild the rollups from the daily reports already in the database
+        days = [beginTime.date() + timedelta(days=i) for i in range((endTime-beginTime).days + 1)]
+        msmsquare.refreshReportRollups(days, locationID, db_session, headers)
+        return
+
+    if arguments.compare:
+        #check that the sql or materialized report engine matches the python report engine
+        differences = msmsquare.compareReportEngines(beginTime,endTime,locationID,db_session, headers, engine=arguments.engine or 'sql')
+        pprint(differences)
+        return
+
     #generate a new report for a certain day
-    msmsquare.generateReportDataForDates(beginTime,endTime, locationID,db_session, headers)
+    msmsquare.generateReportDataForDates(beginTime,endTime, locationID,db_session, headers, engine=arguments.engine)
     #get report data
     report = msmsquare.getReportDataForDatesFromOneLocation(beginTime,endTime,locationID,db_session, headers)
     #print report data
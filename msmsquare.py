@@ -1,27 +1,27 @@
 # This module contains functions used to access, manipulate, and download to a local database information from the Square payment processor
 # It has been updated/rewritten to work with the Square v2 API
 import requests
-from collections import defaultdict
+from collections import defaultdict, Counter
+from contextlib import contextmanager
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import create_engine
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, desc
+from sqlalchemy import create_engine, event
+from sqlalchemy import Column, Integer, BigInteger, String, Date, DateTime, Boolean, LargeBinary, desc, text, or_, func
 from sqlalchemy.dialects.postgresql.json import JSONB
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+from sqlalchemy.exc import SQLAlchemyError
 from datetime import datetime, timedelta, date, time, timezone
 from dateutil import tz
 from pprint import pprint
 import logging
-import yaml
+import json
+import io
+import resource
+import threading
+from time import monotonic, sleep
+import msmconfig
 
 # Load configuration
-try:
-    with open("config-msmsquare.yaml", 'r') as stream:
-        try:
-            msmSquareConfig=yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-except IOError:
-    print("Could not read config-msmsquare.yaml file")
+msmSquareConfig = msmconfig.loadConfig('msmsquare')
 
 base = declarative_base()
 
@@ -44,6 +44,12 @@ class Payment(base):
     created_at = Column(DateTime(timezone=True))
     updated_at = Column(DateTime(timezone=True))
     lastSyncDate = Column(DateTime(timezone=True))
+    # Copies of the fields reports use, so they can be filtered and totalled without loading data
+    status = Column(String)
+    source_type = Column(String)
+    external_type = Column(String)
+    amount = Column(BigInteger)
+    fee_total = Column(BigInteger)
     data = Column(JSONB)
 
 class Refund(base):  
@@ -57,6 +63,10 @@ class Refund(base):
     created_at = Column(DateTime(timezone=True))
     updated_at = Column(DateTime(timezone=True))
     lastSyncDate = Column(DateTime(timezone=True))
+    # Copies of the fields reports use, so they can be filtered and totalled without loading data
+    destination_type = Column(String)
+    amount = Column(BigInteger)
+    fee_total = Column(BigInteger)
     data = Column(JSONB)
 
 class Order(base):  
@@ -114,9 +124,553 @@ class DailyReport(base):
 	reportEndDate = Column(DateTime(timezone=True))
 	data = Column(JSONB)
 
+class OrderFinancial(base):
+    # Create an ORM class for holding the classified financial statistics of one payment (and its order) or one refund
+    # Rows are written at ingest time so reports can be totalled with SUM ... GROUP BY instead of reclassifying every order
+    __tablename__ = 'order_financials'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String) # PAYMENT or REFUND
+    source_id = Column(String) # payment ID or refund ID
+    order_id = Column(String)
+    location_id = Column(String)
+    created_at = Column(DateTime(timezone=True))
+    fares = Column(BigInteger)
+    passes = Column(BigInteger)
+    donations = Column(BigInteger)
+    charters = Column(BigInteger)
+    merchandise_taxable = Column(BigInteger)
+    merchandise_nontaxable = Column(BigInteger)
+    uncategorized = Column(BigInteger)
+    memberships = Column(BigInteger)
+    tax_collected = Column(BigInteger)
+    processing_fees = Column(BigInteger)
+    online_sales = Column(BigInteger)
+    special_events = Column(JSONB)
+    tenders = Column(JSONB)
+    lastSyncDate = Column(DateTime(timezone=True))
+
+class ReportRollup(base):
+    # Create an ORM class for holding the week, month, and fiscal year totals of the daily reports in JSONB format
+    # Rollups with location_id ALL combine every location
+    __tablename__ = 'reportRollups'
+    id = Column(Integer, primary_key=True)
+    period_type = Column(String) # week, month, or fiscal_year
+    period_start = Column(Date)
+    period_end = Column(Date)
+    location_id = Column(String)
+    location_name = Column(String)
+    reportCreationDate = Column(DateTime(timezone=True))
+    data = Column(JSONB)
+
+class BackfillWindow(base):
+    # Create an ORM class for recording which time windows of a backfill have been completely loaded from Square
+    # entity is payments, orders, refunds, or payoutEntries
+    __tablename__ = 'backfillWindows'
+    id = Column(Integer, primary_key=True)
+    entity = Column(String)
+    location_id = Column(String)
+    window_start = Column(DateTime(timezone=True))
+    window_end = Column(DateTime(timezone=True))
+    objectCount = Column(Integer)
+    completedDate = Column(DateTime(timezone=True))
+
+class SyncRun(base):
+    # Create an ORM class for the ledger of cron and backfill runs, data holds the per stage timings and counters in JSONB format
+    __tablename__ = 'sync_runs'
+    id = Column(Integer, primary_key=True)
+    run_type = Column(String) # cron or load
+    status = Column(String) # running, completed, or failed
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+    seconds = Column(Integer)
+    data = Column(JSONB)
+
+class ReportJob(base):
+    # Create an ORM class for the queue of reports rendered in the background by msmsquarereportworker.py
+    # args are the /square/reports query parameters, result holds the rendered report once status is done
+    __tablename__ = 'reportJobs'
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String, unique=True)
+    status = Column(String) # queued, running, done, or failed
+    args = Column(JSONB)
+    requested_by = Column(String)
+    created_at = Column(DateTime(timezone=True))
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+    error = Column(String)
+    result = Column(LargeBinary)
+    attempts = Column(Integer, nullable=False, server_default='0') # times a worker has claimed the job
+
+class SchemaMigration(base):
+    # Create an ORM class for recording which schema changes have been made to the local database, see migrateDB
+    __tablename__ = 'schemaMigrations'
+    name = Column(String, primary_key=True)
+    status = Column(String) # applied or failed
+    appliedDate = Column(DateTime(timezone=True))
+    error = Column(String)
+
+# Columns added to existing tables after they were first created, with the SQL that fills them from data
+TYPED_COLUMN_MIGRATIONS = [
+    ('payments', 'status', 'varchar', "data->>'status'"),
+    ('payments', 'source_type', 'varchar', "data->>'source_type'"),
+    ('payments', 'external_type', 'varchar', "data->'external_details'->>'type'"),
+    ('payments', 'amount', 'bigint', "(data->'total_money'->>'amount')::bigint"),
+    ('payments', 'fee_total', 'bigint', "COALESCE((SELECT SUM((fee->'amount_money'->>'amount')::bigint) FROM jsonb_array_elements(COALESCE(data->'processing_fee', '[]'::jsonb)) AS f(fee)), 0)"),
+    ('refunds', 'destination_type', 'varchar', "data->>'destination_type'"),
+    ('refunds', 'amount', 'bigint', "(data->'amount_money'->>'amount')::bigint"),
+    ('refunds', 'fee_total', 'bigint', "COALESCE((SELECT SUM((fee->'amount_money'->>'amount')::bigint) FROM jsonb_array_elements(COALESCE(data->'processing_fee', '[]'::jsonb)) AS f(fee)), 0)"),
+    ]
+
+# Unique indexes on the Square IDs, the bulk loader merges on these
+# Created separately from INDEXES since a table that already has duplicate rows can not get one
+UNIQUE_KEY_INDEXES = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS payments_payment_id_key ON payments (payment_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS refunds_refund_id_key ON refunds (refund_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS orders_order_id_key ON orders (order_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS catalog_catalog_id_key ON catalog (catalog_id)',
+    ]
+
+# Indexes used by the report queries
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS payments_location_created_idx ON payments (location_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS refunds_location_created_idx ON refunds (location_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS order_financials_location_created_idx ON order_financials (location_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS report_jobs_queued_idx ON "reportJobs" (id) WHERE status = \'queued\'',
+    'CREATE UNIQUE INDEX IF NOT EXISTS backfill_windows_key_idx ON "backfillWindows" (entity, location_id, window_start, window_end)',
+    # Finds the orders that sold a catalog object for recomputeOrderFinancialsForCatalogObjects, line_items @> [{"catalog_object_id": ...}]
+    'CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_line_items_idx ON orders USING gin ((data->\'line_items\') jsonb_path_ops)',
+    ]
+
+def initDB(db):
+    # Create any tables that are missing from the local database, then make any schema changes it has not had yet
+    base.metadata.create_all(db)
+    migrateDB(db)
+    return
+
+def schemaMigrations():
+    # The schema changes made to existing databases in the order they are made, as (name, SQL statement or function of an engine)
+    # A change is only ever made once, migrateDB records it in schemaMigrations by name so names must not change
+    migrations = []
+    for table, column, columnType, fillSQL in TYPED_COLUMN_MIGRATIONS:
+        migrations.append(('column {}.{}'.format(table, column), 'ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}'.format(table, column, columnType)))
+    for index in INDEXES + UNIQUE_KEY_INDEXES:
+        migrations.append(('index ' + index.split(' IF NOT EXISTS ')[1].split()[0], index))
+    migrations.append(('fill typed columns', backfillTypedColumns))
+    migrations.append(('column reportJobs.attempts', 'ALTER TABLE "reportJobs" ADD COLUMN IF NOT EXISTS attempts integer NOT NULL DEFAULT 0'))
+    return migrations
+
+def migrateDB(db, retryFailed=False):
+    # Make the schema changes in schemaMigrations() that have not been made yet, so a migrated database costs one query
+    # instead of taking ACCESS EXCLUSIVE locks on the hot tables and rescanning them on every cron run
+    # A change that fails (a unique index on a table with duplicate rows) is recorded as failed and not tried again
+    # until this is run with retryFailed, by loadmsmsquaredb.py --migrate
+    with db.connect() as connection:
+        done = dict(connection.execute(text('SELECT name, status FROM "schemaMigrations"')).all())
+    for name, migration in schemaMigrations():
+        if done.get(name) == 'applied' or (done.get(name) == 'failed' and not retryFailed):
+            continue
+        logging.info('Migrating database: %s', name)
+        error = None
+        try:
+            if callable(migration):
+                migration(db)
+            elif 'CONCURRENTLY' in migration:
+                # Can not run in a transaction, but does not block writes to the table while it builds
+                with db.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                    connection.execute(text(migration))
+            else:
+                with db.begin() as connection:
+                    connection.execute(text(migration))
+        except SQLAlchemyError as exc:
+            error = str(exc)
+            logging.warning('Could not migrate database (%s), run loadmsmsquaredb.py --migrate to try again: %s', name, exc)
+            if name.startswith('index') and 'UNIQUE' in migration:
+                logging.warning('Bulk loading will not work for this table until duplicates are removed')
+        with db.begin() as connection:
+            connection.execute(text("""INSERT INTO "schemaMigrations" (name, status, "appliedDate", error) VALUES (:name, :status, now(), :error)
+                ON CONFLICT (name) DO UPDATE SET status = excluded.status, "appliedDate" = excluded."appliedDate", error = excluded.error"""),
+                {'name': name, 'status': 'failed' if error else 'applied', 'error': error})
+    return
+
+def backfillTypedColumns(db):
+    # Fill the typed payment and refund columns from data for rows saved before the columns existed
+    # Rows written by savePaymentInDB/saveRefundInDB already have them, so this only touches old rows
+    # fee_total is never NULL once a row has been filled (a payment with no total_money still has a NULL amount), so it marks the rows left to fill
+    tables = {}
+    for table, column, columnType, fillSQL in TYPED_COLUMN_MIGRATIONS:
+        tables.setdefault(table, []).append((column, fillSQL))
+    with db.begin() as connection:
+        for table, columns in tables.items():
+            assignments = ', '.join('{} = {}'.format(column, fillSQL) for column, fillSQL in columns)
+            result = connection.execute(text('UPDATE {} SET {} WHERE fee_total IS NULL'.format(table, assignments)))
+            if result.rowcount:
+                logging.info('Filled typed columns for %s rows in %s', result.rowcount, table)
+    return
+
+def paymentColumns(payment):
+    # The typed Payment columns for a payment dict
+    return {'status': payment.get('status'),
+        'source_type': payment.get('source_type'),
+        'external_type': payment.get('external_details', {}).get('type'),
+        'amount': payment['total_money']['amount'],
+        'fee_total': sum(fee['amount_money']['amount'] for fee in payment.get('processing_fee', []))}
+
+def refundColumns(refund):
+    # The typed Refund columns for a refund dict
+    return {'destination_type': refund.get('destination_type'),
+        'amount': refund['amount_money']['amount'],
+        'fee_total': sum(fee['amount_money']['amount'] for fee in refund.get('processing_fee', []))}
+
+class EntityCache(object):
+    # Request scoped identity cache of the payments, refunds, orders, and catalog objects needed for a report window
+    # Each entity type is loaded with one WHERE id IN (...) query per chunk of IDs and the getters are then served from memory
+    # Anything not found here falls back to the database (and Square) as before
+    __slots__ = ('paymentTotals', 'refundTotals', 'orders', 'catalog', 'categories')
+
+    def __init__(self):
+        self.paymentTotals = {} # payment ID -> typed payment columns, see getPaymentTotals
+        self.refundTotals = {} # refund ID -> typed refund columns, see getRefundTotals
+        self.orders = {}
+        self.catalog = {}
+        self.categories = {} # object ID -> category dict returned by getCategoryForObject
+
+    def prefetch(self, paymentIDs, orderIDs, refundIDs, db_session):
+        # Load the passed payments, orders, and refunds plus every catalog object their line items need
+        self.paymentTotals.update(self.loadTotalsByID(Payment.payment_id, (Payment.source_type, Payment.external_type, Payment.amount, Payment.fee_total), paymentIDs, db_session))
+        self.refundTotals.update(self.loadTotalsByID(Refund.refund_id, (Refund.destination_type, Refund.amount, Refund.fee_total), refundIDs, db_session))
+        self.orders.update(self.loadByID(Order.order_id, Order.data, orderIDs, db_session))
+        objectIDs = set()
+        for orderID in orderIDs:
+            order = self.orders.get(orderID)
+            if order is None:
+                continue
+            for item in order.get('line_items', []):
+                objectIDs.add(item.get('catalog_object_id'))
+            for ireturn in order.get('returns', []):
+                for item in ireturn.get('return_line_items', []):
+                    objectIDs.add(item.get('catalog_object_id'))
+        # Variations point at items, which point at categories, so load one level at a time
+        while objectIDs:
+            objectIDs.discard(None)
+            loaded = self.loadByID(Catalog.catalog_id, Catalog.data, objectIDs - set(self.catalog), db_session)
+            self.catalog.update(loaded)
+            objectIDs = set()
+            for catalogData in loaded.values():
+                if catalogData['type'] == 'ITEM_VARIATION':
+                    objectIDs.add(catalogData['item_variation_data']['item_id'])
+                elif catalogData['type'] == 'ITEM':
+                    objectIDs.add(catalogData['item_data'].get('category_id'))
+        return self
+
+    @staticmethod
+    def loadByID(idColumn, dataColumn, ids, db_session):
+        # Returns a dict of id -> data for the ids found in the database
+        ids = list(set(ids))
+        loaded = {}
+        for i in range(0, len(ids), 1000):
+            for entityID, data in db_session.query(idColumn, dataColumn).filter(idColumn.in_(ids[i:i+1000])):
+                loaded[entityID] = data
+        return loaded
+
+    @staticmethod
+    def loadTotalsByID(idColumn, totalColumns, ids, db_session):
+        # Returns a dict of id -> dict of the typed total columns, rows whose typed columns have not been filled are left out
+        ids = list(set(ids))
+        loaded = {}
+        for i in range(0, len(ids), 1000):
+            for row in db_session.query(idColumn, *totalColumns).filter(idColumn.in_(ids[i:i+1000])):
+                totals = row._asdict()
+                entityID = totals.pop(idColumn.key)
+                if totals['amount'] is not None:
+                    loaded[entityID] = totals
+        return loaded
+
+    def categoryForObject(self, objectID):
+        # Returns the category dict for an item or item variation, or None if anything needed is not cached
+        if objectID in self.categories:
+            return self.categories[objectID]
+        catalogData = self.catalog.get(objectID)
+        if catalogData is None:
+            return None
+        if catalogData['type'] == 'ITEM_VARIATION':
+            category = self.categoryForObject(catalogData['item_variation_data']['item_id'])
+        elif catalogData['type'] == 'ITEM':
+            if not 'category_id' in catalogData['item_data']:
+                category = {'categoryID': -1}
+            else:
+                categoryID = catalogData['item_data']['category_id']
+                if not categoryID in self.catalog:
+                    return None
+                category = {'categoryID': categoryID, 'categoryName': self.catalog[categoryID]['category_data']['name']}
+        else:
+            return None
+        if category is not None:
+            self.categories[objectID] = category
+        return category
+
+@contextmanager
+def entityCacheForWindow(paymentIDs, orderIDs, refundIDs, db_session):
+    # Serve getPaymentTotals, getRefundTotals, getLineItemsFromOrder, getReturnedLineItemsFromOrder, and getCategoryForObject
+    # for the passed IDs from memory while the with block runs
+    previousCache = db_session.info.get('entityCache')
+    db_session.info['entityCache'] = EntityCache().prefetch(paymentIDs, orderIDs, refundIDs, db_session)
+    try:
+        yield db_session.info['entityCache']
+    finally:
+        db_session.info['entityCache'] = previousCache
+
+def getCachedEntity(kind, entityID, db_session):
+    # Returns an entity's data from the session's EntityCache, or None if there is no cache or it does not hold the entity
+    cache = db_session.info.get('entityCache')
+    if cache is None:
+        return None
+    return getattr(cache, kind).get(entityID)
+
+# Counters the sync ledger keeps for each stage
+SYNC_COUNTERS = ('pages', 'inserted', 'updated', 'skipped', 'bulkMerged', 'httpCalls', 'retries', 'throttles', 'dbQueries', 'dbCommits')
+
+class SyncLedger(object):
+    # Records the start and end of each stage of a sync run with counters of the Square and database work done in it
+    # Counters are added to the stage the calling thread is in, stages with the same name (the same entity and location from different
+    # backfill threads) are combined. The run is saved in sync_runs when it starts and again when it finishes
+    def __init__(self, runType, db):
+        self.runType = runType
+        self.db = db
+        self.Session = sessionmaker(db)
+        self.lock = threading.Lock()
+        self.threadState = threading.local()
+        self.stages = {}
+        self.runCounters = Counter()
+        self.locks = []
+        self.startedAt = datetime.now(timezone.utc)
+        self.runID = None
+
+    def start(self):
+        with self.Session() as db_session:
+            run = SyncRun(run_type=self.runType, status='running', started_at=self.startedAt, data={})
+            db_session.add(run)
+            db_session.commit()
+            self.runID = run.id
+        event.listen(self.db, 'after_cursor_execute', self.onQuery)
+        event.listen(self.db, 'commit', self.onCommit)
+        return self
+
+    def onQuery(self, conn, cursor, statement, parameters, context, executemany):
+        self.count('dbQueries')
+
+    def onCommit(self, conn):
+        self.count('dbCommits')
+
+    @contextmanager
+    def stage(self, name):
+        # Everything counted by this thread inside the with block is added to the stage called name
+        with self.lock:
+            if not name in self.stages:
+                self.stages[name] = {'name': name, 'started': datetime.now(timezone.utc), 'finished': None, 'seconds': 0.0, 'counters': Counter()}
+        previousStage = getattr(self.threadState, 'stage', None)
+        self.threadState.stage = name
+        stageStart = monotonic()
+        try:
+            yield
+        finally:
+            self.threadState.stage = previousStage
+            with self.lock:
+                self.stages[name]['finished'] = datetime.now(timezone.utc)
+                self.stages[name]['seconds'] += monotonic() - stageStart
+
+    def count(self, counter, n=1):
+        stage = getattr(self.threadState, 'stage', None)
+        with self.lock:
+            self.runCounters[counter] += n
+            if stage is not None:
+                self.stages[stage]['counters'][counter] += n
+
+    def recordLock(self, name, state):
+        # Keep what happened with each advisory lock the run asked for (acquired, skipped, or waited)
+        with self.lock:
+            self.locks.append({'name': name, 'state': state, 'at': datetime.now(timezone.utc).isoformat()})
+
+    def summary(self):
+        with self.lock:
+            stages = [{'name': stage['name'], 'started': stage['started'].isoformat(), 'finished': stage['finished'].isoformat() if stage['finished'] else None,
+                'seconds': round(stage['seconds'], 3), 'counters': dict((counter, stage['counters'][counter]) for counter in SYNC_COUNTERS)} for stage in self.stages.values()]
+            return {'runType': self.runType, 'runID': self.runID, 'counters': dict((counter, self.runCounters[counter]) for counter in SYNC_COUNTERS), 'stages': stages, 'locks': list(self.locks)}
+
+    def finish(self, status='completed'):
+        # Stop counting, save the run, and log its summary as one JSON line
+        event.remove(self.db, 'after_cursor_execute', self.onQuery)
+        event.remove(self.db, 'commit', self.onCommit)
+        finishedAt = datetime.now(timezone.utc)
+        summary = self.summary()
+        summary['status'] = status
+        summary['seconds'] = round((finishedAt - self.startedAt).total_seconds(), 3)
+        with self.Session() as db_session:
+            run = db_session.get(SyncRun, self.runID)
+            run.status = status
+            run.finished_at = finishedAt
+            run.seconds = int(summary['seconds'])
+            run.data = summary
+            db_session.commit()
+        logging.info('Sync run summary: %s', json.dumps(summary, sort_keys=True))
+        return summary
+
+# The ledger of the sync run in progress in this process, if any
+activeSyncLedger = None
+
+def startSyncLedger(runType, db):
+    # Start a ledger for this process's sync run, the save functions and Square requests count into it
+    global activeSyncLedger
+    activeSyncLedger = SyncLedger(runType, db).start()
+    return activeSyncLedger
+
+def finishSyncLedger(status='completed'):
+    global activeSyncLedger
+    if activeSyncLedger is None:
+        return
+    summary = activeSyncLedger.finish(status)
+    activeSyncLedger = None
+    return summary
+
+def countSync(counter, n=1):
+    # Add to a counter of the active sync ledger, does nothing outside of a sync run
+    if activeSyncLedger is not None:
+        activeSyncLedger.count(counter, n)
+
+@contextmanager
+def syncStage(name):
+    # A stage of the active sync ledger, or nothing outside of a sync run
+    if activeSyncLedger is None:
+        yield
+    else:
+        with activeSyncLedger.stage(name):
+            yield
+
+@contextmanager
+def advisoryLock(name, db_session, mode=None, shared=False):
+    # Hold the Postgres advisory lock called name for the with block, yields True if the lock is held and False if it was skipped
+    # mode skip gives up straight away if another run holds the lock, wait blocks until it is free, defaults to syncLockMode in the config
+    # Shared locks can be held by many runs at once but not at the same time as the exclusive lock of the same name
+    # The lock is taken on a connection of its own since advisory locks belong to a connection and the session's connection changes after each commit
+    if mode is None:
+        mode = msmSquareConfig.get('syncLockMode', 'skip')
+    if mode not in ('skip', 'wait'):
+        raise Exception('Unknown advisory lock mode: {}'.format(mode))
+    suffix = '_shared' if shared else ''
+    connection = db_session.get_bind().connect()
+    try:
+        acquired = connection.execute(text('SELECT pg_try_advisory_lock{}(hashtext(:name))'.format(suffix)), {'name': 'msmsquare:'+name}).scalar()
+        if not acquired and mode == 'wait':
+            logging.info('Waiting for lock: %s', name)
+            recordSyncLock(name, 'waiting')
+            connection.execute(text('SELECT pg_advisory_lock{}(hashtext(:name))'.format(suffix)), {'name': 'msmsquare:'+name})
+            acquired = True
+        connection.commit()
+        if acquired:
+            recordSyncLock(name, 'acquired')
+        else:
+            logging.info('Skipping, another run holds lock: %s', name)
+            recordSyncLock(name, 'skipped')
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                connection.execute(text('SELECT pg_advisory_unlock{}(hashtext(:name))'.format(suffix)), {'name': 'msmsquare:'+name})
+                connection.commit()
+    finally:
+        connection.close()
+
+def recordSyncLock(name, state):
+    # Note what happened to an advisory lock in the active sync ledger, does nothing outside of a sync run
+    if activeSyncLedger is not None:
+        activeSyncLedger.recordLock(name, state)
+
+class RateLimiter(object):
+    # Spaces calls out so that no more than rate calls per second are made, shared by every thread in the process
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.nextCall = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            callTime = max(now, self.nextCall)
+            self.nextCall = callTime + self.interval
+        if callTime > now:
+            sleep(callTime - now)
+        return
+
+squareRateLimiter = RateLimiter(msmSquareConfig.get('squareRequestsPerSecond', 10))
+
+def squareRequest(method, url, headers, maxRetries=5, **kwargs):
+    # Make a request to the Square API under the shared rate limit
+    # If Square says we are making too many requests wait (as long as Retry-After asks, otherwise backing off) and try again
+    for attempt in range(maxRetries + 1):
+        squareRateLimiter.wait()
+        if attempt:
+            countSync('retries')
+        countSync('httpCalls')
+        r = requests.request(method, url, headers=headers, **kwargs)
+        if r.status_code != 429:
+            return r
+        countSync('throttles')
+        if attempt == maxRetries:
+            return r
+        try:
+            delay = float(r.headers['Retry-After'])
+        except (KeyError, ValueError):
+            delay = 2 ** attempt
+        logging.warning('Square rate limit reached, retrying %s in %s seconds', url, delay)
+        sleep(delay)
+
+def iterSquarePages(url, listKey, headers, payload=None):
+    # Yields each page of objects from a Square list endpoint (or search endpoint when a payload is given), following the cursor until there are no more pages
+    # Nothing is yielded if Square returns no objects
+    cursor = None
+    while True:
+        if payload is None:
+            r = squareRequest('GET', url if cursor is None else url+('&' if '?' in url else '?')+'cursor='+cursor, headers=headers)
+        else:
+            r = squareRequest('POST', url, headers=headers, json=payload if cursor is None else dict(payload, cursor=cursor))
+        response = r.json()
+        if not listKey in response:
+            return
+        countSync('pages')
+        yield response[listKey]
+        # Check to see if the list from Square has been paginated
+        if not 'cursor' in response:
+            # There are no more pages to process
+            return
+        cursor = response['cursor']
+
+def endIngestBatch(db_session):
+    # Called after each page of objects is saved, every save has already committed so the session's objects can be let go
+    # Records the largest identity map seen so runs can report it, then empties the identity map
+    identityMapSize = len(db_session.identity_map)
+    db_session.info['peakIdentityMap'] = max(db_session.info.get('peakIdentityMap', 0), identityMapSize)
+    db_session.expunge_all()
+    return
+
+def ingestMemoryStats(db_session):
+    # Returns the session's peak identity map size and the process's current and peak resident memory in MB
+    stats = {'peakIdentityMap': max(db_session.info.get('peakIdentityMap', 0), len(db_session.identity_map)),
+        'peakRSS': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            stats['currentRSS'] = int(statm.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except IOError:
+        # Not on Linux
+        stats['currentRSS'] = None
+    return stats
+
+def logIngestMemory(db_session, stage):
+    stats = ingestMemoryStats(db_session)
+    logging.info('%s: peak identity map %s objects, RSS %s MB (peak %.1f MB)', stage, stats['peakIdentityMap'], 'unknown' if stats['currentRSS'] is None else '{:.1f}'.format(stats['currentRSS']), stats['peakRSS'])
+    return stats
+
 def getLocationsFromSquare(db_session, headers):
     #Get a current list of locations from Square and store in the local database, update any existing records too
-    r = requests.get('https://connect.squareup.com/v2/locations', headers=headers)
+    r = squareRequest('GET', 'https://connect.squareup.com/v2/locations', headers=headers)
     response = r.json()
     locations = response['locations']
     for location in locations:
@@ -136,16 +690,21 @@ def getLocationsFromSquare(db_session, headers):
             raise Exception('Multiple Locations Found in Database with Location ID: {}'.format(location['id']))
     return locations
 
+# Rows fetched at a time by the iter* query functions, which stream results with a server side cursor
+# Do not commit on a session while iterating one of them, committing closes the cursor
+YIELD_PER = 500
+
+def iterLocations(db_session, headers):
+    #Yield each location's data from the local database
+    for location in db_session.query(Location.data).yield_per(YIELD_PER):
+        yield location.data
+
 def getLocations(db_session, headers):
     #Get a current list of locations from the local database
-    locationsInDB = db_session.query(Location).all()
-    locations = []
-    for location in locationsInDB:
-        locations.append(location.data)
-    return locations
+    return list(iterLocations(db_session, headers))
 
 def getLocationByID(locationID, db_session, headers):
-    locationInDB = db_session.query(Location).filter(Location.location_id==locationID).one()
+    locationInDB = db_session.query(Location.location_id, Location.name).filter(Location.location_id==locationID).one()
     location = {'location_id':locationInDB.location_id, 'name':locationInDB.name}
     return location
 
@@ -154,66 +713,92 @@ def savePaymentInDB(payment, db_session, headers):
     # Takes in a payment dict, if the payment ID exists in the database it is updated, if not it is added
     try:
         paymentInDB = db_session.query(Payment).filter(Payment.data.contains({'id': payment['id']})).one()
-        # Yes, it's already in the DB so we should update the DB with the passed payment dict
-        logging.debug('Payment Found in DB, updating: %s', payment['id'])
-        paymentInDB.data = payment
-        paymentInDB.location_id = payment['location_id']
-        paymentInDB.order_id = payment['order_id']
-        paymentInDB.payment_id = payment['id']
-        paymentInDB.created_at = payment['created_at']
-        paymentInDB.updated_at = payment.get('updated_at')
-        paymentInDB.lastSyncDate = datetime.now(timezone.utc)
-        db_session.commit()
+        if paymentInDB.data == payment and paymentInDB.amount is not None:
+            # Nothing has changed since the last sync, skip the write and the reclassification
+            countSync('skipped')
+            return
+        else:
+            # Yes, it's already in the DB so we should update the DB with the passed payment dict
+            logging.debug('Payment Found in DB, updating: %s', payment['id'])
+            paymentInDB.data = payment
+            paymentInDB.location_id = payment['location_id']
+            paymentInDB.order_id = payment['order_id']
+            paymentInDB.payment_id = payment['id']
+            paymentInDB.created_at = payment['created_at']
+            paymentInDB.updated_at = payment.get('updated_at')
+            paymentInDB.lastSyncDate = datetime.now(timezone.utc)
+            for column, value in paymentColumns(payment).items():
+                setattr(paymentInDB, column, value)
+            db_session.commit()
+            countSync('updated')
     except NoResultFound:
         # The payment ID is not in the database yet, add the passed payment dict to the database
         logging.debug('Payment NOT Found in DB, adding: %s', payment['id'])
-        db_payment = Payment(data=payment,payment_id=payment['id'],order_id=payment['order_id'],location_id=payment['location_id'],created_at=payment['created_at'],updated_at=payment.get('updated_at'),lastSyncDate = datetime.now(timezone.utc))
+        db_payment = Payment(data=payment,payment_id=payment['id'],order_id=payment['order_id'],location_id=payment['location_id'],created_at=payment['created_at'],updated_at=payment.get('updated_at'),lastSyncDate = datetime.now(timezone.utc),**paymentColumns(payment))
         db_session.add(db_payment)
         db_session.commit()
+        countSync('inserted')
     except MultipleResultsFound:
         raise Exception('Multiple Payments Found in Database with Payment ID: {}'.format(payment['id']))
+    materializePaymentFinancials(payment, db_session, headers)
     return
 
 def saveRefundInDB(refund, db_session, headers):
     # Takes in a refund dict, if the refund ID exists in the database it is updated, if not it is added
     try:
         refundInDB = db_session.query(Refund).filter(Refund.data.contains({'id': refund['id']})).one()
-        # Yes, it's already in the DB so we should update the DB with the passed refund dict
-        refundInDB.data = refund
-        refundInDB.location_id = refund['location_id']
-        refundInDB.order_id = refund['order_id']
-        refundInDB.payment_id = refund['payment_id']
-        refundInDB.refund_id = refund['id']
-        refundInDB.created_at = refund['created_at']
-        refundInDB.updated_at = refund.get('updated_at')
-        refundInDB.lastSyncDate = datetime.now(timezone.utc)
-        db_session.commit()
+        if refundInDB.data == refund and refundInDB.amount is not None:
+            # Nothing has changed since the last sync, skip the write and the reclassification
+            countSync('skipped')
+            return
+        else:
+            # Yes, it's already in the DB so we should update the DB with the passed refund dict
+            refundInDB.data = refund
+            refundInDB.location_id = refund['location_id']
+            refundInDB.order_id = refund['order_id']
+            refundInDB.payment_id = refund['payment_id']
+            refundInDB.refund_id = refund['id']
+            refundInDB.created_at = refund['created_at']
+            refundInDB.updated_at = refund.get('updated_at')
+            refundInDB.lastSyncDate = datetime.now(timezone.utc)
+            for column, value in refundColumns(refund).items():
+                setattr(refundInDB, column, value)
+            db_session.commit()
+            countSync('updated')
     except NoResultFound:
         # The refund ID is not in the database yet, add the passed refund dict to the database
-        db_refund = Refund(data=refund,refund_id=refund['id'],payment_id=refund['payment_id'],order_id=refund['order_id'],location_id=refund['location_id'],created_at = refund['created_at'],updated_at = refund.get('updated_at'),lastSyncDate = datetime.now(timezone.utc))
+        db_refund = Refund(data=refund,refund_id=refund['id'],payment_id=refund['payment_id'],order_id=refund['order_id'],location_id=refund['location_id'],created_at = refund['created_at'],updated_at = refund.get('updated_at'),lastSyncDate = datetime.now(timezone.utc),**refundColumns(refund))
         db_session.add(db_refund)
         db_session.commit()
+        countSync('inserted')
     except MultipleResultsFound:
         raise Exception('Multiple Refunds Found in Database with Refund ID: {}'.format(refund['id']))
+    materializeRefundFinancials(refund, db_session, headers)
     return
 
 def savePayoutInDB(payout, db_session, headers):
     # Takes in a payout dict, if the refund ID exists in the database it is updated, if not it is added
     try:
         payoutInDB = db_session.query(Payout).filter(Payout.data.contains({'id': payout['id']})).one()
-        # Yes, it's already in the DB so we should update the DB with the passed payout dict
-        payoutInDB.data = payout
-        payoutInDB.location_id = payout['location_id']
-        payoutInDB.payout_id = payout['id']
-        payoutInDB.created_at = payout['created_at']
-        payoutInDB.updated_at = payout.get('updated_at')
-        payoutInDB.lastSyncDate = datetime.now(timezone.utc)
-        db_session.commit()
+        if payoutInDB.data == payout:
+            # Nothing has changed since the last sync, skip the write
+            countSync('skipped')
+        else:
+            # Yes, it's already in the DB so we should update the DB with the passed payout dict
+            payoutInDB.data = payout
+            payoutInDB.location_id = payout['location_id']
+            payoutInDB.payout_id = payout['id']
+            payoutInDB.created_at = payout['created_at']
+            payoutInDB.updated_at = payout.get('updated_at')
+            payoutInDB.lastSyncDate = datetime.now(timezone.utc)
+            db_session.commit()
+            countSync('updated')
     except NoResultFound:
         # The payout ID is not in the database yet, add the passed payout dict to the database
         db_payout = Payout(data=payout,payout_id=payout['id'],location_id=payout['location_id'],created_at = payout['created_at'],updated_at = payout.get('updated_at'),lastSyncDate = datetime.now(timezone.utc))
         db_session.add(db_payout)
         db_session.commit()
+        countSync('inserted')
     except MultipleResultsFound:
         raise Exception('Multiple Payouts Found in Database with Payout ID: {}'.format(payout['id']))
     return
@@ -222,19 +807,25 @@ def savePayoutEntryInDB(payoutEntry, db_session, headers):
     # Takes in a payoutEntry dict, if the refund ID exists in the database it is updated, if not it is added
     try:
         payoutEntryInDB = db_session.query(PayoutEntries).filter(PayoutEntries.data.contains({'id': payoutEntry['id']})).one()
-        # Yes, it's already in the DB so we should update the DB with the passed payoutEntry dict
-        payoutEntryInDB.data = payoutEntry
-        payoutEntryInDB.payoutEntry_id = payoutEntry['id']
-        payoutEntryInDB.payout_id = payoutEntry['payout_id']
-        payoutEntryInDB.type = payoutEntry['type']
-        payoutEntryInDB.effective_at = payoutEntry['effective_at']
-        payoutEntryInDB.lastSyncDate = datetime.now(timezone.utc)
-        db_session.commit()
+        if payoutEntryInDB.data == payoutEntry:
+            # Nothing has changed since the last sync, skip the write
+            countSync('skipped')
+        else:
+            # Yes, it's already in the DB so we should update the DB with the passed payoutEntry dict
+            payoutEntryInDB.data = payoutEntry
+            payoutEntryInDB.payoutEntry_id = payoutEntry['id']
+            payoutEntryInDB.payout_id = payoutEntry['payout_id']
+            payoutEntryInDB.type = payoutEntry['type']
+            payoutEntryInDB.effective_at = payoutEntry['effective_at']
+            payoutEntryInDB.lastSyncDate = datetime.now(timezone.utc)
+            db_session.commit()
+            countSync('updated')
     except NoResultFound:
         # The payout ID is not in the database yet, add the passed payoutEntry dict to the database
         db_payoutEntry = PayoutEntries(data=payoutEntry,payoutEntry_id=payoutEntry['id'],payout_id=payoutEntry['payout_id'],effective_at = payoutEntry['effective_at'],type = payoutEntry['type'],lastSyncDate = datetime.now(timezone.utc))
         db_session.add(db_payoutEntry)
         db_session.commit()
+        countSync('inserted')
     except MultipleResultsFound:
         raise Exception('Multiple Payout Entries Found in Database with Payout Entry ID: {}'.format(payoutEntry['id']))
     return
@@ -243,20 +834,28 @@ def saveOrderInDB(order, db_session, headers):
     # Takes in an order dict, if the order ID exists in the database it is updated, if not it is added 
     try:
         orderInDB = db_session.query(Order).filter(Order.data.contains({'id': order['id']})).one()
-        # Yes, it's already in the DB so we should update the DB with the passed payment dict
-        orderInDB.data = order
-        orderInDB.location_id = order['location_id']
-        orderInDB.created_at = order['created_at']
-        orderInDB.updated_at = order.get('updated_at')
-        orderInDB.lastSyncDate = datetime.now(timezone.utc)
-        db_session.commit()
+        if orderInDB.data == order:
+            # Nothing has changed since the last sync, skip the write and the reclassification
+            countSync('skipped')
+            return
+        else:
+            # Yes, it's already in the DB so we should update the DB with the passed payment dict
+            orderInDB.data = order
+            orderInDB.location_id = order['location_id']
+            orderInDB.created_at = order['created_at']
+            orderInDB.updated_at = order.get('updated_at')
+            orderInDB.lastSyncDate = datetime.now(timezone.utc)
+            db_session.commit()
+            countSync('updated')
     except NoResultFound:
         # The payment ID is not in the database yet, add the passed payment dict to the database
         db_order = Order(data=order,order_id=order['id'],location_id=order['location_id'],created_at = order['created_at'],updated_at = order.get('updated_at'),lastSyncDate = datetime.now(timezone.utc))
         db_session.add(db_order)
         db_session.commit()
+        countSync('inserted')
     except MultipleResultsFound:
         raise Exception('Multiple Orders Found in Database with Order ID: {}'.format(order['id']))
+    materializeOrderFinancials(order['id'], db_session, headers)
     return
 
 def getPayment(paymentID, db_session, headers):
@@ -267,7 +866,7 @@ def getPayment(paymentID, db_session, headers):
         logging.debug('Payment Found in Local DB: %s',paymentID)
         return payment.data
     except NoResultFound:
-        r = requests.get('https://connect.squareup.com/v2/payments/'+paymentID, headers=headers)
+        r = squareRequest('GET', 'https://connect.squareup.com/v2/payments/'+paymentID, headers=headers)
         response = r.json()
         payment = response['payment']
         savePaymentInDB(payment, db_session, headers)
@@ -277,55 +876,56 @@ def getPayment(paymentID, db_session, headers):
         raise Exception('Multiple Payments Found in Database with Payment ID: {}'.format(paymentID))
         return
 
+def getPaymentTotals(paymentID, db_session, headers):
+    # Returns the typed columns (source_type, external_type, amount, fee_total) of a payment, which is all the reports need
+    # Uses the report window's entity cache, then the typed columns in the database, then the full payment from getPayment
+    totals = getCachedEntity('paymentTotals', paymentID, db_session)
+    if totals is not None:
+        return totals
+    paymentInDB = db_session.query(Payment.source_type, Payment.external_type, Payment.amount, Payment.fee_total).filter(Payment.payment_id == paymentID).first()
+    if paymentInDB is not None and paymentInDB.amount is not None:
+        return paymentInDB._asdict()
+    return paymentColumns(getPayment(paymentID, db_session, headers))
+
+def iterPaymentsByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers, save=True):
+    #Yield each payment that Square has between two dates for a given location as its page arrives, saving it in the database unless save is False
+    for payments in iterSquarePages('https://connect.squareup.com/v2/payments?location_id='+locationID+'&begin_time='+startTime+'&end_time='+stopTime, 'payments', headers):
+        for payment in payments:
+            logging.debug('Processing Payment: %s', payment['id'])
+            logging.debug(' Payment Date: %s', payment['created_at'])
+            if save:
+                savePaymentInDB(payment, db_session, headers)
+            yield payment
+        # Release the page's objects so long syncs run in constant memory
+        endIngestBatch(db_session)
+
 def getPaymentsByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers):
     #Get all of the payments that Square has between two dates for a given location
-    paymentList = []
-    r = requests.get('https://connect.squareup.com/v2/payments?location_id='+locationID+'&begin_time='+startTime+'&end_time='+stopTime, headers=headers)
-    response = r.json()
-    try:
-        payments = response['payments']
-        while True:
-            for payment in payments:
-                logging.debug('Processing Payment: %s', payment['id'])
-                logging.debug(' Payment Date: %s', payment['created_at'])
-                savePaymentInDB(payment, db_session, headers)
-                paymentList.append(payment['id'])
-            # Check to see if the list of payments from Square has been paginated
-            try:
-                cursor = response['cursor']
-                # Yes, it has so obtain the next page of payments
-                r = requests.get('https://connect.squareup.com/v2/payments?location_id='+locationID+'&begin_time='+startTime+'&end_time='+stopTime+'&cursor='+cursor, headers=headers)
-                response = r.json()
-                payments = response['payments']
-            except KeyError:
-                # There are no more pages of payments to process
-                break
-    except KeyError:
-        #No payments were returned
-        pass
-    return paymentList
+    return [payment['id'] for payment in iterPaymentsByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers)]
+
+def iterPaymentsAndOrdersByDateRange(startTime, stopTime, locationID, db_session, headers):
+    #Yield the payment and associated order IDs between two dates for a given location
+    #do not include failed or cancelled payments in the payments and orders, sometimes they have orderids which don't really exist
+    #status is only read from data for rows that have not had their typed columns filled yet
+    paymentsInDB = db_session.query(Payment.payment_id, Payment.order_id, Payment.created_at).filter(Payment.location_id == locationID, Payment.created_at >= startTime, Payment.created_at < stopTime, func.coalesce(Payment.status, Payment.data['status'].astext).notin_(['FAILED', 'CANCELED'])).yield_per(YIELD_PER)
+    for payment in paymentsInDB:
+        logging.debug('Processing Payment: %s', payment.payment_id)
+        logging.debug(' Payment Date: %s', payment.created_at)
+        yield {'paymentID': payment.payment_id, 'orderID': payment.order_id}
 
 def getPaymentsAndOrdersByDateRange(startTime, stopTime, locationID, db_session, headers):
     #Get all of the payment and associated order IDs between two dates for a given location
-    paymentsAndOrders = []
     try:
-        paymentsInDB = db_session.query(Payment).filter(Payment.location_id == locationID, Payment.created_at >= startTime, Payment.created_at < stopTime).all()
-        for payment in paymentsInDB:
-            logging.debug('Processing Payment: %s', payment.payment_id)
-            logging.debug(' Payment Date: %s', payment.created_at)
-            if payment.data['status'] == 'FAILED' or payment.data['status'] == 'CANCELED':
-                #do not include failed or cancelled payments in the payments and orders, sometimes they have orderids which don't really exist
-                pass
-            else:
-                paymentsAndOrders.append({'paymentID': payment.payment_id, 'orderID': payment.order_id})
-        return paymentsAndOrders
+        return list(iterPaymentsAndOrdersByDateRange(startTime, stopTime, locationID, db_session, headers))
     except:
         return
 
 def getLineItemsFromOrder(orderID, db_session, headers):
     try:
-        orderInDB = db_session.query(Order).filter(Order.order_id == orderID).one()
-        orderData = orderInDB.data
+        orderData = getCachedEntity('orders', orderID, db_session)
+        if orderData is None:
+            orderInDB = db_session.query(Order).filter(Order.order_id == orderID).one()
+            orderData = orderInDB.data
         if not 'line_items' in orderData:
             logging.debug('No line items in Order: %s', orderID)
             return -1
@@ -339,8 +939,10 @@ def getLineItemsFromOrder(orderID, db_session, headers):
 def getReturnedLineItemsFromOrder(orderID, db_session, headers):
     lineItems = []
     try:
-        orderInDB = db_session.query(Order).filter(Order.order_id == orderID).one()
-        orderData = orderInDB.data
+        orderData = getCachedEntity('orders', orderID, db_session)
+        if orderData is None:
+            orderInDB = db_session.query(Order).filter(Order.order_id == orderID).one()
+            orderData = orderInDB.data
         for ireturn in orderData['returns']:
             for item in ireturn['return_line_items']:
                 lineItems.append(item)
@@ -352,7 +954,12 @@ def getReturnedLineItemsFromOrder(orderID, db_session, headers):
 
 def getCategoryForObject(objectID, catalogVersion, db_session, headers):
     # Returns the category ID and category name of an item or item variation
-    # Try from local first
+    # Try the report window's entity cache, then local, then Square
+    cache = db_session.info.get('entityCache')
+    if cache is not None:
+        category = cache.categoryForObject(objectID)
+        if category is not None:
+            return category
     try:
         objectInDB = db_session.query(Catalog).filter(Catalog.catalog_id == objectID).one()
         catalogData = objectInDB.data
@@ -369,7 +976,7 @@ def getCategoryForObject(objectID, catalogVersion, db_session, headers):
             logging.debug('ITEM or ITEM VARIATION not returned for Object ID: %s', objectID)
             return
     except NoResultFound:
-        r = requests.get('https://connect.squareup.com/v2/catalog/object/'+objectID+'?catalog_version='+str(catalogVersion), headers=headers)
+        r = squareRequest('GET', 'https://connect.squareup.com/v2/catalog/object/'+objectID+'?catalog_version='+str(catalogVersion), headers=headers)
         response = r.json()
         object = response['object']
         saveCatalogObjectInDB(object, db_session, headers)
@@ -393,41 +1000,28 @@ def getCategoryForObject(objectID, catalogVersion, db_session, headers):
         categoryName = categoryInDB.data['category_data']['name']
     except NoResultFound:
         print('No category for: '+categoryID)
-        r = requests.get('https://connect.squareup.com/v2/catalog/object/'+categoryID+'?catalog_version='+str(catalogVersion), headers=headers)
+        r = squareRequest('GET', 'https://connect.squareup.com/v2/catalog/object/'+categoryID+'?catalog_version='+str(catalogVersion), headers=headers)
         response = r.json()
         saveCatalogObjectInDB(object, db_session, headers)
         categoryName = response['category_data']['name']
     category = {'categoryID': categoryID, 'categoryName': categoryName}
     return category
 
-def getOrdersByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers):
-    #Get all of the orders that Square has between two dates for a given location
-    orderList = []
+def iterOrdersByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers, save=True):
+    #Yield each order that Square has between two dates for a given location as its page arrives, saving it in the database unless save is False
     payload = {'location_ids':[locationID],'query':{'filter':{'date_time_filter':{'created_at':{'start_at':startTime,'end_at':stopTime}}}}}
-    r = requests.post('https://connect.squareup.com/v2/orders/search', headers=headers, json=payload)
-    response = r.json()
-    try:
-        orders = response['orders']
-        while True:
-            for order in orders:
-                logging.debug('Processing Order: %s', order['id'])
+    for orders in iterSquarePages('https://connect.squareup.com/v2/orders/search', 'orders', headers, payload=payload):
+        for order in orders:
+            logging.debug('Processing Order: %s', order['id'])
+            if save:
                 saveOrderInDB(order, db_session, headers)
-                orderList.append(order['id'])
-            # Check to see if the list of orders from Square has been paginated
-            try:
-                cursor = response['cursor']
-                # Yes, it has so obtain the next page of orders
-                payload = {'location_ids':[locationID],'query':{'filter':{'date_time_filter':{'created_at':{'start_at':startTime,'end_at':stopTime}}}},'cursor':cursor}
-                r = requests.post('https://connect.squareup.com/v2/orders/search', headers=headers, json=payload)
-                response = r.json()
-                orders = response['orders']
-            except KeyError:
-                # There are no more pages of payments to process
-                break
-    except KeyError:
-        #No orders were returned
-        pass
-    return orderList
+            yield order
+        # Release the page's objects so long syncs run in constant memory
+        endIngestBatch(db_session)
+
+def getOrdersByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers):
+    #Get all of the orders that Square has between two dates for a given location
+    return [order['id'] for order in iterOrdersByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers)]
 
 def getOrder(orderID, db_session, headers):
     # Check the local cache to see if we have that order data. If yes, return it. If no, get it from square, store it in the local cache, and then return it.
@@ -437,7 +1031,7 @@ def getOrder(orderID, db_session, headers):
         print ("Order Found in Local DB: {}".format(orderID))
         return refund.data
     except NoResultFound:
-        r = requests.get('https://connect.squareup.com/v2/orders/'+orderID, headers=headers)
+        r = squareRequest('GET', 'https://connect.squareup.com/v2/orders/'+orderID, headers=headers)
         response = r.json()
         order = response['order']
         saveOrderInDB(order, db_session, headers)
@@ -447,87 +1041,88 @@ def getOrder(orderID, db_session, headers):
         raise Exception('Multiple Orders Found in Database with Order ID: {}'.format(orderID))
         return
 
+def iterCatalogFromSquare(db_session, headers, save=True):
+    #Yield each object in the current full catalog from Square as its page arrives, storing it in the local database and updating any existing records unless save is False
+    changedObjects=[]
+    for catalogObjects in iterSquarePages('https://connect.squareup.com/v2/catalog/list', 'objects', headers):
+        for catalogObject in catalogObjects:
+            if save and saveCatalogObjectInDB(catalogObject, db_session, headers):
+                changedObjects.append(catalogObject['id'])
+            yield catalogObject
+        # Release the page's objects so long syncs run in constant memory
+        endIngestBatch(db_session)
+    if changedObjects:
+        # Categories changed during the sync, reclassify the orders that sold the affected items
+        recomputeOrderFinancialsForCatalogObjects(changedObjects, db_session, headers)
+
 def getCatalogFromSquare(db_session, headers):
     #Get a current full catalog from Square and store in the local database, update any existing records too
-    catalog=[]
-    r = requests.get('https://connect.squareup.com/v2/catalog/list', headers=headers)
-    response = r.json()
-    try:
-        catalogObjects = response['objects']
-        while True:
-            for catalogObject in catalogObjects:
-                saveCatalogObjectInDB(catalogObject, db_session, headers)
-                catalog.append(catalogObject)
-            # Check to see if the list of objects from Square has been paginated
-            try:
-                cursor = response['cursor']
-                # Yes, it has so obtain the next page of objects
-                r = requests.get('https://connect.squareup.com/v2/catalog/list?cursor='+cursor, headers=headers)
-                response = r.json()
-                catalogObjects = response['objects']
-            except KeyError:
-                # There are no more pages of payments to process
-                break
-    except KeyError:
-        #No objects were returned
-        pass
-    return catalog
+    return list(iterCatalogFromSquare(db_session, headers))
 
 def saveCatalogObjectInDB(catalogObject, db_session, headers):
     # Takes in an object dict, if the object ID exists in the database it is updated, if not it is added
+    # Returns True if an existing object changed in a way that changes how line items are categorized
+    classificationChanged = False
     try:
         objectInDB = db_session.query(Catalog).filter(Catalog.data.contains({'id': catalogObject['id']})).one()
-        # Yes, it's already in the DB so we should update the DB with the passed object dict
-        objectInDB.data = catalogObject
-        objectInDB.type = catalogObject['type']
-        objectInDB.version = catalogObject['version']
-        objectInDB.is_deleted = catalogObject['is_deleted']
-        objectInDB.lastSyncDate = datetime.now(timezone.utc)
-        db_session.commit()
+        if objectInDB.data == catalogObject:
+            # Nothing has changed since the last sync, skip the write
+            countSync('skipped')
+        else:
+            # Yes, it's already in the DB so we should update the DB with the passed object dict
+            classificationChanged = catalogClassificationChanged(objectInDB.data, catalogObject)
+            objectInDB.data = catalogObject
+            objectInDB.type = catalogObject['type']
+            objectInDB.version = catalogObject['version']
+            objectInDB.is_deleted = catalogObject['is_deleted']
+            objectInDB.lastSyncDate = datetime.now(timezone.utc)
+            db_session.commit()
+            countSync('updated')
     except NoResultFound:
         # The object ID is not in the database yet, add the passed object dict to the database
         db_catalog = Catalog(data=catalogObject,catalog_id=catalogObject['id'],type=catalogObject['type'],is_deleted=catalogObject['is_deleted'],lastSyncDate = datetime.now(timezone.utc))
         db_session.add(db_catalog)
         db_session.commit()
+        countSync('inserted')
     except MultipleResultsFound:
         raise Exception('Multiple Catalog Objects Found in Database with Catalog Object ID: {}'.format(catalogObject['id']))
-    return
+    return classificationChanged
+
+def catalogClassificationChanged(oldObject, newObject):
+    # Compare two versions of a catalog object and return True if the category of any item they cover could have changed
+    if newObject['type'] == 'ITEM':
+        return oldObject.get('item_data', {}).get('category_id') != newObject.get('item_data', {}).get('category_id')
+    elif newObject['type'] == 'ITEM_VARIATION':
+        return oldObject.get('item_variation_data', {}).get('item_id') != newObject.get('item_variation_data', {}).get('item_id')
+    elif newObject['type'] == 'CATEGORY':
+        return oldObject.get('category_data', {}).get('name') != newObject.get('category_data', {}).get('name')
+    return False
+
+def iterRefundsByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers, save=True):
+    #Yield each refund that Square has between two dates for a given location as its page arrives, saving it in the database unless save is False
+    for refunds in iterSquarePages('https://connect.squareup.com/v2/refunds?location_id='+locationID+'&begin_time='+startTime+'&end_time='+stopTime, 'refunds', headers):
+        for refund in refunds:
+            logging.debug('Processing Refund: %s', refund['id'])
+            logging.debug(' Refund Date: %s', refund['created_at'])
+            if save:
+                saveRefundInDB(refund, db_session, headers)
+            yield refund
+        # Release the page's objects so long syncs run in constant memory
+        endIngestBatch(db_session)
 
 def getRefundsByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers):
     #Get all of the refunds that Square has between two dates for a given location
-    refundList = []
-    r = requests.get('https://connect.squareup.com/v2/refunds?location_id='+locationID+'&begin_time='+startTime+'&end_time='+stopTime, headers=headers)
-    response = r.json()
-    try:
-        refunds = response['refunds']
-        while True:
-            for refund in refunds:
-                logging.debug('Processing Refund: %s', refund['id'])
-                logging.debug(' Refund Date: %s', refund['created_at'])
-                saveRefundInDB(refund, db_session, headers)
-                refundList.append(refund['id'])
-            # Check to see if the list of refunds from Square has been paginated
-            try:
-                cursor = response['cursor']
-                # Yes, it has so obtain the next page of refund
-                r = requests.get('https://connect.squareup.com/v2/refunds?location_id='+locationID+'&begin_time='+startTime+'&end_time='+stopTime+'&cursor='+cursor, headers=headers)
-                response = r.json()
-                refunds = response['refunds']
-            except KeyError:
-                # There are no more pages of refunds to process
-                break
-    except KeyError:
-        #No refunds were returned
-        pass
-    return refundList
+    return [refund['id'] for refund in iterRefundsByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers)]
+
+def iterRefundsByDateRange(startTime, stopTime, locationID, db_session, headers):
+    #Yield the refund, payment, and associated order IDs between two dates for a given location
+    refundsInDB = db_session.query(Refund.refund_id, Refund.payment_id, Refund.order_id).filter(Refund.location_id == locationID, Refund.created_at >= startTime, Refund.created_at < stopTime ).yield_per(YIELD_PER)
+    for refund in refundsInDB:
+        yield {'refundID': refund.refund_id, 'paymentID': refund.payment_id,'orderID': refund.order_id}
 
 def getRefundsByDateRange(startTime, stopTime, locationID, db_session, headers):
     #Get all of the refund, payment, and associated order IDs between two dates for a given location
-    refunds = []
-    refundsInDB = db_session.query(Refund).filter(Refund.location_id == locationID, Refund.created_at >= startTime, Refund.created_at < stopTime ).all()
-    for refund in refundsInDB:
-        refunds.append({'refundID': refund.refund_id, 'paymentID': refund.payment_id,'orderID': refund.order_id})
-    return refunds
+    return list(iterRefundsByDateRange(startTime, stopTime, locationID, db_session, headers))
 
 def getRefund(refundID, db_session, headers):
     # Check the local cache to see if we have that refund data. If yes, return it. If no, get it from square, store it in the local cache, and then return it.
@@ -537,7 +1132,7 @@ def getRefund(refundID, db_session, headers):
         logging.debug('Refund Found in Local DB: %s',refundID)
         return refund.data
     except NoResultFound:
-        r = requests.get('https://connect.squareup.com/v2/refunds/'+refundID, headers=headers)
+        r = squareRequest('GET', 'https://connect.squareup.com/v2/refunds/'+refundID, headers=headers)
         response = r.json()
         refund = response['refund']
         saveRefundInDB(refund, db_session, headers)
@@ -547,238 +1142,506 @@ def getRefund(refundID, db_session, headers):
         raise Exception('Multiple Refunds Found in Database with Refund ID: {}'.format(refundID))
         return
 
+def getRefundTotals(refundID, db_session, headers):
+    # Returns the typed columns (destination_type, amount, fee_total) of a refund, which is all the reports need
+    # Uses the report window's entity cache, then the typed columns in the database, then the full refund from getRefund
+    totals = getCachedEntity('refundTotals', refundID, db_session)
+    if totals is not None:
+        return totals
+    refundInDB = db_session.query(Refund.destination_type, Refund.amount, Refund.fee_total).filter(Refund.refund_id == refundID).first()
+    if refundInDB is not None and refundInDB.amount is not None:
+        return refundInDB._asdict()
+    return refundColumns(getRefund(refundID, db_session, headers))
+
+def iterPayoutsByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers, save=True):
+    #Yield each payout that Square has between two dates for a given location as its page arrives, saving it in the database unless save is False
+    for payouts in iterSquarePages('https://connect.squareup.com/v2/payouts?location_id='+locationID+'&begin_time='+startTime+'&end_time='+stopTime, 'payouts', headers):
+        for payout in payouts:
+            logging.debug('Processing Payout: %s', payout['id'])
+            logging.debug(' Payout Date: %s', payout['created_at'])
+            if save:
+                savePayoutInDB(payout, db_session, headers)
+            yield payout
+        # Release the page's objects so long syncs run in constant memory
+        endIngestBatch(db_session)
+
 def getPayoutsByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers):
     #Get all of the payouts that Square has between two dates for a given location
-    payoutList = []
-    r = requests.get('https://connect.squareup.com/v2/payouts?location_id='+locationID+'&begin_time='+startTime+'&end_time='+stopTime, headers=headers)
-    response = r.json()
-    try:
-        payouts = response['payouts']
-        while True:
-            for payout in payouts:
-                logging.debug('Processing Payout: %s', payout['id'])
-                logging.debug(' Payout Date: %s', payout['created_at'])
-                savePayoutInDB(payout, db_session, headers)
-                payoutList.append(payout['id'])
-            # Check to see if the list of payouts from Square has been paginated
-            try:
-                cursor = response['cursor']
-                # Yes, it has so obtain the next page of payouts
-                r = requests.get('https://connect.squareup.com/v2/payouts?location_id='+locationID+'&begin_time='+startTime+'&end_time='+stopTime+'&cursor='+cursor, headers=headers)
-                response = r.json()
-                payouts = response['payouts']
-            except KeyError:
-                # There are no more pages of payouts to process
-                break
-    except KeyError:
-        #No payouts were returned
-        pass
-    return payoutList
+    return [payout['id'] for payout in iterPayoutsByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers)]
 
-def getPayoutEntriesByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers):
+def iterPayoutEntriesByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers, save=True):
     # NOTE this gets all the payouts too
-    #Get all of the payouts that Square has between two dates for a given location
-    payoutList = getPayoutsByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers)
-    payoutEntryList = []
+    #Yield each payout entry for the payouts that Square has between two dates for a given location, saving the payouts and entries in the database unless save is False
+    payoutList = [payout['id'] for payout in iterPayoutsByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers, save=save)]
     for payout in payoutList:
-        r = requests.get('https://connect.squareup.com/v2/payouts/'+payout+'/payout-entries', headers=headers)
-        response = r.json()
-        try:
-            payoutEntries = response['payout_entries']
-            while True:
-                for payoutEntry in payoutEntries:
-                    logging.debug('Processing Payout Entry: %s', payoutEntry['id'])
-                    logging.debug(' Payout Entry Effective Date: %s', payoutEntry['effective_at'])
+        for payoutEntries in iterSquarePages('https://connect.squareup.com/v2/payouts/'+payout+'/payout-entries', 'payout_entries', headers):
+            for payoutEntry in payoutEntries:
+                logging.debug('Processing Payout Entry: %s', payoutEntry['id'])
+                logging.debug(' Payout Entry Effective Date: %s', payoutEntry['effective_at'])
+                if save:
                     savePayoutEntryInDB(payoutEntry, db_session, headers)
-                    payoutEntryList.append(payoutEntry['id'])
-                # Check to see if the list of payout entries from Square has been paginated
-                try:
-                    cursor = response['cursor']
-                    # Yes, it has so obtain the next page of payout entries
-                    r = requests.get('https://connect.squareup.com/v2/payouts/'+payout+'/payout-entries?cursor='+cursor, headers=headers)
-                    response = r.json()
-                    payoutEntries = response['payout_entries']
-                except KeyError:
-                    # There are no more pages of payout entries to process
-                    break
-        except KeyError:
-            #No payout entries were returned
-            pass
-    return payoutEntryList
-
-def sumDicts(dicts_list):
-   #Sums the values of matching keys from a list of dictionaries. If a value is another dictionary, recursively sums its values.
-    result = {}
-    for d in dicts_list:
-        for key, value in d.items():
-            if isinstance(value, dict):
-                # Recursively sum nested dictionary values
-                nested_sum = sumDicts([value])
-                result[key] = result.get(key, {}).copy()
-                for nested_key, nested_value in nested_sum.items():
-                    result[key][nested_key] = result[key].get(nested_key, 0) + nested_value
+                yield payoutEntry
+            # Release the page's objects so long syncs run in constant memory
+            endIngestBatch(db_session)
+
+def getPayoutEntriesByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers):
+    # NOTE this gets all the payouts too
+    #Get all of the payouts that Square has between two dates for a given location
+    return [payoutEntry['id'] for payoutEntry in iterPayoutEntriesByDateRangeFromSquare(startTime, stopTime, locationID, db_session, headers)]
+
+# The entities a backfill loads, in the order they have to be loaded so orders can find their payments and refunds their orders
+BACKFILL_ENTITIES = [
+    ('payments', iterPaymentsByDateRangeFromSquare),
+    ('orders', iterOrdersByDateRangeFromSquare),
+    ('refunds', iterRefundsByDateRangeFromSquare),
+    ('payoutEntries', iterPayoutEntriesByDateRangeFromSquare),
+    ]
+
+def backfillWindowsForDates(beginTime, endTime):
+    # Split the time between two datetimes into windows at each local month boundary, returns a list of (windowStart, windowEnd)
+    LOCAL_tzone = tz.gettz(msmSquareConfig['localTimezone'])
+    windows = []
+    windowStart = beginTime
+    while windowStart < endTime:
+        localStart = windowStart.astimezone(LOCAL_tzone)
+        if localStart.month == 12:
+            nextMonth = datetime(localStart.year+1, 1, 1, tzinfo=LOCAL_tzone)
+        else:
+            nextMonth = datetime(localStart.year, localStart.month+1, 1, tzinfo=LOCAL_tzone)
+        windowEnd = min(nextMonth, endTime)
+        windows.append((windowStart, windowEnd))
+        windowStart = windowEnd
+    return windows
+
+def completedBackfillWindows(entity, locationID, db_session):
+    # Returns the set of (windowStart, windowEnd) that have already been loaded for an entity and location
+    windowsInDB = db_session.query(BackfillWindow.window_start, BackfillWindow.window_end).filter(BackfillWindow.entity == entity, BackfillWindow.location_id == locationID).all()
+    return set((window.window_start, window.window_end) for window in windowsInDB)
+
+def saveBackfillWindowInDB(entity, locationID, windowStart, windowEnd, objectCount, db_session):
+    # Record that a window has been completely loaded, replacing any earlier record of the same window
+    db_session.query(BackfillWindow).filter(BackfillWindow.entity == entity, BackfillWindow.location_id == locationID, BackfillWindow.window_start == windowStart, BackfillWindow.window_end == windowEnd).delete()
+    db_session.add(BackfillWindow(entity=entity, location_id=locationID, window_start=windowStart, window_end=windowEnd, objectCount=objectCount, completedDate=datetime.now(timezone.utc)))
+    db_session.commit()
+    return
+
+def backfillWindow(entity, locationID, windowStart, windowEnd, db_session, headers, record=True, bulk=False):
+    # Load one entity for one location and window from Square, then record the window as complete if record is True
+    # If bulk is True and the entity has a bulk loader the objects are loaded with bulkLoad instead of one at a time,
+    # which does not fill order_financials, run materializeOrderFinancialsForDateRange once everything is loaded
+    # Windows of the same entity and location can load side by side (shared lock) but not while cron syncs it (exclusive lock),
+    # a window another backfill is already loading is skipped
+    # Returns the number of objects loaded
+    fetcher = dict(BACKFILL_ENTITIES)[entity]
+    startTime = windowStart.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    stopTime = windowEnd.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    with advisoryLock(entity+' '+locationID, db_session, mode='wait', shared=True), advisoryLock(entity+' '+locationID+' '+startTime+' '+stopTime, db_session, mode='skip') as acquired:
+        if not acquired:
+            return 0
+        if bulk and entity in BULK_TABLES:
+            objectCount = bulkLoad(entity, fetcher(startTime, stopTime, locationID, db_session, headers, save=False), db_session)
+        else:
+            objectCount = sum(1 for _ in fetcher(startTime, stopTime, locationID, db_session, headers))
+        if record:
+            saveBackfillWindowInDB(entity, locationID, windowStart, windowEnd, objectCount, db_session)
+    logging.info('Loaded %s %s for %s from %s to %s', objectCount, entity, locationID, startTime, stopTime)
+    return objectCount
+
+# Tables the bulk loader can fill, with the key column it merges on and the SQL that computes each column from data
+# The typed columns from TYPED_COLUMN_MIGRATIONS are added by bulkColumns
+BULK_TABLES = {
+    'payments': ('payment_id', {'payment_id': "data->>'id'", 'location_id': "data->>'location_id'", 'order_id': "data->>'order_id'",
+        'created_at': "(data->>'created_at')::timestamptz", 'updated_at': "(data->>'updated_at')::timestamptz"}),
+    'refunds': ('refund_id', {'refund_id': "data->>'id'", 'payment_id': "data->>'payment_id'", 'location_id': "data->>'location_id'", 'order_id': "data->>'order_id'",
+        'created_at': "(data->>'created_at')::timestamptz", 'updated_at': "(data->>'updated_at')::timestamptz"}),
+    'orders': ('order_id', {'order_id': "data->>'id'", 'location_id': "data->>'location_id'",
+        'created_at': "(data->>'created_at')::timestamptz", 'updated_at': "(data->>'updated_at')::timestamptz"}),
+    'catalog': ('catalog_id', {'catalog_id': "data->>'id'", 'type': "data->>'type'", 'version': "data->>'version'", 'is_deleted': "(data->>'is_deleted')::boolean"}),
+    }
+
+BULK_BATCH = 5000
+
+def bulkColumns(table):
+    # Returns the key column and a dict of column name to the SQL that fills it for a bulk loaded table
+    keyColumn, columns = BULK_TABLES[table]
+    columns = dict(columns)
+    for migrationTable, column, columnType, fillSQL in TYPED_COLUMN_MIGRATIONS:
+        if migrationTable == table:
+            columns[column] = fillSQL
+    return keyColumn, columns
+
+def bulkMergeBatch(table, objects, db_session):
+    # COPY a list of Square object dicts into a staging table, then merge them into table with one INSERT ... ON CONFLICT
+    # Rows already in the table are replaced, the same as saving them one at a time would do
+    keyColumn, columns = bulkColumns(table)
+    buffer = io.StringIO()
+    for squareObject in objects:
+        # COPY text format treats backslash as an escape character, json.dumps has already escaped tabs and newlines
+        buffer.write(json.dumps(squareObject).replace('\\', '\\\\')+'\n')
+    buffer.seek(0)
+    db_session.execute(text('CREATE TEMP TABLE IF NOT EXISTS square_staging (data jsonb) ON COMMIT DELETE ROWS'))
+    cursor = db_session.connection().connection.cursor()
+    cursor.copy_expert('COPY square_staging (data) FROM STDIN', buffer)
+    # A batch can contain the same object twice (an object updated while paging), keep one of them
+    mergeSQL = 'INSERT INTO {table} ({columns}, data, "lastSyncDate") SELECT DISTINCT ON ({key}) {values}, data, now() FROM square_staging ORDER BY {key} ON CONFLICT ({keyColumn}) DO UPDATE SET {updates}, data = EXCLUDED.data, "lastSyncDate" = EXCLUDED."lastSyncDate"'.format(
+        table=table, columns=', '.join(columns), key=columns[keyColumn], values=', '.join(columns.values()), keyColumn=keyColumn,
+        updates=', '.join('{0} = EXCLUDED.{0}'.format(column) for column in columns if column != keyColumn))
+    result = db_session.execute(text(mergeSQL))
+    db_session.commit()
+    countSync('bulkMerged', result.rowcount)
+    return
+
+def bulkLoad(table, objects, db_session):
+    # Load an iterable of Square object dicts into table in batches of BULK_BATCH using COPY, returns the number of objects loaded
+    objectCount = 0
+    batch = []
+    for squareObject in objects:
+        batch.append(squareObject)
+        if len(batch) >= BULK_BATCH:
+            bulkMergeBatch(table, batch, db_session)
+            objectCount += len(batch)
+            batch = []
+    if batch:
+        bulkMergeBatch(table, batch, db_session)
+        objectCount += len(batch)
+    logging.info('Bulk loaded %s objects into %s', objectCount, table)
+    return objectCount
+
+def iterJSONLinesFile(path, listKey):
+    # Yield the Square objects in a file with one JSON document per line
+    # A line can be a single object or a whole Square list response, in which case the objects under listKey are yielded
+    with open(path, 'r') as jsonLines:
+        for line in jsonLines:
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            if listKey in document:
+                for squareObject in document[listKey]:
+                    yield squareObject
             else:
-                result[key] = result.get(key, 0) + value
-    return result
-
-def summaryFinancialsForPurchase(paymentsAndOrders, locationID, db_session, headers):
-    # Return financial statistics for a given order
-    finStats = {
-		'fares': 0,
-		'passes': 0,
-		'donations': 0,
-		'charters': 0,
-		'merchandise_taxable': 0,
-		'merchandise_nontaxable': 0,
-		'uncategorized': 0,
-		'memberships': 0,
-		'tax_collected': 0,
-		'processing_fees':0,
-        'online_sales':0,
-		'special_events': {},
-		'tenders': {}
-		}
-    special_events = []
-    tenders = []
+                yield document
+
+def bulkLoadJSONLinesFile(table, path, db_session):
+    # Bulk load a JSON lines file of Square objects (or Square list responses) into table
+    listKey = 'objects' if table == 'catalog' else table
+    return bulkLoad(table, iterJSONLinesFile(path, listKey), db_session)
+
+FINANCIAL_BUCKETS = ('fares', 'passes', 'donations', 'charters', 'merchandise_taxable', 'merchandise_nontaxable', 'uncategorized', 'memberships', 'tax_collected', 'processing_fees', 'online_sales')
+
+class FinancialSummary(object):
+    # Accumulates the financial statistics of many orders and refunds into integer counters (amounts are in cents)
+    # Special events and tenders are kept in Counters keyed by event name and tender type
+    # Orders and refunds are added one at a time so no per-order summary needs to be kept around
+    __slots__ = FINANCIAL_BUCKETS + ('special_events', 'tenders', 'transactions')
+
+    def __init__(self):
+        for bucket in FINANCIAL_BUCKETS:
+            setattr(self, bucket, 0)
+        self.special_events = Counter()
+        self.tenders = Counter()
+        # Number of orders and refunds added, a summary with no transactions serializes to an empty dict
+        self.transactions = 0
+
+    def add(self, bucket, amount):
+        setattr(self, bucket, getattr(self, bucket) + amount)
+
+    def addSpecialEvent(self, eventName, amount):
+        self.special_events[eventName] += amount
+
+    def addTender(self, tenderType, amount):
+        self.tenders[tenderType] += amount
+
+    def addLineItem(self, bucket, eventName, amount):
+        # Add a classified line item, see ClassificationRules for the buckets
+        if bucket == 'special_event':
+            self.special_events[eventName] += amount
+        elif bucket is not None:
+            setattr(self, bucket, getattr(self, bucket) + amount)
+
+    def merge(self, other):
+        # Add the totals of another FinancialSummary to this one
+        for bucket in FINANCIAL_BUCKETS:
+            setattr(self, bucket, getattr(self, bucket) + getattr(other, bucket))
+        self.special_events.update(other.special_events)
+        self.tenders.update(other.tenders)
+        self.transactions += other.transactions
+        return self
+
+    def toDict(self):
+        # Serialize to the JSON shape stored in DailyReport.data
+        if not self.transactions:
+            return {}
+        data = {bucket: getattr(self, bucket) for bucket in FINANCIAL_BUCKETS}
+        data['special_events'] = dict(self.special_events)
+        data['tenders'] = dict(self.tenders)
+        return data
+
+    @classmethod
+    def fromDict(cls, data):
+        # Build a FinancialSummary from the JSON shape stored in DailyReport.data
+        summary = cls()
+        if not data:
+            return summary
+        for bucket in FINANCIAL_BUCKETS:
+            setattr(summary, bucket, data.get(bucket, 0))
+        summary.special_events.update(data.get('special_events', {}))
+        summary.tenders.update(data.get('tenders', {}))
+        summary.transactions = 1
+        return summary
+
+# Default line item classification rules, used when config-msmsquare.yaml has no classificationRules
+# These reproduce the original hard coded rules: webstore sales are online sales (except Streetcar Camp registrations),
+# catalog categories map to their income class, and everything else is taxable or non-taxable merchandise
+DEFAULT_CLASSIFICATION_RULES = [
+    {'location': 'LBR2E5T341WDH', 'itemName': 'Streetcar Camp', 'bucket': 'special_event'},
+    {'location': 'LBR2E5T341WDH', 'bucket': 'online_sales'},
+    {'category': 'Special Events', 'bucket': 'special_event'},
+    {'category': 'Fares', 'bucket': 'fares'},
+    {'category': 'Passes', 'bucket': 'passes'},
+    {'category': 'Donations', 'bucket': 'donations'},
+    {'category': 'Charters', 'bucket': 'charters'},
+    {'category': 'Membership', 'bucket': 'memberships'},
+    {'taxable': True, 'bucket': 'merchandise_taxable'},
+    {'taxable': False, 'bucket': 'merchandise_nontaxable'},
+    ]
+
+class ClassificationRules(object):
+    # Line item classification rules compiled into dictionaries so each item is classified with a few hash lookups
+    # Rules are checked by location and item name, then location, then catalog category, then tax status
+    # A bucket is one of FINANCIAL_BUCKETS or special_event (totalled by item name)
+    __slots__ = ('locationItemRules', 'locationRules', 'categoryRules', 'taxableBucket', 'nontaxableBucket')
+
+    def __init__(self):
+        self.locationItemRules = {} # location ID -> {item name -> bucket}
+        self.locationRules = {} # location ID -> bucket
+        self.categoryRules = {} # lower case category name -> bucket
+        self.taxableBucket = 'merchandise_taxable'
+        self.nontaxableBucket = 'merchandise_nontaxable'
+
+    def bucketForLocation(self, locationID, itemName):
+        # Returns the bucket for an item sold at a location with its own rules, or None if the location rules do not apply
+        itemRules = self.locationItemRules.get(locationID)
+        if itemRules is not None and itemName in itemRules:
+            return itemRules[itemName]
+        return self.locationRules.get(locationID)
+
+    def bucketForCategory(self, categoryName, taxAmount):
+        # Returns the bucket for a catalog item in the named category (None if it has no category)
+        if categoryName is None:
+            return 'uncategorized'
+        bucket = self.categoryRules.get(categoryName.lower())
+        if bucket is not None:
+            return bucket
+        if taxAmount == 0:
+            return self.nontaxableBucket
+        return self.taxableBucket
+
+    def sqlParameters(self):
+        # Bind parameters that let REPORT_AGGREGATION_SQL apply these rules with JSONB key lookups
+        return {'locationItemRules': json.dumps(self.locationItemRules), 'locationRules': json.dumps(self.locationRules), 'categoryRules': json.dumps(self.categoryRules), 'taxableBucket': self.taxableBucket, 'nontaxableBucket': self.nontaxableBucket}
+
+def compileClassificationRules(rules):
+    # Compile a list of classification rule dicts, from config-msmsquare.yaml or DEFAULT_CLASSIFICATION_RULES, into ClassificationRules
+    # Each rule has a bucket and matches on location and itemName, location, category, or taxable, the first matching rule wins
+    compiled = ClassificationRules()
+    taxBuckets = {}
+    for rule in rules:
+        bucket = rule.get('bucket')
+        if bucket != 'special_event' and bucket not in FINANCIAL_BUCKETS:
+            raise Exception('Unknown bucket in classification rule: {}'.format(rule))
+        keys = set(rule) - {'bucket'}
+        if keys == {'location', 'itemName'}:
+            compiled.locationItemRules.setdefault(rule['location'], {}).setdefault(rule['itemName'], bucket)
+        elif keys == {'location'}:
+            compiled.locationRules.setdefault(rule['location'], bucket)
+        elif keys == {'category'}:
+            compiled.categoryRules.setdefault(rule['category'].lower(), bucket)
+        elif keys == {'taxable'}:
+            taxBuckets.setdefault(bool(rule['taxable']), bucket)
+        else:
+            raise Exception('Unsupported classification rule: {}'.format(rule))
+    compiled.taxableBucket = taxBuckets.get(True, compiled.taxableBucket)
+    compiled.nontaxableBucket = taxBuckets.get(False, compiled.nontaxableBucket)
+    return compiled
+
+classificationRules = compileClassificationRules(msmSquareConfig.get('classificationRules', DEFAULT_CLASSIFICATION_RULES))
+
+def classifyLineItem(item, locationID, isRefund, db_session, headers):
+    # Returns the bucket and special event name for a sold or returned line item, bucket is None for items that are not counted
+    bucket = classificationRules.bucketForLocation(locationID, item.get('name'))
+    if bucket is not None:
+        return bucket, item.get('name')
+    # Custom Amount items have no catalog object id, they should be treated as uncategorized
+    elif not 'catalog_object_id' in item:
+        if isRefund or item['item_type'] == 'CUSTOM_AMOUNT':
+            return 'uncategorized', None
+        return None, None
+    # get category name for each item
+    category = getCategoryForObject(item['catalog_object_id'], item['catalog_version'], db_session, headers)
+    bucket = classificationRules.bucketForCategory(category.get('categoryName'), item['total_tax_money']['amount'])
+    if isRefund and item.get('variation_name'):
+        return bucket, item['variation_name']
+    return bucket, item['name']
+
+def summaryFinancialsForPurchase(paymentsAndOrders, locationID, db_session, headers, summary=None):
+    # Add the financial statistics for a given order to summary (a new FinancialSummary if none is passed) and return it
+    if summary is None:
+        summary = FinancialSummary()
+    summary.transactions += 1
     # get list of line items from the order
     lineItems = getLineItemsFromOrder(paymentsAndOrders['orderID'], db_session, headers)
     if lineItems == -1:
         #No line items in the order (could be a NO SALE for instance)
-        return finStats
+        return summary
     else:
         for item in lineItems:
-            if locationID == 'LBR2E5T341WDH':
-                # Webstore sale, put all in online category, except for streetcar camp registrations
-                if 'name' in item:
-                    if item['name'] == 'Streetcar Camp':
-                        special_events.append({item['name']:item['total_money']['amount']})
-                    else:
-                        finStats['online_sales'] += item['total_money']['amount']
-                else:
-                    finStats['online_sales'] += item['total_money']['amount']
-            # Custom Amount items have no catalog object id, they should be treated as uncategorized
-            elif not 'catalog_object_id' in item:
-                if item['item_type'] == 'CUSTOM_AMOUNT':
-                    finStats['uncategorized'] += item['total_money']['amount']
-            else:
-                # get category name for each item
-                category = getCategoryForObject(item['catalog_object_id'], item['catalog_version'], db_session, headers)
-                if not 'categoryName' in category:
-                    finStats['uncategorized'] += item['total_money']['amount']
-                elif category['categoryName'].lower() == 'special events':
-                    special_events.append({item['name']:item['total_money']['amount']})
-                elif category['categoryName'].lower() == 'fares':
-                    finStats['fares'] += item['total_money']['amount']
-                elif category['categoryName'].lower() == 'passes':
-                    finStats['passes'] += item['total_money']['amount']
-                elif category['categoryName'].lower() == 'donations':
-                    finStats['donations'] += item['total_money']['amount']
-                elif category['categoryName'].lower() == 'charters':
-                    finStats['charters'] += item['total_money']['amount']
-                elif category['categoryName'].lower() == 'membership':
-                    finStats['memberships'] += item['total_money']['amount']
-                else:
-                    if item['total_tax_money']['amount'] == 0:
-                        finStats['merchandise_nontaxable'] += item['total_money']['amount']
-                    else:
-                        finStats['merchandise_taxable'] += item['total_money']['amount']
-            finStats['tax_collected'] += item['total_tax_money']['amount']
-        finStats['special_events'] = sumDicts(special_events)
-        payment = getPayment(paymentsAndOrders['paymentID'], db_session, headers)
+            bucket, eventName = classifyLineItem(item, locationID, False, db_session, headers)
+            summary.addLineItem(bucket, eventName, item['total_money']['amount'])
+            summary.tax_collected += item['total_tax_money']['amount']
+        payment = getPaymentTotals(paymentsAndOrders['paymentID'], db_session, headers)
         if payment['source_type'] != 'EXTERNAL':
-            tenders.append({payment['source_type']:payment['total_money']['amount']})
-        elif payment['external_details']['type'] == 'CHECK':
-            tenders.append({'CHECK':payment['total_money']['amount']})
-        finStats['tenders'] = sumDicts(tenders)
-        if 'processing_fee' in payment:
-            #skip if there is no fee line in the payment, eg cash sale
-            for fee in payment['processing_fee']:
-                finStats['processing_fees'] += 0-fee['amount_money']['amount']
-        return finStats
-
-def summaryFinancialsForRefund(refundIDs, locationID, db_session, headers):
-    # Return financial statistics for a given refund
-    finStats = {
-		'fares': 0,
-		'passes': 0,
-		'donations': 0,
-		'charters': 0,
-		'merchandise_taxable': 0,
-		'merchandise_nontaxable': 0,
-		'uncategorized': 0,
-		'memberships': 0,
-		'tax_collected': 0,
-		'processing_fees':0,
-        'online_sales':0,
-		'special_events': {},
-		'tenders': {}
-		}
-    special_events = []
-    tenders = []
+            summary.addTender(payment['source_type'], payment['amount'])
+        elif payment['external_type'] == 'CHECK':
+            summary.addTender('CHECK', payment['amount'])
+        #fee_total is 0 if there is no fee line in the payment, eg cash sale
+        summary.processing_fees += 0-payment['fee_total']
+        return summary
+
+def summaryFinancialsForRefund(refundIDs, locationID, db_session, headers, summary=None):
+    # Add the financial statistics for a given refund to summary (a new FinancialSummary if none is passed) and return it
+    if summary is None:
+        summary = FinancialSummary()
+    summary.transactions += 1
     lineItems = getReturnedLineItemsFromOrder(refundIDs['orderID'], db_session, headers)
     for item in lineItems:
-        if locationID == 'LBR2E5T341WDH':
-                # Webstore sale, put all in online category, except for streetcar camp registrations
-                if 'name' in item:
-                    if item['name'] == 'Streetcar Camp':
-                        special_events.append({item['name']:0-item['total_money']['amount']})
-                    else:
-                        finStats['online_sales'] += 0-item['total_money']['amount']
-                else:
-                    finStats['online_sales'] += 0-item['total_money']['amount']
-        elif not 'catalog_object_id' in item:
-            finStats['uncategorized'] += 0-item['total_money']['amount']
-        else:
-            # get category name for each item
-            category = getCategoryForObject(item['catalog_object_id'], item['catalog_version'], db_session, headers)
-            if not 'categoryName' in category:
-                finStats['uncategorized'] += 0-item['total_money']['amount']
-            elif category['categoryName'].lower() == 'special events':
-                if item['variation_name']:
-                    special_events.append({item['variation_name']:0-item['total_money']['amount']})
-                else:
-                    special_events.append({item['name']:0-item['total_money']['amount']})
-            elif category['categoryName'].lower() == 'fares':
-                finStats['fares'] += 0-item['total_money']['amount']
-            elif category['categoryName'].lower() == 'passes':
-                finStats['passes'] += 0-item['total_money']['amount']
-            elif category['categoryName'].lower() == 'donations':
-                finStats['donations'] += 0-item['total_money']['amount']
-            elif category['categoryName'].lower() == 'charters':
-                finStats['charters'] += 0-item['total_money']['amount']
-            elif category['categoryName'].lower() == 'membership':
-                finStats['memberships'] += 0-item['total_money']['amount']
-            else:
-                if item['total_tax_money']['amount'] == 0:
-                    finStats['merchandise_nontaxable'] += 0-item['total_money']['amount']
-                else:
-                    finStats['merchandise_taxable'] += 0-item['total_money']['amount']
-        finStats['tax_collected'] += 0-item['total_tax_money']['amount']
-    finStats['special_events'] = sumDicts(special_events)
-    refund = getRefund(refundIDs['refundID'], db_session, headers) 
-    if 'processing_fee' in refund:
-        # square used to refund the processing fees too
-        for fee in refund['processing_fee']:
-            finStats['processing_fees'] += fee['amount_money']['amount']
-    tenders.append({refund['destination_type']:0-refund['amount_money']['amount']})
-    finStats['tenders'] = sumDicts(tenders)
-    return finStats
+        bucket, eventName = classifyLineItem(item, locationID, True, db_session, headers)
+        summary.addLineItem(bucket, eventName, 0-item['total_money']['amount'])
+        summary.tax_collected += 0-item['total_tax_money']['amount']
+    refund = getRefundTotals(refundIDs['refundID'], db_session, headers)
+    # square used to refund the processing fees too
+    summary.processing_fees += refund['fee_total']
+    summary.addTender(refund['destination_type'], 0-refund['amount'])
+    return summary
 
-def generateSummaryStatsForDateRange(beginTime,endTime,locationID,db_session,headers):
-    location=getLocationByID(locationID,db_session,headers)
+def saveOrderFinancialsInDB(kind, sourceID, orderID, locationID, createdAt, summary, db_session, headers):
+    # Takes in the FinancialSummary of one payment or refund, if a row for it exists in the database it is updated, if not it is added
+    data = summary.toDict()
+    try:
+        financialsInDB = db_session.query(OrderFinancial).filter(OrderFinancial.kind == kind, OrderFinancial.source_id == sourceID).one()
+    except NoResultFound:
+        financialsInDB = OrderFinancial(kind=kind, source_id=sourceID)
+        db_session.add(financialsInDB)
+    except MultipleResultsFound:
+        raise Exception('Multiple Order Financials Found in Database for {} ID: {}'.format(kind, sourceID))
+    financialsInDB.order_id = orderID
+    financialsInDB.location_id = locationID
+    financialsInDB.created_at = createdAt
+    for bucket in FINANCIAL_BUCKETS:
+        setattr(financialsInDB, bucket, data[bucket])
+    financialsInDB.special_events = data['special_events']
+    financialsInDB.tenders = data['tenders']
+    financialsInDB.lastSyncDate = datetime.now(timezone.utc)
+    db_session.commit()
+    return
+
+def deleteOrderFinancialsInDB(kind, sourceID, db_session, headers):
+    # Remove the stored financial statistics of a payment or refund that should no longer be reported
+    db_session.query(OrderFinancial).filter(OrderFinancial.kind == kind, OrderFinancial.source_id == sourceID).delete()
+    db_session.commit()
+    return
+
+def materializePaymentFinancials(payment, db_session, headers):
+    # Classify a payment and its order and store the result in order_financials
+    # Payments are skipped until their order is in the local database, saveOrderInDB materializes them once it arrives
+    try:
+        if payment['status'] == 'FAILED' or payment['status'] == 'CANCELED':
+            deleteOrderFinancialsInDB('PAYMENT', payment['id'], db_session, headers)
+        elif db_session.query(Order.id).filter(Order.order_id == payment['order_id']).first() is not None:
+            summary = summaryFinancialsForPurchase({'paymentID': payment['id'], 'orderID': payment['order_id']}, payment['location_id'], db_session, headers)
+            saveOrderFinancialsInDB('PAYMENT', payment['id'], payment['order_id'], payment['location_id'], payment['created_at'], summary, db_session, headers)
+    except Exception:
+        # A payment that cannot be classified should not stop the sync, it is retried the next time it or its order changes
+        db_session.rollback()
+        logging.exception('Could not materialize financials for Payment: %s', payment['id'])
+    return
+
+def materializeRefundFinancials(refund, db_session, headers):
+    # Classify a refund and store the result in order_financials
+    try:
+        summary = summaryFinancialsForRefund({'refundID': refund['id'], 'paymentID': refund['payment_id'], 'orderID': refund['order_id']}, refund['location_id'], db_session, headers)
+        saveOrderFinancialsInDB('REFUND', refund['id'], refund['order_id'], refund['location_id'], refund['created_at'], summary, db_session, headers)
+    except Exception:
+        db_session.rollback()
+        logging.exception('Could not materialize financials for Refund: %s', refund['id'])
+    return
+
+def materializeOrderFinancials(orderID, db_session, headers):
+    # Reclassify every payment and refund of an order, called when the order or the catalog items it sold change
+    paymentsInDB = db_session.query(Payment).filter(Payment.order_id == orderID).all()
+    for payment in paymentsInDB:
+        materializePaymentFinancials(payment.data, db_session, headers)
+    refundsInDB = db_session.query(Refund).filter(Refund.order_id == orderID).all()
+    for refund in refundsInDB:
+        materializeRefundFinancials(refund.data, db_session, headers)
+    return
+
+def materializeOrderFinancialsForDateRange(startTime, stopTime, locationID, db_session, headers):
+    # Rebuild order_financials for every payment and refund between two dates for a given location, used to backfill the table
+    paymentsInDB = db_session.query(Payment).filter(Payment.location_id == locationID, Payment.created_at >= startTime, Payment.created_at < stopTime).all()
+    for payment in paymentsInDB:
+        materializePaymentFinancials(payment.data, db_session, headers)
+    refundsInDB = db_session.query(Refund).filter(Refund.location_id == locationID, Refund.created_at >= startTime, Refund.created_at < stopTime).all()
+    for refund in refundsInDB:
+        materializeRefundFinancials(refund.data, db_session, headers)
+    return
+
+def recomputeOrderFinancialsForCatalogObjects(catalogIDs, db_session, headers):
+    # Reclassify the orders that sold any of the passed catalog items, item variations, or items in the passed categories
+    catalogIDs = set(catalogIDs)
+    # Items in a changed category
+    itemsInDB = db_session.query(Catalog.catalog_id).filter(Catalog.type == 'ITEM', Catalog.data['item_data']['category_id'].astext.in_(catalogIDs)).all()
+    catalogIDs.update(item.catalog_id for item in itemsInDB)
+    # Variations of a changed item, line items reference the variation
+    variationsInDB = db_session.query(Catalog.catalog_id).filter(Catalog.type == 'ITEM_VARIATION', Catalog.data['item_variation_data']['item_id'].astext.in_(catalogIDs)).all()
+    catalogIDs.update(variation.catalog_id for variation in variationsInDB)
+    logging.info('Reclassifying orders for %s changed catalog objects', len(catalogIDs))
+    catalogIDs = list(catalogIDs)
+    orderIDs = set()
+    # Search in chunks so a large category change does not build one enormous query
+    for i in range(0, len(catalogIDs), 100):
+        conditions = [Order.data['line_items'].contains([{'catalog_object_id': catalogID}]) for catalogID in catalogIDs[i:i+100]]
+        orderIDs.update(order.order_id for order in db_session.query(Order.order_id).filter(or_(*conditions)).all())
+    for orderID in orderIDs:
+        materializeOrderFinancials(orderID, db_session, headers)
+    return
+
+def summaryStatsForDateRange(beginTime,endTime,locationID,db_session,headers):
+    # Calculate the FinancialSummary of all orders and refunds between two times for a given location without saving it
+    # Orders and refunds are streamed into a single accumulator
+    summary = FinancialSummary()
     # Get list of orderIDs in the date range
     paymentsAndOrders = getPaymentsAndOrdersByDateRange(beginTime, endTime, locationID, db_session, headers)
-    summaries = []
-    for paymentAndOrder in paymentsAndOrders:
-	    # get summary statistics for the order
-        summaries.append(summaryFinancialsForPurchase(paymentAndOrder, locationID, db_session, headers))
-    chargeSummaries = sumDicts(summaries)
-    summaries = []
     refunds = getRefundsByDateRange(beginTime, endTime, locationID, db_session, headers)
-    for refund in refunds:
-        summaries.append(summaryFinancialsForRefund(refund, locationID, db_session, headers))
-    refundSummaries = sumDicts(summaries)
-    totalSummaries = sumDicts([chargeSummaries,refundSummaries])
+    # Load everything the summaries need in a few bulk queries instead of one query per order, payment, and catalog object
+    paymentIDs = [paymentAndOrder['paymentID'] for paymentAndOrder in paymentsAndOrders]
+    orderIDs = [paymentAndOrder['orderID'] for paymentAndOrder in paymentsAndOrders] + [refund['orderID'] for refund in refunds]
+    refundIDs = [refund['refundID'] for refund in refunds]
+    with entityCacheForWindow(paymentIDs, orderIDs, refundIDs, db_session):
+        for paymentAndOrder in paymentsAndOrders:
+            # get summary statistics for the order
+            summaryFinancialsForPurchase(paymentAndOrder, locationID, db_session, headers, summary)
+        for refund in refunds:
+            summaryFinancialsForRefund(refund, locationID, db_session, headers, summary)
+    return summary
+
+def generateSummaryStatsForDateRange(beginTime,endTime,locationID,db_session,headers):
+    totalSummaries = summaryStatsForDateRange(beginTime,endTime,locationID,db_session,headers).toDict()
+    saveDailyReport(beginTime,endTime,locationID,totalSummaries,db_session,headers)
+    return totalSummaries
+
+def saveDailyReport(beginTime,endTime,locationID,totalSummaries,db_session,headers):
+    # Takes in a report data dict, if a report for the location and start/end date exists in the database it is updated, if not it is added
+    location=getLocationByID(locationID,db_session,headers)
     try:
         reportInDB = db_session.query(DailyReport).filter(DailyReport.reportStartDate==beginTime, DailyReport.reportEndDate==endTime, DailyReport.location_id==locationID).one()
         # Yes, it's already in the DB so we should update the DB with the passed report data
@@ -797,52 +1660,492 @@ def generateSummaryStatsForDateRange(beginTime,endTime,locationID,db_session,hea
             db_session.commit()
     except MultipleResultsFound:
         raise Exception('Multiple Daily Reports Found in Database with same location and start/end date')
-    return totalSummaries
+    return
+
+# Classifies every sold and returned line item, tender, and fee for a location in Postgres and totals them by business day
+# Business days start at 3am local time, the same as the windows used by generateReportDataForDates
+# Each result row is (business_day, bucket, label, amount) where bucket is a FinancialSummary bucket, 'special_event', 'tender', or 'transactions'
+# This mirrors summaryFinancialsForPurchase/summaryFinancialsForRefund and is driven by the same compiled classificationRules,
+# but catalog objects missing from the local database are not fetched from Square
+REPORT_AGGREGATION_SQL = """
+WITH sale_payments AS (
+    SELECT p.payment_id, p.order_id, p.created_at, p.source_type, p.external_type, p.amount, p.fee_total
+    FROM payments p
+    WHERE p.location_id = :locationID AND p.created_at >= :beginTime AND p.created_at < :endTime
+        AND p.status NOT IN ('FAILED', 'CANCELED')
+), sale_orders AS (
+    SELECT sp.created_at, sp.source_type, sp.external_type, sp.amount, sp.fee_total, o.data AS order_data
+    FROM sale_payments sp JOIN orders o ON o.order_id = sp.order_id
+    WHERE o.data ? 'line_items'
+), refund_rows AS (
+    SELECT r.order_id, r.created_at, r.destination_type, r.amount, r.fee_total
+    FROM refunds r
+    WHERE r.location_id = :locationID AND r.created_at >= :beginTime AND r.created_at < :endTime
+), line_items AS (
+    SELECT so.created_at, 1 AS sign, FALSE AS is_refund, li.item
+    FROM sale_orders so CROSS JOIN LATERAL jsonb_array_elements(so.order_data->'line_items') AS li(item)
+    UNION ALL
+    SELECT rr.created_at, -1 AS sign, TRUE AS is_refund, rli.item
+    FROM refund_rows rr JOIN orders o ON o.order_id = rr.order_id
+        CROSS JOIN LATERAL jsonb_array_elements(COALESCE(o.data->'returns', '[]'::jsonb)) AS ret(ireturn)
+        CROSS JOIN LATERAL jsonb_array_elements(ret.ireturn->'return_line_items') AS rli(item)
+), categorized AS (
+    SELECT li.created_at, li.sign, li.is_refund, li.item,
+        li.item->>'catalog_object_id' AS catalog_object_id,
+        (li.item->'total_money'->>'amount')::bigint AS amount,
+        (li.item->'total_tax_money'->>'amount')::bigint AS tax,
+        cat.data->'category_data'->>'name' AS category_name,
+        COALESCE(CAST(:locationItemRules AS jsonb)->:locationID->>(li.item->>'name'), CAST(:locationRules AS jsonb)->>:locationID) AS location_bucket
+    FROM line_items li
+        LEFT JOIN catalog obj ON obj.catalog_id = li.item->>'catalog_object_id'
+        LEFT JOIN catalog itm ON itm.catalog_id = CASE WHEN obj.data->>'type' = 'ITEM_VARIATION' THEN obj.data->'item_variation_data'->>'item_id' ELSE obj.catalog_id END
+        LEFT JOIN catalog cat ON cat.catalog_id = itm.data->'item_data'->>'category_id'
+), classified AS (
+    SELECT created_at, sign, amount, tax,
+        CASE
+            WHEN location_bucket IS NOT NULL THEN location_bucket
+            WHEN catalog_object_id IS NULL THEN
+                CASE WHEN is_refund OR item->>'item_type' = 'CUSTOM_AMOUNT' THEN 'uncategorized' END
+            WHEN category_name IS NULL THEN 'uncategorized'
+            WHEN CAST(:categoryRules AS jsonb) ? lower(category_name) THEN CAST(:categoryRules AS jsonb)->>lower(category_name)
+            WHEN tax = 0 THEN :nontaxableBucket
+            ELSE :taxableBucket
+        END AS bucket,
+        CASE
+            WHEN is_refund AND location_bucket IS NULL AND COALESCE(item->>'variation_name', '') <> '' THEN item->>'variation_name'
+            ELSE item->>'name'
+        END AS label
+    FROM categorized
+), amounts AS (
+    SELECT created_at, bucket, CASE WHEN bucket = 'special_event' THEN label END AS label, sign * amount AS amount
+    FROM classified WHERE bucket IS NOT NULL
+    UNION ALL
+    SELECT created_at, 'tax_collected', NULL, sign * tax FROM classified
+    UNION ALL
+    SELECT created_at, 'tender',
+        CASE WHEN source_type <> 'EXTERNAL' THEN source_type
+            WHEN external_type = 'CHECK' THEN 'CHECK' END,
+        amount
+    FROM sale_orders
+    UNION ALL
+    SELECT created_at, 'processing_fees', NULL, 0 - fee_total FROM sale_orders
+    UNION ALL
+    SELECT created_at, 'tender', destination_type, 0 - amount FROM refund_rows
+    UNION ALL
+    SELECT created_at, 'processing_fees', NULL, fee_total FROM refund_rows
+    UNION ALL
+    SELECT created_at, 'transactions', NULL, 1 FROM sale_payments
+    UNION ALL
+    SELECT created_at, 'transactions', NULL, 1 FROM refund_rows
+)
+SELECT ((created_at AT TIME ZONE :localTimezone) - interval '3 hours')::date AS business_day, bucket, label, SUM(amount)::bigint AS amount
+FROM amounts
+WHERE NOT (bucket = 'tender' AND label IS NULL)
+GROUP BY business_day, bucket, label
+"""
 
-def generateReportDataForDates(beginDate,endDate, locationID,db_session, headers):
+def summaryStatsForDateRangeSQL(beginTime,endTime,locationID,db_session,headers):
+    # Calculate the FinancialSummary of each business day between two times for a given location inside Postgres
+    # Returns a dict keyed by business day date, days without any transactions are left out
+    summaries = {}
+    params = {'beginTime': beginTime, 'endTime': endTime, 'locationID': locationID, 'localTimezone': msmSquareConfig['localTimezone']}
+    params.update(classificationRules.sqlParameters())
+    for businessDay, bucket, label, amount in db_session.execute(text(REPORT_AGGREGATION_SQL), params):
+        summary = summaries.setdefault(businessDay, FinancialSummary())
+        if bucket == 'transactions':
+            summary.transactions += amount
+        elif bucket == 'special_event':
+            summary.addSpecialEvent(label, amount)
+        elif bucket == 'tender':
+            summary.addTender(label, amount)
+        else:
+            summary.add(bucket, amount)
+    return summaries
+
+# Totals the order_financials rows of a location by business day, see REPORT_AGGREGATION_SQL for how business days are found
+MATERIALIZED_BUCKETS_SQL = """
+SELECT ((created_at AT TIME ZONE :localTimezone) - interval '3 hours')::date AS business_day, COUNT(*) AS transactions, {buckets}
+FROM order_financials
+WHERE location_id = :locationID AND created_at >= :beginTime AND created_at < :endTime
+GROUP BY business_day
+""".format(buckets=', '.join('SUM({0})::bigint AS {0}'.format(bucket) for bucket in FINANCIAL_BUCKETS))
+
+MATERIALIZED_MAPS_SQL = """
+SELECT ((created_at AT TIME ZONE :localTimezone) - interval '3 hours')::date AS business_day, 'special_event' AS bucket, e.key AS label, SUM(e.value::bigint)::bigint AS amount
+FROM order_financials CROSS JOIN LATERAL jsonb_each_text(special_events) AS e
+WHERE location_id = :locationID AND created_at >= :beginTime AND created_at < :endTime
+GROUP BY business_day, e.key
+UNION ALL
+SELECT ((created_at AT TIME ZONE :localTimezone) - interval '3 hours')::date AS business_day, 'tender' AS bucket, t.key AS label, SUM(t.value::bigint)::bigint AS amount
+FROM order_financials CROSS JOIN LATERAL jsonb_each_text(tenders) AS t
+WHERE location_id = :locationID AND created_at >= :beginTime AND created_at < :endTime
+GROUP BY business_day, t.key
+"""
+
+def summaryStatsForDateRangeMaterialized(beginTime,endTime,locationID,db_session,headers):
+    # Total the FinancialSummary of each business day between two times for a given location from the order_financials table
+    # Returns a dict keyed by business day date, days without any transactions are left out
+    summaries = {}
+    params = {'beginTime': beginTime, 'endTime': endTime, 'locationID': locationID, 'localTimezone': msmSquareConfig['localTimezone']}
+    for row in db_session.execute(text(MATERIALIZED_BUCKETS_SQL), params).mappings():
+        summary = summaries.setdefault(row['business_day'], FinancialSummary())
+        summary.transactions += row['transactions']
+        for bucket in FINANCIAL_BUCKETS:
+            summary.add(bucket, row[bucket])
+    for businessDay, bucket, label, amount in db_session.execute(text(MATERIALIZED_MAPS_SQL), params):
+        summary = summaries.setdefault(businessDay, FinancialSummary())
+        if bucket == 'special_event':
+            summary.addSpecialEvent(label, amount)
+        else:
+            summary.addTender(label, amount)
+    return summaries
+
+def businessDaysForDates(beginDate,endDate):
+    # Returns a (business day date, UTC begin time, UTC end time) tuple for each day from beginDate to endDate, days start at 3am local time
     UTC_tzone = tz.gettz('UTC')
     LOCAL_tzone = tz.gettz(msmSquareConfig['localTimezone'])
+    businessDays = []
     deltaDays = endDate-beginDate
     for i in range(deltaDays.days + 1):
         date = beginDate + timedelta(days=i)
         newDayTime = time(3,0,0,tzinfo=LOCAL_tzone)
         beginTime=datetime.combine(date, newDayTime)
-        spelledDate = beginTime.astimezone(LOCAL_tzone).strftime('%A %B %-d, %Y')
-        beginTimeTZ = beginTime.astimezone(LOCAL_tzone)
         endTime=beginTime+timedelta(days=1)
-        endTimeTZ = endTime.astimezone(LOCAL_tzone)
-        endTime=endTime.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ')
-        beginTime=beginTime.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ')
-        logging.info('Generating Report for: %s for Location %s', spelledDate, locationID)
-        generateSummaryStatsForDateRange(beginTime,endTime,locationID,db_session, headers)
+        businessDays.append((beginTime.date(), beginTime.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ'), endTime.astimezone(UTC_tzone).strftime('%Y-%m-%dT%H:%M:%SZ')))
+    return businessDays
+
+def generateReportDataForDates(beginDate,endDate, locationID,db_session, headers, engine=None):
+    # Generate and save the daily reports for a location, engine is 'python' (classify each order here), 'sql' (aggregate in Postgres),
+    # or 'materialized' (total the order_financials rows written at ingest time)
+    # The reportEngine configuration setting is used when no engine is passed
+    if engine is None:
+        engine = msmSquareConfig.get('reportEngine', 'python')
+    businessDays = businessDaysForDates(beginDate,endDate)
+    if engine == 'sql' or engine == 'materialized':
+        if not businessDays:
+            return
+        logging.info('Generating Reports in Postgres for: %s to %s for Location %s', businessDays[0][0], businessDays[-1][0], locationID)
+        if engine == 'sql':
+            summaries = summaryStatsForDateRangeSQL(businessDays[0][1], businessDays[-1][2], locationID, db_session, headers)
+        else:
+            summaries = summaryStatsForDateRangeMaterialized(businessDays[0][1], businessDays[-1][2], locationID, db_session, headers)
+        for businessDay, beginTime, endTime in businessDays:
+            saveDailyReport(beginTime, endTime, locationID, summaries.get(businessDay, FinancialSummary()).toDict(), db_session, headers)
+    elif engine == 'python':
+        for businessDay, beginTime, endTime in businessDays:
+            logging.info('Generating Report for: %s for Location %s', businessDay.strftime('%A %B %-d, %Y'), locationID)
+            generateSummaryStatsForDateRange(beginTime,endTime,locationID,db_session, headers)
+    else:
+        raise Exception('Unknown report engine: {}'.format(engine))
+    refreshReportRollups([businessDay for businessDay, beginTime, endTime in businessDays], locationID, db_session, headers)
     return
 
+def compareReportEngines(beginDate,endDate, locationID, db_session, headers, engine='sql'):
+    # Calculate the daily reports for a location with both the python engine and the passed engine (sql or materialized) without saving them
+    # Returns a list of the days where the engines disagree
+    differences = []
+    businessDays = businessDaysForDates(beginDate,endDate)
+    if not businessDays:
+        return differences
+    if engine == 'materialized':
+        otherSummaries = summaryStatsForDateRangeMaterialized(businessDays[0][1], businessDays[-1][2], locationID, db_session, headers)
+    else:
+        otherSummaries = summaryStatsForDateRangeSQL(businessDays[0][1], businessDays[-1][2], locationID, db_session, headers)
+    for businessDay, beginTime, endTime in businessDays:
+        pythonData = summaryStatsForDateRange(beginTime, endTime, locationID, db_session, headers).toDict()
+        otherData = otherSummaries.get(businessDay, FinancialSummary()).toDict()
+        if pythonData != otherData:
+            logging.warning('Report engines disagree for %s for Location %s', businessDay, locationID)
+            differences.append({'date': businessDay, 'python': pythonData, engine: otherData})
+    return differences
+
+def iterReportDataForDatesFromOneLocation(beginDate,endDate, locationID, db_session, headers):
+    # Yield the daily reports for a location between two dates
+    beginTime, endTime = dailyReportTimesForDates(beginDate, endDate)
+    reportsInDB = db_session.query(DailyReport.location_name, DailyReport.reportStartDate, DailyReport.reportCreationDate, DailyReport.data).filter(DailyReport.reportStartDate.between(beginTime,endTime), DailyReport.location_id==locationID).order_by(DailyReport.location_name,DailyReport.reportStartDate).yield_per(YIELD_PER)
+    for report in reportsInDB:
+        yield dailyReportEntry(report)
+
 def getReportDataForDatesFromOneLocation(beginDate,endDate, locationID, db_session, headers):
-    UTC_tzone = tz.gettz('UTC')
-    LOCAL_tzone = tz.gettz(msmSquareConfig['localTimezone'])
-    reportData = []
-    newDayTime = time(3,0,0,tzinfo=LOCAL_tzone)
-    beginTime = datetime.combine(beginDate, newDayTime)
-    beginTimeTZ = beginTime.astimezone(LOCAL_tzone)
-    endTime = datetime.combine(endDate, newDayTime)
-    endTimeTZ = endTime.astimezone(LOCAL_tzone)
-    reportsInDB = db_session.query(DailyReport).filter(DailyReport.reportStartDate.between(beginTimeTZ,endTimeTZ), DailyReport.location_id==locationID).order_by(DailyReport.location_name,DailyReport.reportStartDate).all()
+    return list(iterReportDataForDatesFromOneLocation(beginDate,endDate, locationID, db_session, headers))
+
+def iterReportDataForDatesFromDBAllLocations(beginDate,endDate, db_session, headers):
+    # Yield the daily reports for every location between two dates, ordered by location and date
+    beginTime, endTime = dailyReportTimesForDates(beginDate, endDate)
+    reportsInDB = db_session.query(DailyReport.location_name, DailyReport.reportStartDate, DailyReport.reportCreationDate, DailyReport.data).filter(DailyReport.reportStartDate.between(beginTime,endTime)).order_by(DailyReport.location_name,DailyReport.reportStartDate).yield_per(YIELD_PER)
     for report in reportsInDB:
-        spelledDate = report.reportStartDate.strftime('%A %B %-d, %Y')
-        reportData.append({'location':report.location_name, 'date': spelledDate, 'created': report.reportCreationDate, 'data': report.data})
-    return reportData
+        yield dailyReportEntry(report)
 
 def getReportDataForDatesFromDBAllLocations(beginDate,endDate, db_session, headers):
-    UTC_tzone = tz.gettz('UTC')
+    return list(iterReportDataForDatesFromDBAllLocations(beginDate,endDate, db_session, headers))
+
+def reportDigestForDates(beginDate, endDate, db_session, rollups=False):
+    # Returns a digest of the IDs and creation dates of the daily reports (and the rollups overlapping the range if rollups is True)
+    # between two dates, which changes whenever any of those reports is regenerated
+    beginTime, endTime = dailyReportTimesForDates(beginDate, endDate)
+    digest = db_session.execute(text("""SELECT md5(COALESCE(string_agg(id || ':' || "reportCreationDate", ',' ORDER BY id), '')) FROM "dailyReports" WHERE "reportStartDate" BETWEEN :beginTime AND :endTime"""),
+        {'beginTime': beginTime, 'endTime': endTime}).scalar()
+    if rollups:
+        rollupDigest = db_session.execute(text("""SELECT md5(COALESCE(string_agg(id || ':' || "reportCreationDate", ',' ORDER BY id), '')) FROM "reportRollups" WHERE period_start <= :endDate AND period_end >= :beginDate"""),
+            {'beginDate': beginDate, 'endDate': endDate}).scalar()
+        digest = digest+rollupDigest
+    return digest
+
+def reportExportColumns(beginDate, endDate, db_session):
+    # The columns of a flattened daily report export: the location and day, each FinancialSummary bucket in dollars,
+    # then a column for every tender type and special event that appears in any report in the range
+    beginTime, endTime = dailyReportTimesForDates(beginDate, endDate)
+    keysInDB = db_session.execute(text("""SELECT 'tender' AS kind, key FROM "dailyReports", jsonb_object_keys(CASE WHEN jsonb_typeof(data->'tenders') = 'object' THEN data->'tenders' ELSE '{}'::jsonb END) AS key
+            WHERE "reportStartDate" BETWEEN :beginTime AND :endTime
+        UNION
+        SELECT 'special_event' AS kind, key FROM "dailyReports", jsonb_object_keys(CASE WHEN jsonb_typeof(data->'special_events') = 'object' THEN data->'special_events' ELSE '{}'::jsonb END) AS key
+            WHERE "reportStartDate" BETWEEN :beginTime AND :endTime
+        ORDER BY kind DESC, key"""), {'beginTime': beginTime, 'endTime': endTime}).all()
+    columns = ['location_id', 'location', 'business_day', 'created'] + list(FINANCIAL_BUCKETS)
+    columns += [row.kind + ':' + row.key for row in keysInDB]
+    return columns
+
+def iterReportExportRows(beginDate, endDate, columns, db_session):
+    # Yield one flattened dict per location-day between two dates with the columns from reportExportColumns, amounts in dollars
     LOCAL_tzone = tz.gettz(msmSquareConfig['localTimezone'])
-    reportData = []
-    newDayTime = time(3,0,0,tzinfo=LOCAL_tzone)
-    beginTime = datetime.combine(beginDate, newDayTime)
-    beginTimeTZ = beginTime.astimezone(LOCAL_tzone)
-    endTime = datetime.combine(endDate, newDayTime)
-    endTimeTZ = endTime.astimezone(LOCAL_tzone)
-    reportsInDB = db_session.query(DailyReport).filter(DailyReport.reportStartDate.between(beginTimeTZ,endTimeTZ)).order_by(DailyReport.location_name,DailyReport.reportStartDate).all()
+    beginTime, endTime = dailyReportTimesForDates(beginDate, endDate)
+    reportsInDB = db_session.query(DailyReport.location_id, DailyReport.location_name, DailyReport.reportStartDate, DailyReport.reportCreationDate, DailyReport.data).filter(DailyReport.reportStartDate.between(beginTime,endTime)).order_by(DailyReport.location_name,DailyReport.reportStartDate).yield_per(YIELD_PER)
     for report in reportsInDB:
-        spelledDate = report.reportStartDate.strftime('%A %B %-d, %Y')
-        reportData.append({'location':report.location_name, 'date': spelledDate, 'created': report.reportCreationDate, 'data': report.data})
-    return reportData
\ No newline at end of file
+        data = report.data or {}
+        row = dict.fromkeys(columns, 0.0)
+        row['location_id'] = report.location_id
+        row['location'] = report.location_name
+        row['business_day'] = report.reportStartDate.astimezone(LOCAL_tzone).date().isoformat()
+        row['created'] = report.reportCreationDate.isoformat()
+        for bucket in FINANCIAL_BUCKETS:
+            row[bucket] = data.get(bucket, 0)/100
+        for tender, amount in data.get('tenders', {}).items():
+            row['tender:'+tender] = amount/100
+        for eventName, amount in data.get('special_events', {}).items():
+            row['special_event:'+eventName] = amount/100
+        yield row
+
+def dailyReportEntry(report):
+    # The dict the report templates expect for a DailyReport row
+    spelledDate = report.reportStartDate.strftime('%A %B %-d, %Y')
+    return {'location':report.location_name, 'date': spelledDate, 'created': report.reportCreationDate, 'data': report.data}
+
+# Income rows of a report in the order they are shown: (account number, label, sub label, bucket)
+# A bucket of None is a heading row with no amount
+REPORT_INCOME_ROWS = [
+    ('4120', 'Charters', '', 'charters'),
+    ('4011', 'Donations', '', 'donations'),
+    ('4111', 'Fares', '', 'fares'),
+    ('4160', 'Memberships', '', 'memberships'),
+    ('', 'Merchandise', '', None),
+    ('4151', '', 'Taxable', 'merchandise_taxable'),
+    ('4152', '', 'Non-Taxable', 'merchandise_nontaxable'),
+    ('4112', 'Passes', '', 'passes'),
+    ]
+
+def formatDollars(amount):
+    return '${:,.2f}'.format(amount)
+
+def dailyReportView(entry, LOCAL_tzone):
+    # Turn a report entry (from dailyReportEntry or the rollup/summary functions) into the rows the report templates lay out,
+    # with every amount already converted from cents and formatted
+    # Totals are added up in the order the rows are shown so they round the same way the template always has
+    data = entry['data']
+    tenders = data.get('tenders', {})
+    def dollars(key):
+        return data[key]/100 if key in data else 0.00
+    incomeRows = []
+    totalIncome = 0.00
+    # Uncategorized and online sales are only shown when there are some
+    for label, key in (('Uncategorized', 'uncategorized'), ('Online Sales', 'online_sales')):
+        if data.get(key, 0) != 0:
+            amount = data[key]/100
+            totalIncome = totalIncome+amount
+            incomeRows.append({'account': '', 'label': label, 'subLabel': '', 'amount': formatDollars(amount), 'amountClass': 'tg-amounts'})
+    for account, label, subLabel, key in REPORT_INCOME_ROWS:
+        if key is None:
+            incomeRows.append({'account': account, 'label': label, 'subLabel': subLabel, 'amount': '', 'amountClass': 'tg-0lax'})
+            continue
+        amount = dollars(key)
+        totalIncome = totalIncome+amount
+        incomeRows.append({'account': account, 'label': label, 'subLabel': subLabel, 'amount': formatDollars(amount), 'amountClass': 'tg-amounts'})
+    incomeRows.append({'account': '', 'label': 'Special Events', 'subLabel': '', 'amount': '', 'amountClass': 'tg-amounts'})
+    for eventName, receipts in data.get('special_events', {}).items():
+        amount = receipts/100
+        totalIncome = totalIncome+amount
+        incomeRows.append({'account': '', 'label': '', 'subLabel': eventName, 'amount': formatDollars(amount), 'amountClass': 'tg-0lax'})
+    processingFees = dollars('processing_fees')
+    taxExpense = 0-(data['tax_collected']/100) if 'tax_collected' in data else 0.00
+    expenseRows = [
+        {'label': 'Partial Refunds', 'amount': formatDollars(dollars('partial_refunds'))},
+        {'label': 'Credit Card Processing Fees', 'amount': formatDollars(processingFees)},
+        {'label': 'Sales Tax Expense', 'amount': formatDollars(taxExpense)},
+        ]
+    cashAmount = tenders['CASH']/100 if 'CASH' in tenders else 0.00
+    checkAmount = tenders['CHECK']/100 if 'CHECK' in tenders else 0.00
+    ccAmount = tenders['CARD']/100 if 'CARD' in tenders else 0.00
+    if 'WALLET' in tenders:
+        ccAmount = ccAmount + (tenders['WALLET']/100)
+    # The processing fees are negative, so adding them gives the net deposit
+    ccNetAmount = ccAmount+processingFees
+    return {'location': entry['location'],
+        'date': entry['date'],
+        'created': entry['created'].astimezone(LOCAL_tzone).strftime('%Y-%m-%d %H:%M:%S'),
+        'incomeRows': incomeRows,
+        'incomeTotal': formatDollars(totalIncome),
+        'expenseRows': expenseRows,
+        'cash': formatDollars(cashAmount),
+        'check': formatDollars(checkAmount),
+        'cashCheckTotal': formatDollars(cashAmount+checkAmount),
+        'creditCard': formatDollars(ccAmount),
+        'creditCardFees': formatDollars(processingFees),
+        'creditCardNet': formatDollars(ccNetAmount)}
+
+ROLLUP_PERIODS = ('week', 'month', 'fiscal_year')
+ALL_LOCATIONS_ID = 'ALL'
+
+def rollupPeriodForDate(periodType, day):
+    # Returns the first and last date of the week (starting Monday), month, or fiscal year that contains day
+    if periodType == 'week':
+        periodStart = day - timedelta(days=day.weekday())
+        return periodStart, periodStart + timedelta(days=6)
+    elif periodType == 'month':
+        periodStart = day.replace(day=1)
+        nextMonth = (periodStart + timedelta(days=32)).replace(day=1)
+        return periodStart, nextMonth - timedelta(days=1)
+    elif periodType == 'fiscal_year':
+        startMonth = msmSquareConfig.get('fiscalYearStartMonth', 1)
+        startYear = day.year if day.month >= startMonth else day.year - 1
+        periodStart = date(startYear, startMonth, 1)
+        return periodStart, date(startYear + 1, startMonth, 1) - timedelta(days=1)
+    raise Exception('Unknown rollup period: {}'.format(periodType))
+
+def rollupPeriodLabel(periodType, periodStart, periodEnd):
+    # Human readable name of a rollup period, fiscal years are named for the year they end in
+    if periodType == 'week':
+        return 'Week of ' + periodStart.strftime('%A %B %-d, %Y')
+    elif periodType == 'month':
+        return periodStart.strftime('%B %Y')
+    return 'Fiscal Year ' + str(periodEnd.year)
+
+def dailyReportTimesForDates(beginDate, endDate):
+    # Returns the first and last DailyReport.reportStartDate for the business days from beginDate to endDate
+    LOCAL_tzone = tz.gettz(msmSquareConfig['localTimezone'])
+    newDayTime = time(3,0,0,tzinfo=LOCAL_tzone)
+    return datetime.combine(beginDate, newDayTime), datetime.combine(endDate, newDayTime)
+
+def saveReportRollupInDB(periodType, periodStart, periodEnd, locationID, locationName, summary, db_session, headers):
+    # Takes in the FinancialSummary of a period, if a rollup for the period and location exists in the database it is updated, if not it is added
+    try:
+        rollupInDB = db_session.query(ReportRollup).filter(ReportRollup.period_type == periodType, ReportRollup.period_start == periodStart, ReportRollup.location_id == locationID).one()
+    except NoResultFound:
+        if not summary.transactions:
+            return
+        rollupInDB = ReportRollup(period_type=periodType, period_start=periodStart, location_id=locationID)
+        db_session.add(rollupInDB)
+    except MultipleResultsFound:
+        raise Exception('Multiple Report Rollups Found in Database for {} starting {} at Location {}'.format(periodType, periodStart, locationID))
+    rollupInDB.period_end = periodEnd
+    rollupInDB.location_name = locationName
+    rollupInDB.reportCreationDate = datetime.now(timezone.utc)
+    rollupInDB.data = summary.toDict()
+    db_session.commit()
+    return
+
+def iterDailyReportsForMonthsWithoutRollups(firstMonthStart, lastMonthEnd, db_session, locationID=None):
+    # Yield the daily reports of every month between two dates that has daily reports but no month rollup for its location,
+    # for one location or all of them, so totals built from month rollups do not leave out months from before rollups were kept
+    beginTime, endTime = dailyReportTimesForDates(firstMonthStart, lastMonthEnd)
+    monthsInDB = db_session.execute(text("""SELECT DISTINCT d.location_id, date_trunc('month', d."reportStartDate" AT TIME ZONE :localTimezone)::date AS month_start
+        FROM "dailyReports" d
+        WHERE d."reportStartDate" BETWEEN :beginTime AND :endTime AND (CAST(:locationID AS varchar) IS NULL OR d.location_id = :locationID)
+            AND NOT EXISTS (SELECT 1 FROM "reportRollups" r WHERE r.period_type = 'month' AND r.location_id = d.location_id
+                AND r.period_start = date_trunc('month', d."reportStartDate" AT TIME ZONE :localTimezone)::date)
+        ORDER BY d.location_id, month_start"""),
+        {'beginTime': beginTime, 'endTime': endTime, 'locationID': locationID, 'localTimezone': msmSquareConfig['localTimezone']}).all()
+    if monthsInDB:
+        logging.info('Reading %s location-months without a month rollup from the daily reports', len(monthsInDB))
+    for month in monthsInDB:
+        monthBeginTime, monthEndTime = dailyReportTimesForDates(*rollupPeriodForDate('month', month.month_start))
+        reportsInDB = db_session.query(DailyReport.location_id, DailyReport.location_name, DailyReport.reportCreationDate, DailyReport.data).filter(DailyReport.location_id == month.location_id, DailyReport.reportStartDate.between(monthBeginTime, monthEndTime)).all()
+        for report in reportsInDB:
+            yield report
+
+def refreshReportRollups(days, locationID, db_session, headers):
+    # Recalculate the week, month, and fiscal year rollups for a location and for all locations combined that contain any of the passed days
+    # Weeks and months are summed from the daily reports, fiscal years from the month rollups (and the daily reports of months that have none),
+    # and all locations from the per location rollups
+    location = getLocationByID(locationID, db_session, headers)
+    periods = []
+    for periodType in ROLLUP_PERIODS:
+        for periodStart, periodEnd in sorted(set(rollupPeriodForDate(periodType, day) for day in days)):
+            periods.append((periodType, periodStart, periodEnd))
+    for periodType, periodStart, periodEnd in periods:
+        summary = FinancialSummary()
+        if periodType == 'fiscal_year':
+            rollupsInDB = db_session.query(ReportRollup.data).filter(ReportRollup.period_type == 'month', ReportRollup.location_id == locationID, ReportRollup.period_start.between(periodStart, periodEnd)).all()
+            for rollup in rollupsInDB:
+                summary.merge(FinancialSummary.fromDict(rollup.data))
+            for report in iterDailyReportsForMonthsWithoutRollups(periodStart, periodEnd, db_session, locationID):
+                summary.merge(FinancialSummary.fromDict(report.data))
+        else:
+            beginTime, endTime = dailyReportTimesForDates(periodStart, periodEnd)
+            reportsInDB = db_session.query(DailyReport.data).filter(DailyReport.location_id == locationID, DailyReport.reportStartDate.between(beginTime, endTime)).all()
+            for report in reportsInDB:
+                summary.merge(FinancialSummary.fromDict(report.data))
+        saveReportRollupInDB(periodType, periodStart, periodEnd, locationID, location['name'], summary, db_session, headers)
+        # Combine every location's rollup for the same period
+        allLocations = FinancialSummary()
+        rollupsInDB = db_session.query(ReportRollup.data).filter(ReportRollup.period_type == periodType, ReportRollup.period_start == periodStart, ReportRollup.location_id != ALL_LOCATIONS_ID).all()
+        for rollup in rollupsInDB:
+            allLocations.merge(FinancialSummary.fromDict(rollup.data))
+        saveReportRollupInDB(periodType, periodStart, periodEnd, ALL_LOCATIONS_ID, 'All Locations', allLocations, db_session, headers)
+    return
+
+def getReportDataForPeriodsFromDB(beginDate,endDate, periodType, db_session, headers):
+    # Get the week, month, or fiscal year rollups that overlap a date range for each location and all locations combined
+    reportData = []
+    rollupsInDB = db_session.query(ReportRollup).filter(ReportRollup.period_type == periodType, ReportRollup.period_start <= endDate, ReportRollup.period_end >= beginDate).order_by(ReportRollup.location_id == ALL_LOCATIONS_ID, ReportRollup.location_name, ReportRollup.period_start).all()
+    for rollup in rollupsInDB:
+        reportData.append({'location':rollup.location_name, 'date': rollupPeriodLabel(periodType, rollup.period_start, rollup.period_end), 'created': rollup.reportCreationDate, 'data': rollup.data})
+    return reportData
+
+def getRangeSummaryFromDB(beginDate,endDate, db_session, headers):
+    # Get one summary per location, and one for all locations combined, covering a date range
+    # Whole months inside the range are read from the month rollups, the days before and after them, and any month a location has no rollup for,
+    # from the daily reports. All locations is totalled here from the per location figures so it includes those months too
+    summaries = {} # (location ID, location name) -> [latest creation date, FinancialSummary]
+    def addReport(key, created, data):
+        entry = summaries.setdefault(key, [created, FinancialSummary()])
+        entry[0] = max(entry[0], created)
+        entry[1].merge(FinancialSummary.fromDict(data))
+    firstMonthStart = beginDate if beginDate.day == 1 else rollupPeriodForDate('month', beginDate)[1] + timedelta(days=1)
+    lastMonthEnd = rollupPeriodForDate('month', endDate)[1]
+    if lastMonthEnd != endDate:
+        lastMonthEnd = endDate.replace(day=1) - timedelta(days=1)
+    dailyRanges = []
+    if firstMonthStart <= lastMonthEnd:
+        rollupsInDB = db_session.query(ReportRollup.location_id, ReportRollup.location_name, ReportRollup.reportCreationDate, ReportRollup.data).filter(ReportRollup.period_type == 'month', ReportRollup.period_start.between(firstMonthStart, lastMonthEnd), ReportRollup.location_id != ALL_LOCATIONS_ID).yield_per(YIELD_PER)
+        for rollup in rollupsInDB:
+            addReport((rollup.location_id, rollup.location_name), rollup.reportCreationDate, rollup.data)
+            addReport((ALL_LOCATIONS_ID, 'All Locations'), rollup.reportCreationDate, rollup.data)
+        for report in iterDailyReportsForMonthsWithoutRollups(firstMonthStart, lastMonthEnd, db_session):
+            addReport((report.location_id, report.location_name), report.reportCreationDate, report.data)
+            addReport((ALL_LOCATIONS_ID, 'All Locations'), report.reportCreationDate, report.data)
+        if beginDate < firstMonthStart:
+            dailyRanges.append((beginDate, firstMonthStart - timedelta(days=1)))
+        if lastMonthEnd < endDate:
+            dailyRanges.append((lastMonthEnd + timedelta(days=1), endDate))
+    else:
+        dailyRanges.append((beginDate, endDate))
+    for rangeBegin, rangeEnd in dailyRanges:
+        beginTime, endTime = dailyReportTimesForDates(rangeBegin, rangeEnd)
+        reportsInDB = db_session.query(DailyReport.location_id, DailyReport.location_name, DailyReport.reportCreationDate, DailyReport.data).filter(DailyReport.reportStartDate.between(beginTime, endTime)).yield_per(YIELD_PER)
+        for report in reportsInDB:
+            addReport((report.location_id, report.location_name), report.reportCreationDate, report.data)
+            addReport((ALL_LOCATIONS_ID, 'All Locations'), report.reportCreationDate, report.data)
+    spelledRange = beginDate.strftime('%B %-d, %Y') + ' - ' + endDate.strftime('%B %-d, %Y')
+    reportData = []
+    for (locationID, locationName), (created, summary) in sorted(summaries.items(), key=lambda entry: (entry[0][0] == ALL_LOCATIONS_ID, entry[0][1])):
+        reportData.append({'location':locationName, 'date': spelledRange, 'created': created, 'data': summary.toDict()})
+    return reportData
@@ -0,0 +1,222 @@
+#! /usr/bin/python3
+# Vectorized analytics over the local Square database for long date ranges
+# Line items, payments, and refunds for a range are streamed from Postgres with a server side cursor into pandas DataFrames
+# and classified with the same compiled classificationRules as the daily reports, so totals reconcile with the reports
+import logging
+import msmsquare
+import argparse
+import numpy
+import pandas
+from pprint import pprint
+from datetime import datetime, timedelta, date, time, timezone
+from dateutil import tz
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine
+
+# Rows fetched from the server side cursor at a time
+CHUNK_SIZE = 10000
+
+# One row per sold or returned line item, amounts are in cents and negative for returns
+# Sold items are counted once per (non failed) payment of their order, the same as the daily reports
+LINE_ITEMS_SQL = """
+WITH sale_items AS (
+    SELECT p.location_id, p.created_at, FALSE AS is_refund, li.item
+    FROM payments p JOIN orders o ON o.order_id = p.order_id
+        CROSS JOIN LATERAL jsonb_array_elements(o.data->'line_items') AS li(item)
+    WHERE p.created_at >= :beginTime AND p.created_at < :endTime AND (:locationID IS NULL OR p.location_id = :locationID)
+        AND p.status NOT IN ('FAILED', 'CANCELED')
+), refund_items AS (
+    SELECT r.location_id, r.created_at, TRUE AS is_refund, rli.item
+    FROM refunds r JOIN orders o ON o.order_id = r.order_id
+        CROSS JOIN LATERAL jsonb_array_elements(COALESCE(o.data->'returns', '[]'::jsonb)) AS ret(ireturn)
+        CROSS JOIN LATERAL jsonb_array_elements(ret.ireturn->'return_line_items') AS rli(item)
+    WHERE r.created_at >= :beginTime AND r.created_at < :endTime AND (:locationID IS NULL OR r.location_id = :locationID)
+)
+SELECT li.location_id, li.created_at AT TIME ZONE :localTimezone AS local_time, li.is_refund,
+    li.item->>'name' AS name, li.item->>'variation_name' AS variation_name, li.item->>'catalog_object_id' AS catalog_object_id,
+    li.item->>'item_type' AS item_type, (li.item->>'quantity')::numeric AS quantity,
+    (li.item->'total_money'->>'amount')::bigint AS amount, (li.item->'total_tax_money'->>'amount')::bigint AS tax,
+    cat.data->'category_data'->>'name' AS category_name
+FROM (SELECT * FROM sale_items UNION ALL SELECT * FROM refund_items) li
+    LEFT JOIN catalog obj ON obj.catalog_id = li.item->>'catalog_object_id'
+    LEFT JOIN catalog itm ON itm.catalog_id = CASE WHEN obj.data->>'type' = 'ITEM_VARIATION' THEN obj.data->'item_variation_data'->>'item_id' ELSE obj.catalog_id END
+    LEFT JOIN catalog cat ON cat.catalog_id = itm.data->'item_data'->>'category_id'
+"""
+
+LINE_ITEM_COLUMNS = ['location_id', 'local_time', 'is_refund', 'name', 'variation_name', 'catalog_object_id', 'item_type', 'quantity', 'amount', 'tax', 'category_name']
+
+PAYMENTS_SQL = """
+SELECT p.payment_id, p.location_id, p.created_at AT TIME ZONE :localTimezone AS local_time,
+    CASE WHEN p.source_type <> 'EXTERNAL' THEN p.source_type
+        WHEN p.external_type = 'CHECK' THEN 'CHECK' END AS tender,
+    p.amount, p.fee_total AS fees
+FROM payments p
+WHERE p.created_at >= :beginTime AND p.created_at < :endTime AND (:locationID IS NULL OR p.location_id = :locationID)
+    AND p.status NOT IN ('FAILED', 'CANCELED')
+"""
+
+PAYMENT_COLUMNS = ['payment_id', 'location_id', 'local_time', 'tender', 'amount', 'fees']
+
+REFUNDS_SQL = """
+SELECT r.refund_id, r.location_id, r.created_at AT TIME ZONE :localTimezone AS local_time, r.destination_type AS tender,
+    0 - r.amount AS amount, r.fee_total AS fees
+FROM refunds r
+WHERE r.created_at >= :beginTime AND r.created_at < :endTime AND (:locationID IS NULL OR r.location_id = :locationID)
+"""
+
+REFUND_COLUMNS = ['refund_id', 'location_id', 'local_time', 'tender', 'amount', 'fees']
+
+def streamFrame(sql, columns, beginTime, endTime, db_session, locationID=None):
+    # Run one of the queries above with a server side cursor and build a DataFrame a chunk at a time
+    # The execution options are passed with each query, on the session's connection they only apply if it is the session's first query
+    params = {'beginTime': beginTime, 'endTime': endTime, 'locationID': locationID, 'localTimezone': msmsquare.msmSquareConfig['localTimezone']}
+    result = db_session.execute(text(sql), params, execution_options={'stream_results': True, 'yield_per': CHUNK_SIZE})
+    frames = []
+    for rows in result.partitions():
+        frames.append(pandas.DataFrame.from_records(rows, columns=columns))
+    result.close()
+    if frames:
+        frame = pandas.concat(frames, ignore_index=True)
+    else:
+        frame = pandas.DataFrame(columns=columns)
+    # Business days start at 3am local time
+    frame['local_time'] = pandas.to_datetime(frame['local_time'])
+    frame['business_day'] = (frame['local_time'] - pandas.Timedelta(hours=3)).dt.normalize()
+    return frame
+
+def loadLineItems(beginTime, endTime, db_session, locationID=None):
+    # Load and classify every sold and returned line item between two times, for one location or all of them
+    lineItems = streamFrame(LINE_ITEMS_SQL, LINE_ITEM_COLUMNS, beginTime, endTime, db_session, locationID)
+    lineItems['quantity'] = lineItems['quantity'].astype(float)
+    sign = numpy.where(lineItems['is_refund'].astype(bool), -1, 1)
+    lineItems['amount'] = lineItems['amount'].astype('int64') * sign
+    lineItems['tax'] = lineItems['tax'].astype('int64') * sign
+    return classifyLineItems(lineItems)
+
+def loadPayments(beginTime, endTime, db_session, locationID=None):
+    # Load every successful payment between two times with its tender type and processing fees (as negative amounts)
+    payments = streamFrame(PAYMENTS_SQL, PAYMENT_COLUMNS, beginTime, endTime, db_session, locationID)
+    payments['fees'] = 0 - payments['fees'].astype('int64')
+    return payments
+
+def loadRefunds(beginTime, endTime, db_session, locationID=None):
+    # Load every refund between two times with its tender type, refunded amounts are negative
+    return streamFrame(REFUNDS_SQL, REFUND_COLUMNS, beginTime, endTime, db_session, locationID)
+
+def classifyLineItems(lineItems):
+    # Add bucket and event columns to a line item DataFrame using msmsquare.classificationRules
+    # This is the vectorized equivalent of msmsquare.classifyLineItem, items that are not counted get an empty bucket
+    rules = msmsquare.classificationRules
+    itemRules = pandas.DataFrame([(location, name, bucket) for location, names in rules.locationItemRules.items() for name, bucket in names.items()],
+        columns=['location_id', 'name', 'bucket'], dtype=object)
+    locationItemBucket = lineItems[['location_id', 'name']].merge(itemRules, how='left', on=['location_id', 'name'])['bucket']
+    locationItemBucket.index = lineItems.index
+    locationBucket = locationItemBucket.fillna(lineItems['location_id'].map(rules.locationRules))
+    categoryBucket = lineItems['category_name'].str.lower().map(rules.categoryRules)
+    noCatalogObject = lineItems['catalog_object_id'].isna()
+    lineItems['bucket'] = numpy.select(
+        [locationBucket.notna(),
+            noCatalogObject & (lineItems['is_refund'].astype(bool) | (lineItems['item_type'] == 'CUSTOM_AMOUNT')),
+            noCatalogObject,
+            lineItems['category_name'].isna(),
+            categoryBucket.notna(),
+            lineItems['tax'] == 0],
+        [locationBucket, 'uncategorized', '', 'uncategorized', categoryBucket, rules.nontaxableBucket],
+        default=rules.taxableBucket)
+    # Special events are totalled by item name, returned catalog items use the variation name when there is one
+    # An event item with no name gets a missing event like the None from classifyLineItem, the totals keep it with dropna=False
+    useVariation = lineItems['is_refund'].astype(bool) & locationBucket.isna() & lineItems['variation_name'].fillna('').ne('')
+    lineItems['event'] = numpy.where(lineItems['bucket'] == 'special_event', numpy.where(useVariation, lineItems['variation_name'], lineItems['name']), '')
+    return lineItems
+
+def salesByBucket(lineItems, period='business_day'):
+    # Total the line items by report income class, period is business_day or a pandas period alias such as M or Y
+    return totalBy(lineItems[lineItems['bucket'] != ''], 'bucket', period)
+
+def salesByCategory(lineItems, period='business_day'):
+    # Total the line items by catalog category
+    return totalBy(lineItems.assign(category_name=lineItems['category_name'].fillna('Uncategorized')), 'category_name', period)
+
+def salesByItem(lineItems, period='business_day'):
+    # Total the line items by item name
+    return totalBy(lineItems.assign(name=lineItems['name'].fillna('Custom Amount')), 'name', period)
+
+def salesByHour(lineItems):
+    # Total the line items by local hour of the day
+    return lineItems.groupby(lineItems['local_time'].dt.hour)[['quantity', 'amount']].sum()
+
+def totalBy(lineItems, column, period='business_day'):
+    # Group line items by period and column and sum quantities and amounts
+    if period == 'business_day':
+        periods = lineItems['business_day']
+    else:
+        periods = lineItems['business_day'].dt.to_period(period)
+    return lineItems.groupby([periods, lineItems[column]], dropna=False)[['quantity', 'amount']].sum()
+
+def yearOverYear(beginDate, endDate, years, db_session, column='bucket', locationID=None):
+    # Compare totals by column for the same date range over several years, one column of totals per year
+    LOCAL_tzone = tz.gettz(msmsquare.msmSquareConfig['localTimezone'])
+    newDayTime = time(3,0,0,tzinfo=LOCAL_tzone)
+    totals = {}
+    for yearsBack in range(years):
+        # DateOffset moves Feb 29 to Feb 28 in years that do not have one
+        rangeBegin = (pandas.Timestamp(beginDate) - pandas.DateOffset(years=yearsBack)).date()
+        rangeEnd = (pandas.Timestamp(endDate) - pandas.DateOffset(years=yearsBack)).date()
+        lineItems = loadLineItems(datetime.combine(rangeBegin, newDayTime), datetime.combine(rangeEnd + timedelta(days=1), newDayTime), db_session, locationID)
+        if column == 'bucket':
+            lineItems = lineItems[lineItems['bucket'] != '']
+        totals[rangeBegin.year] = lineItems.groupby(column, dropna=False)['amount'].sum()
+    return pandas.DataFrame(totals).fillna(0).astype('int64') / 100
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b","--startdate", help="Start Date YYYY-MM-DD", type=str, required=True)
+    parser.add_argument("-e","--stopdate", help="Stop Date YYYY-MM-DD", type=str, required=True)
+    parser.add_argument("-l","--locationid", help="Location ID, all locations if not given", type=str)
+    parser.add_argument("-g","--groupby", help="bucket, category_name, name, or hour", type=str, default='bucket')
+    parser.add_argument("-p","--period", help="business_day or a pandas period alias such as M or Y", type=str, default='M')
+    parser.add_argument("-y","--years", help="Compare the same dates over this many years", type=int)
+    parser.add_argument("-o","--output", help="Write the result to this CSV file", type=str)
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    msmSquareConfig = msmsquare.msmSquareConfig
+
+    # Timezone stuff
+    LOCAL_tzone = tz.gettz(msmSquareConfig['localTimezone'])
+
+    #connect to the squareData cache database, setup SQLAlchemy stuff
+    db_string = msmSquareConfig['postgresConnection']
+    db = create_engine(db_string, connect_args={'sslmode':'disable'})
+    Session = sessionmaker(db)  # Create a session class associated with the database engine
+
+    db_session = Session() # create a working database session for version 2
+
+    beginDate = datetime.strptime(arguments.startdate, "%Y-%m-%d").date()
+    endDate = datetime.strptime(arguments.stopdate, "%Y-%m-%d").date()
+
+    if arguments.years:
+        result = yearOverYear(beginDate, endDate, arguments.years, db_session, arguments.groupby, arguments.locationid)
+    else:
+        newDayTime = time(3,0,0,tzinfo=LOCAL_tzone)
+        lineItems = loadLineItems(datetime.combine(beginDate, newDayTime), datetime.combine(endDate + timedelta(days=1), newDayTime), db_session, arguments.locationid)
+        logging.info('Loaded %s line items', len(lineItems))
+        if arguments.groupby == 'hour':
+            result = salesByHour(lineItems)
+        elif arguments.groupby == 'bucket':
+            result = salesByBucket(lineItems, arguments.period)
+        else:
+            result = totalBy(lineItems, arguments.groupby, arguments.period)
+
+    if arguments.output:
+        result.to_csv(arguments.output)
+    else:
+        pprint(result)
+
+    return
+
+if __name__ == "__main__":
+    main()
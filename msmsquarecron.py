@@ -5,7 +5,7 @@ from collections import Counter
 from pprint import pprint
 from datetime import datetime, timedelta, date, time, timezone
 from dateutil import tz
-import yaml
+import msmconfig
 from sqlalchemy import desc
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy import create_engine
@@ -14,14 +14,7 @@ def main():
     logging.basicConfig(level=logging.INFO)
     
     # Load configuration
-    try:
-        with open("config-msmsquare.yaml", 'r') as stream:
-            try:
-                msmSquareConfig=yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                print(exc)
-    except IOError:
-        print("Could not read config-msmsquare.yaml file")
+    msmSquareConfig = msmconfig.loadConfig('msmsquare')
 
     applicationID = msmSquareConfig['squareApplicationID']
     accessToken = msmSquareConfig['squareApplicationAccessToken']
@@ -35,28 +28,47 @@ def main():
     #connect to the squareData cache database, setup SQLAlchemy stuff
     db_string = msmSquareConfig['postgresConnection']
     db = create_engine(db_string, connect_args={'sslmode':'disable'})
+    msmsquare.initDB(db)  # Create any new tables
     Session = sessionmaker(db)  # Create a session class associated with the database engine
 
     db_session = Session() # create a working database session for version 2
 
+    msmsquare.startSyncLedger('cron', db)
+    try:
+        runCron(db_session, headers)
+    except:
+        msmsquare.finishSyncLedger('failed')
+        raise
+    msmsquare.finishSyncLedger()
+
+    return
+
+def runCron(db_session, headers):
     logging.info('Starting Cron DB Load')
 
     #Get all of the location IDs from square into the database api v2
     logging.info('Getting Locations')
-    locations = msmsquare.getLocationsFromSquare(db_session,headers)
+    with msmsquare.syncStage('locations'), msmsquare.advisoryLock('locations', db_session, mode='wait'):
+        locations = msmsquare.getLocationsFromSquare(db_session,headers)
 
     #Get all of the catalog objects from square into the database api v2
     logging.info('Getting Catalog Objects')
-    msmsquare.getCatalogFromSquare(db_session, headers)
+    with msmsquare.syncStage('catalog'), msmsquare.advisoryLock('catalog', db_session) as acquired:
+        if acquired:
+            count = sum(1 for _ in msmsquare.iterCatalogFromSquare(db_session, headers))
+            logging.info('Loaded %s catalog objects', count)
+    msmsquare.logIngestMemory(db_session, 'Catalog Objects')
 
     getNewSquareData(db_session, headers, locations)
 
+    msmsquare.logIngestMemory(db_session, 'Cron DB Load')
     logging.info('Cron DB Load Complete')
 
     logging.info('Generating Report Data')
 
     generateReports(db_session, headers, locations)
 
+    msmsquare.logIngestMemory(db_session, 'Report Generation')
     logging.info('Done Generating Report Data')
 
     return
@@ -71,7 +83,10 @@ def generateReports(db_session, headers, locations):
 
     for location in locations:
         #do for each location
-        msmsquare.generateReportDataForDates(beginTime,endTime, location['id'],db_session, headers)
+        with msmsquare.syncStage('reports '+location['id']), msmsquare.advisoryLock('reports '+location['id'], db_session) as acquired:
+            if acquired:
+                msmsquare.generateReportDataForDates(beginTime,endTime, location['id'],db_session, headers)
+        msmsquare.endIngestBatch(db_session)
 
     return
 
@@ -85,15 +100,19 @@ def getNewSquareData(db_session, headers, locations):
 
     #Get all of the payments from square into the database api v2
     loadPayments(locations, db_session, headers, beginTime, endTime)
+    msmsquare.logIngestMemory(db_session, 'Payments')
 
     #Get all of the orders from square into the database api v2
     loadOrders(locations, db_session, headers, beginTime, endTime)
+    msmsquare.logIngestMemory(db_session, 'Orders')
 
     #Get all of the refunds from square into the database api v2
     loadRefunds(locations, db_session, headers, beginTime, endTime)
+    msmsquare.logIngestMemory(db_session, 'Refunds')
 
     #Get all of the payouts and payout entries from square into the database api v2
     loadPayoutEntries(locations, db_session, headers, beginTime, endTime)
+    msmsquare.logIngestMemory(db_session, 'Payouts and Payout Entries')
 
     return
 
@@ -103,7 +122,10 @@ def loadPayments(locations, db_session, headers, beginTimeDT, endTimeDT):
     for location in locations:
         endTime=endTimeDT.strftime('%Y-%m-%dT%H:%M:%SZ')
         beginTime=beginTimeDT.strftime('%Y-%m-%dT%H:%M:%SZ')
-        payments = msmsquare.getPaymentsByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers)
+        with msmsquare.syncStage('payments '+location['id']), msmsquare.advisoryLock('payments '+location['id'], db_session) as acquired:
+            if acquired:
+                count = sum(1 for _ in msmsquare.iterPaymentsByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers))
+                logging.info('Loaded %s payments for %s', count, location['id'])
     return
 
 def loadRefunds(locations, db_session, headers, beginTimeDT, endTimeDT):
@@ -112,7 +134,10 @@ def loadRefunds(locations, db_session, headers, beginTimeDT, endTimeDT):
     for location in locations:
         endTime=endTimeDT.strftime('%Y-%m-%dT%H:%M:%SZ')
         beginTime=beginTimeDT.strftime('%Y-%m-%dT%H:%M:%SZ')
-        msmsquare.getRefundsByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers)
+        with msmsquare.syncStage('refunds '+location['id']), msmsquare.advisoryLock('refunds '+location['id'], db_session) as acquired:
+            if acquired:
+                count = sum(1 for _ in msmsquare.iterRefundsByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers))
+                logging.info('Loaded %s refunds for %s', count, location['id'])
     return
 
 def loadPayoutEntries(locations, db_session, headers, beginTimeDT, endTimeDT):
@@ -121,7 +146,10 @@ def loadPayoutEntries(locations, db_session, headers, beginTimeDT, endTimeDT):
     for location in locations:
         endTime=endTimeDT.strftime('%Y-%m-%dT%H:%M:%SZ')
         beginTime=beginTimeDT.strftime('%Y-%m-%dT%H:%M:%SZ')
-        msmsquare.getPayoutEntriesByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers)
+        with msmsquare.syncStage('payoutEntries '+location['id']), msmsquare.advisoryLock('payoutEntries '+location['id'], db_session) as acquired:
+            if acquired:
+                count = sum(1 for _ in msmsquare.iterPayoutEntriesByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers))
+                logging.info('Loaded %s payout entries for %s', count, location['id'])
     return
 
 def loadOrders(locations, db_session, headers, beginTimeDT, endTimeDT):
@@ -130,7 +158,10 @@ def loadOrders(locations, db_session, headers, beginTimeDT, endTimeDT):
     for location in locations:
         endTime=endTimeDT.strftime('%Y-%m-%dT%H:%M:%SZ')
         beginTime=beginTimeDT.strftime('%Y-%m-%dT%H:%M:%SZ')
-        msmsquare.getOrdersByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers)
+        with msmsquare.syncStage('orders '+location['id']), msmsquare.advisoryLock('orders '+location['id'], db_session) as acquired:
+            if acquired:
+                count = sum(1 for _ in msmsquare.iterOrdersByDateRangeFromSquare(beginTime, endTime, location['id'], db_session, headers))
+                logging.info('Loaded %s orders for %s', count, location['id'])
     return
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+#! /usr/bin/python3
+# Renders the reports queued by /square/reports?pdf&async in the background so long reports do not tie up (or get harakiri'd in) the web workers
+# Any number of these can run, each job is claimed by exactly one of them
+import logging
+import msmsquare
+import msmsquareweb
+from datetime import datetime, timedelta, timezone
+from time import sleep
+import traceback
+from flask import Flask
+from sqlalchemy import text
+
+import msmconfig
+
+logging.basicConfig(level=logging.INFO)
+
+# Load configuration
+msmSquareConfig = msmconfig.loadConfig('msmsquare')
+
+# Seconds to wait between looking for new jobs when the queue is empty
+pollInterval = msmSquareConfig.get('reportJobPollSeconds', 2)
+# Jobs left running this long were being rendered by a worker that died, they are queued again
+# This has to be longer than the longest report takes to render or a job that is still rendering gets claimed a second time
+staleAfter = timedelta(seconds = msmSquareConfig.get('reportJobStaleSeconds', 1800))
+# A job whose worker died this many times is marked failed instead of being queued again, so a report that kills its worker is not retried forever
+maxAttempts = msmSquareConfig.get('reportJobMaxAttempts', 3)
+# Finished jobs and their reports are deleted after this long
+keepFor = timedelta(days = msmSquareConfig.get('reportJobKeepDays', 7))
+
+# The report template is rendered with Flask's render_template, which needs an app context but nothing else from passport
+app = Flask(__name__)
+
+def claimReportJob(db_session):
+    # Take the oldest queued job, SKIP LOCKED lets several workers claim jobs at the same time without waiting on each other
+    # Returns the job, or None if the queue is empty
+    claimed = db_session.execute(text("""UPDATE "reportJobs" SET status = 'running', started_at = now(), attempts = attempts + 1
+        WHERE id = (SELECT id FROM "reportJobs" WHERE status = 'queued' ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED)
+        RETURNING id""")).scalar()
+    db_session.commit()
+    if claimed is None:
+        return None
+    return db_session.get(msmsquare.ReportJob, claimed)
+
+def runReportJob(job, db_session):
+    logging.info('Rendering report job %s for %s', job.job_id, job.requested_by)
+    try:
+        with app.app_context():
+            result = msmsquareweb.renderReport(job.args, db_session, pdfWorkers=msmsquareweb.reportPDFWorkers)
+        if isinstance(result, str):
+            result = result.encode('utf-8')
+        job.result = result
+        job.status = 'done'
+    except Exception:
+        db_session.rollback()
+        logging.exception('Report job %s failed', job.job_id)
+        job.status = 'failed'
+        job.error = traceback.format_exc(limit=5)
+    job.finished_at = datetime.now(timezone.utc)
+    db_session.commit()
+    return
+
+def cleanReportJobs(db_session):
+    # Queue again the jobs of workers that died while rendering unless they have used up their attempts, and delete old finished jobs
+    now = datetime.now(timezone.utc)
+    stale = db_session.query(msmsquare.ReportJob).filter(msmsquare.ReportJob.status == 'running', msmsquare.ReportJob.started_at < now - staleAfter)
+    failed = stale.filter(msmsquare.ReportJob.attempts >= maxAttempts).update({'status': 'failed', 'finished_at': now,
+        'error': 'The report was not finished after {} attempts, the worker rendering it stopped or took longer than {} seconds'.format(maxAttempts, int(staleAfter.total_seconds()))},
+        synchronize_session=False)
+    requeued = stale.filter(msmsquare.ReportJob.attempts < maxAttempts).update({'status': 'queued', 'started_at': None}, synchronize_session=False)
+    deleted = db_session.query(msmsquare.ReportJob).filter(msmsquare.ReportJob.status.in_(['done', 'failed']), msmsquare.ReportJob.finished_at < datetime.now(timezone.utc) - keepFor).delete()
+    db_session.commit()
+    if failed:
+        logging.warning('Failed %s stale report jobs after %s attempts', failed, maxAttempts)
+    if requeued or deleted:
+        logging.info('Queued %s stale report jobs again, deleted %s old report jobs', requeued, deleted)
+    return
+
+def main():
+    db_session = msmsquareweb.getSession()
+    msmsquare.initDB(db_session.get_bind())  # Create any new tables
+    logging.info('Report worker started')
+    lastClean = None
+    while True:
+        if lastClean is None or datetime.now(timezone.utc) - lastClean > timedelta(minutes = 10):
+            cleanReportJobs(db_session)
+            lastClean = datetime.now(timezone.utc)
+        job = claimReportJob(db_session)
+        if job is None:
+            # Let go of the connection while idle
+            db_session.close()
+            sleep(pollInterval)
+            continue
+        runReportJob(job, db_session)
+        # Do not keep the rendered report in memory
+        db_session.expunge_all()
+
+if __name__ == "__main__":
+    main()
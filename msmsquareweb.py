@@ -1,28 +1,31 @@
 #! /usr/bin/python3
 import logging
+import os
+import uuid
+import threading
+import json
+import csv
+import hashlib
+import tempfile
 import msmsquare
-from collections import Counter
 from pprint import pprint
 from datetime import datetime, timedelta, date, time, timezone
 from dateutil import tz
-import weasyprint
-from flask import render_template
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from flask import render_template, stream_template, stream_with_context, Response
+from markupsafe import Markup
+from collections import Counter, OrderedDict
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy import create_engine
 
-import yaml
+import msmconfig
 
 logging.basicConfig(level=logging.INFO)
 
 # Load configuration
-try:
-    with open("config-msmsquare.yaml", 'r') as stream:
-        try:
-            msmSquareConfig=yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-except IOError:
-    print("Could not read config-msmsquare.yaml file")
+msmSquareConfig = msmconfig.loadConfig('msmsquare')
 
 applicationID = msmSquareConfig['squareApplicationID']
 accessToken = msmSquareConfig['squareApplicationAccessToken']
@@ -64,44 +67,325 @@ reportData = [{'location': 'CHSL',
                 'tax_collected': 1300,
                 'tenders': {'CASH': 7676, 'CREDIT_CARD': 265, 'NO_SALE': 0, 'OTHER': 322}}}]
 
+# The squareData cache database engine and session class for this process, created on first use by getSession
+# uWSGI loads the app in the master and forks the workers, a pool inherited across a fork would share sockets between processes,
+# so the engine is tied to the pid that created it and a forked worker makes its own
+engine = None
+Session = None
+enginePID = None
+engineLock = threading.Lock()
+
+def getSession():
+    # Returns a new session from this worker's pooled engine, the caller must close it
+    global engine, Session, enginePID
+    with engineLock:
+        if engine is None or enginePID != os.getpid():
+            if engine is not None:
+                # Inherited from the parent process, drop the parent's connections without closing them under it
+                engine.dispose(close=False)
+            #connect to the squareData cache database, setup SQLAlchemy stuff
+            db_string = msmSquareConfig['postgresConnection']
+            engine = create_engine(db_string, connect_args={'sslmode':'disable'},
+                pool_size=msmSquareConfig.get('webPoolSize', 2),
+                max_overflow=msmSquareConfig.get('webPoolMaxOverflow', 3),
+                pool_pre_ping=True,
+                pool_recycle=msmSquareConfig.get('webPoolRecycle', 1800))
+            Session = sessionmaker(engine)  # Create a session class associated with the database engine
+            enginePID = os.getpid()
+    return Session()
+
 def getReport(request):
-    #connect to the squareData cache database, setup SQLAlchemy stuff
-    db_string = msmSquareConfig['postgresConnection']
-    db = create_engine(db_string, connect_args={'sslmode':'disable'})  
-    Session = sessionmaker(db)  # Create a session class associated with the database engine
+    # create a working database session for version 2, returned to the pool when the report is done
+    with getSession() as db_session:
+        return renderReport(request.args, db_session)
+
+def enqueueReportJob(request, user):
+    # Queue the requested report to be rendered by msmsquarereportworker.py instead of in the web worker, returns the job ID
+    with getSession() as db_session:
+        job = msmsquare.ReportJob(job_id=str(uuid.uuid4()), status='queued', args=request.args.to_dict(), requested_by=user, created_at=datetime.now(timezone.utc))
+        db_session.add(job)
+        db_session.commit()
+        logging.info('Queued report job %s for %s', job.job_id, user)
+        return job.job_id
+
+def getReportJob(jobID, user):
+    # Returns the status of a report job as a dict, or None if there is no such job for the user
+    with getSession() as db_session:
+        job = db_session.query(msmsquare.ReportJob.job_id, msmsquare.ReportJob.status, msmsquare.ReportJob.created_at, msmsquare.ReportJob.finished_at, msmsquare.ReportJob.error).filter(msmsquare.ReportJob.job_id == jobID, msmsquare.ReportJob.requested_by == user).first()
+        if job is None:
+            return None
+        return {'jobID': job.job_id, 'status': job.status, 'created': job.created_at.isoformat(), 'finished': job.finished_at.isoformat() if job.finished_at else None, 'error': job.error}
+
+def getReportJobResult(jobID, user):
+    # Returns the rendered report of a finished report job, or None if there is no such job for the user or it is not done
+    with getSession() as db_session:
+        job = db_session.query(msmsquare.ReportJob.result).filter(msmsquare.ReportJob.job_id == jobID, msmsquare.ReportJob.requested_by == user, msmsquare.ReportJob.status == 'done').first()
+        if job is None:
+            return None
+        return job.result
+
+# Rendered reports are cached on disk so every uWSGI worker can use them, keyed by the request and a digest of the reports it covers
+reportCacheDir = msmSquareConfig.get('reportCacheDir', 'reportcache')
+reportCacheMaxBytes = msmSquareConfig.get('reportCacheMaxMB', 500) * 1024 * 1024
+
+def reportCacheKey(beginDate, endDate, mode, kind, db_session):
+    # A report only changes when one of the reports it is built from is regenerated or the template changes
+    digest = msmsquare.reportDigestForDates(beginDate, endDate, db_session, rollups=(mode != 'daily'))
+    templateDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    templateTime = max(os.path.getmtime(os.path.join(templateDir, template)) for template in ('dailyreport.html', 'dailyreportday.html'))
+    keyData = json.dumps([beginDate.isoformat(), endDate.isoformat(), mode, kind, digest, templateTime])
+    return hashlib.sha256(keyData.encode('utf-8')).hexdigest() + '.' + kind
+
+def readReportCache(key):
+    # Returns the cached report bytes, or None if there is not one
+    path = os.path.join(reportCacheDir, key)
+    try:
+        with open(path, 'rb') as cached:
+            content = cached.read()
+    except IOError:
+        return None
+    try:
+        # Mark it recently used so eviction removes it last
+        os.utime(path)
+    except OSError:
+        pass
+    return content
+
+def openReportCacheFile():
+    # Reports are written to a temporary file and renamed into place by commitReportCacheFile so other workers never read a partial file
+    # Returns the open file and its path
+    os.makedirs(reportCacheDir, exist_ok=True)
+    fd, tempPath = tempfile.mkstemp(dir=reportCacheDir, prefix='.tmp-')
+    return os.fdopen(fd, 'wb'), tempPath
 
-    db_session = Session() # create a working database session for version 2
+def commitReportCacheFile(tempPath, key):
+    os.replace(tempPath, os.path.join(reportCacheDir, key))
+    evictReportCache()
+    return
+
+def discardReportCacheFile(tempPath):
+    try:
+        os.unlink(tempPath)
+    except OSError:
+        pass
+    return
 
+def writeReportCache(key, content):
+    cacheFile, tempPath = openReportCacheFile()
     try:
-        beginYear=int(request.args['by'])
+        with cacheFile:
+            cacheFile.write(content)
+    except:
+        discardReportCacheFile(tempPath)
+        raise
+    commitReportCacheFile(tempPath, key)
+    return
+
+def evictReportCache():
+    # Remove the least recently used reports until the cache is under reportCacheMaxMB
+    entries = []
+    for entry in os.scandir(reportCacheDir):
+        if entry.is_file() and not entry.name.startswith('.tmp-'):
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Removed by another worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    totalSize = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if totalSize <= reportCacheMaxBytes:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        totalSize -= size
+    return
+
+def reportArgs(args):
+    # Returns the (beginDate, endDate, mode, kind) of the /square/reports query parameters
+    try:
+        beginYear=int(args['by'])
     except:
         beginYear=2022
     try:
-        beginMonth=int(request.args['bm'])
+        beginMonth=int(args['bm'])
     except:
         beginMonth=4
     try:
-        beginDay=int(request.args['bd'])
+        beginDay=int(args['bd'])
     except:
         beginDay=1
     try:
-        endYear=int(request.args['ey'])
+        endYear=int(args['ey'])
     except:
         endYear=2022
     try:
-        endMonth=int(request.args['em'])
+        endMonth=int(args['em'])
     except:
         endMonth=4
     try:
-        endDay=int(request.args['ed'])
+        endDay=int(args['ed'])
     except:
         endDay=30
     beginDate=date(beginYear,beginMonth,beginDay)
     endDate=date(endYear,endMonth,endDay)
-    reportData=msmsquare.getReportDataForDatesFromDBAllLocations(beginDate,endDate, db_session, headers)
-    myHTML = render_template('dailyreport.html', reportData=reportData, LOCAL_tzone = tz.gettz('America/Chicago'))
-    weasyCSS='@page {size: letter; margin: .5in;}'
-    if 'pdf' in request.args:
-        return weasyprint.HTML(string=myHTML).write_pdf(stylesheets=[weasyprint.CSS(string=weasyCSS)])
+    # mode selects daily reports (default), one summary of the whole range, or the week, month, or fiscal_year rollups
+    mode = args.get('mode', 'daily')
+    if mode != 'summary' and mode not in msmsquare.ROLLUP_PERIODS:
+        mode = 'daily'
+    kind = 'pdf' if 'pdf' in args else 'html'
+    return beginDate, endDate, mode, kind
+
+def renderReport(args, db_session, pdfWorkers=1):
+    # args are the /square/reports query parameters, from the request or from a queued report job
+    # PDFs are laid out on pdfWorkers processes, only msmsquarereportworker.py asks for more than one, web requests render in one piece
+    beginDate, endDate, mode, kind = reportArgs(args)
+    cacheKey = reportCacheKey(beginDate, endDate, mode, kind, db_session)
+    cached = readReportCache(cacheKey)
+    if cached is not None:
+        return cached if kind == 'pdf' else cached.decode('utf-8')
+    reportData = list(iterReportData(beginDate, endDate, mode, db_session))
+    myHTML = renderReportHTML(reportData)
+    if kind == 'pdf':
+        myPDF = renderPDF(reportData, myHTML, pdfWorkers)
+        writeReportCache(cacheKey, myPDF)
+        return myPDF
+    else:
+        writeReportCache(cacheKey, myHTML.encode('utf-8'))
+        return myHTML
+
+def iterReportData(beginDate, endDate, mode, db_session):
+    # The report entries for a mode, daily reports are streamed from the database, the summary and rollups are short lists
+    if mode == 'summary':
+        return iter(msmsquare.getRangeSummaryFromDB(beginDate,endDate, db_session, headers))
+    elif mode in msmsquare.ROLLUP_PERIODS:
+        return iter(msmsquare.getReportDataForPeriodsFromDB(beginDate,endDate, mode, db_session, headers))
+    return msmsquare.iterReportDataForDatesFromDBAllLocations(beginDate,endDate, db_session, headers)
+
+def streamReport(request):
+    # Yield the HTML report as it is rendered, one location-day at a time, so the browser shows the first day straight away
+    # The generator owns its database session, it outlives the view function that returns it
+    # What is sent is also written to the disk cache, a report the client stops reading part way through is not cached
+    with getSession() as db_session:
+        beginDate, endDate, mode, kind = reportArgs(request.args)
+        cacheKey = reportCacheKey(beginDate, endDate, mode, 'html', db_session)
+        cached = readReportCache(cacheKey)
+        if cached is not None:
+            yield cached.decode('utf-8')
+            return
+        fragments = (renderDayFragment(entry) for entry in iterReportData(beginDate, endDate, mode, db_session))
+        cacheFile, tempPath = openReportCacheFile()
+        try:
+            with cacheFile:
+                for chunk in stream_template('dailyreport.html', fragments=fragments):
+                    cacheFile.write(chunk.encode('utf-8'))
+                    yield chunk
+        except:
+            discardReportCacheFile(tempPath)
+            raise
+        commitReportCacheFile(tempPath, cacheKey)
+
+def exportReport(request, exportFormat):
+    # Stream the daily reports of the requested range as CSV or JSON, one flattened row per location-day
+    # The ETag is the digest of the reports' IDs and creation dates, so a client that already has this export gets a 304
+    # The ETag, the columns, and the rows are all read in one REPEATABLE READ transaction, so a report regenerated
+    # while the export streams can not add a column part way through it
+    db_session = getSession()
+    try:
+        db_session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+        beginDate, endDate, mode, kind = reportArgs(request.args)
+        etag = hashlib.sha256((exportFormat + msmsquare.reportDigestForDates(beginDate, endDate, db_session)).encode('utf-8')).hexdigest()
+        if etag in request.if_none_match:
+            db_session.close()
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        columns = msmsquare.reportExportColumns(beginDate, endDate, db_session)
+    except:
+        db_session.close()
+        raise
+    filename = 'squarereports-{}-{}.{}'.format(beginDate.isoformat(), endDate.isoformat(), exportFormat)
+    if exportFormat == 'csv':
+        response = Response(stream_with_context(streamReportCSV(beginDate, endDate, columns, db_session)), mimetype='text/csv', headers={'Content-disposition': 'attachment; filename='+filename})
     else:
-        return myHTML
\ No newline at end of file
+        response = Response(stream_with_context(streamReportJSON(beginDate, endDate, columns, db_session)), mimetype='application/json', headers={'Content-disposition': 'attachment; filename='+filename})
+    # The session outlives this view function, it is closed with the response whether or not the client read all of it
+    response.call_on_close(db_session.close)
+    response.set_etag(etag)
+    return response
+
+def streamReportCSV(beginDate, endDate, columns, db_session):
+    line = io.StringIO()
+    writer = csv.DictWriter(line, fieldnames=columns)
+    writer.writeheader()
+    for row in msmsquare.iterReportExportRows(beginDate, endDate, columns, db_session):
+        writer.writerow(row)
+        yield line.getvalue()
+        line.seek(0)
+        line.truncate(0)
+    yield line.getvalue()
+
+def streamReportJSON(beginDate, endDate, columns, db_session):
+    # A JSON array of row objects, written one row at a time
+    separator = '[\n'
+    for row in msmsquare.iterReportExportRows(beginDate, endDate, columns, db_session):
+        yield separator + json.dumps(row)
+        separator = ',\n'
+    yield '[]\n' if separator == '[\n' else '\n]\n'
+
+# Rendered location-days, a report only changes when it is regenerated so (location, date, creation date) identifies its HTML
+fragmentCache = OrderedDict()
+fragmentCacheSize = msmSquareConfig.get('reportFragmentCacheSize', 5000)
+fragmentCacheLock = threading.Lock()
+
+def renderDayFragment(entry):
+    # The HTML of one location-day (or rollup period) of a report, from this worker's fragment cache when it has it
+    key = (entry['location'], entry['date'], entry['created'])
+    with fragmentCacheLock:
+        fragment = fragmentCache.get(key)
+        if fragment is not None:
+            fragmentCache.move_to_end(key)
+            return fragment
+    fragment = Markup(render_template('dailyreportday.html', day=msmsquare.dailyReportView(entry, LOCAL_tzone)))
+    with fragmentCacheLock:
+        fragmentCache[key] = fragment
+        while len(fragmentCache) > fragmentCacheSize:
+            fragmentCache.popitem(last=False)
+    return fragment
+
+def renderReportHTML(reportData):
+    return render_template('dailyreport.html', fragments=[renderDayFragment(entry) for entry in reportData])
+
+weasyCSS='@page {size: letter; margin: .5in;}'
+# Reports with more location-days than this are split into chunks of this many location-days that are laid out in parallel
+# by the background report worker, on at most reportPDFWorkers processes
+reportPDFChunkSize = msmSquareConfig.get('reportPDFChunkSize', 7)
+reportPDFWorkers = msmSquareConfig.get('reportPDFWorkers', min(4, os.cpu_count() or 1))
+
+def renderPDFChunk(html):
+    # Lay out one chunk of a report, runs in a process pool worker
+    # WeasyPrint takes longer to import than the rest of the web app, so it is only imported by workers that render a PDF
+    import weasyprint
+    return weasyprint.HTML(string=html).write_pdf(stylesheets=[weasyprint.CSS(string=weasyCSS)])
+
+def renderPDF(reportData, html, workers=1):
+    # Render the report HTML as a PDF
+    # Every location-day starts a new page, so with more than one worker a long report is rendered as separate documents
+    # of reportPDFChunkSize location-days on a process pool (WeasyPrint layout is single threaded) and the PDFs are joined in order
+    # The pool is never started inside a uWSGI worker, where sys.executable is the uwsgi binary and spawned children cannot start
+    if len(reportData) <= reportPDFChunkSize or workers <= 1:
+        return renderPDFChunk(html)
+    chunks = [renderReportHTML(reportData[i:i+reportPDFChunkSize]) for i in range(0, len(reportData), reportPDFChunkSize)]
+    # spawn rather than fork, the web and report workers run threads that a forked child could inherit mid-lock
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=multiprocessing.get_context('spawn')) as executor:
+        chunkPDFs = list(executor.map(renderPDFChunk, chunks))
+    import pypdf
+    writer = pypdf.PdfWriter()
+    for chunkPDF in chunkPDFs:
+        writer.append(pypdf.PdfReader(io.BytesIO(chunkPDF)))
+    merged = io.BytesIO()
+    writer.write(merged)
+    logging.info('Rendered %s location-days as %s PDF chunks', len(reportData), len(chunks))
+    return merged.getvalue()
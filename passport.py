@@ -1,32 +1,66 @@
+import os
 import uuid
 import requests
-from flask import Flask, render_template, session, request, redirect, url_for, Response
-from flask_session import Session  # https://pythonhosted.org/Flask-Session
+import threading
+import functools
+from time import time
+from datetime import timedelta
+from flask import Flask, render_template, session, request, redirect, url_for, Response, jsonify, stream_with_context
+import importlib
+from time import perf_counter
 import msal
-import yaml
+import msmconfig
 import logging
-import msmcharters
-import msmevents
-import msmsquareweb
-import msmmembership
+
+class LazyModule:
+    # Stands in for a subsystem module until a route first uses it
+    # uWSGI spawns and recycles workers all the time, a worker that only serves the events pages never pays for importing the Square reports (SQLAlchemy, WeasyPrint)
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = perf_counter()
+                    self._module = importlib.import_module(self._name)
+                    logging.info('Loaded %s in %.3f seconds', self._name, perf_counter() - started)
+        return getattr(self._module, attr)
+
+msmcharters = LazyModule('msmcharters')
+msmevents = LazyModule('msmevents')
+msmsquareweb = LazyModule('msmsquareweb')
+msmmembership = LazyModule('msmmembership')
 
 # Load configuration
-try:
-    with open("config-passport.yaml", 'r') as stream:
-        try:
-            passportConfig=yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-except IOError:
-    print("Could not read config-passport.yaml file")
+passportConfig = msmconfig.loadConfig('passport')
 
 app = Flask(__name__)
 # Translate yaml config to flask config for session type
-app.config['SESSION_TYPE'] = passportConfig['sessionType']
 app.config['SERVER_NAME'] = passportConfig['serverName']
 app.config['PREFERRED_URL_SCHEME'] = 'https'
+app.permanent_session_lifetime = timedelta(hours=passportConfig.get('sessionLifetimeHours', 12))
 
-Session(app)
+if passportConfig['sessionType'] == 'database':
+    # Sessions in one table shared by all of the workers, see msmsessions.py
+    import msmsessions
+    app.session_interface = msmsessions.DatabaseSessionInterface(passportConfig['sessionDatabase'], cleanupSeconds=passportConfig.get('sessionCleanupSeconds', 600))
+else:
+    from flask_session import Session  # https://pythonhosted.org/Flask-Session
+    app.config['SESSION_TYPE'] = passportConfig['sessionType']
+    Session(app)
+
+# Each request builds its own MSAL application bound to that session's token cache, building one can mean an OIDC discovery
+# round trip to the authority, so the applications in a worker share an HTTP cache that keeps the discovery responses
+# and an HTTP client that keeps its connections open
+msalHTTPCache = {}
+msalHTTPClient = None
+msalHTTPClientPID = None
+msalHTTPClientLock = threading.Lock()
+# Access tokens are only refreshed once they are this close to expiring, until then the claims in the session are trusted
+tokenRefreshSeconds = passportConfig.get('tokenRefreshSeconds', 300)
 
 # This section is needed for url_for("foo", _external=True) to automatically
 # generate http scheme when this sample is running on localhost,
@@ -40,6 +74,28 @@ app.wsgi_app = ProxyFix(
 
 logging.basicConfig(level=logging.INFO)
 
+def _require_role(role):
+    # Authorize from the user's claims already in the session, MSAL is only asked for a silent refresh when the access token is close to expiring
+    # Defined here since the routes below are decorated with it
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not session.get("user"):
+                return redirect(url_for("login"))
+            if session.get("token_expires_at", 0) - time() < tokenRefreshSeconds:
+                token = _get_token_from_cache(passportConfig['permissionScope'])
+                if not token or "access_token" not in token:
+                    return redirect(url_for("login"))
+            if not role in session['user'].get('roles', []):
+                return redirect(url_for("index"))
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _report_job_user():
+    # Report jobs can only be seen by the user that queued them
+    return session['user'].get('oid') or session['user'].get('preferred_username')
+
 @app.route("/")
 def index():
     if not session.get("user"):
@@ -62,7 +118,11 @@ def authorized():
         if "error" in result:
             return render_template("auth_error.html", result=result)
         session["user"] = result.get("id_token_claims")
+        # A new session ID for the signed in session, the one from before sign in is no longer valid
+        if hasattr(app.session_interface, 'regenerate'):
+            app.session_interface.regenerate(session)
         _save_cache(cache)
+        _save_token_expiry(result)
     except ValueError:  # Usually caused by CSRF
         pass  # Simply ignore them
     return redirect(url_for("index"))
@@ -75,12 +135,8 @@ def logout():
         "?post_logout_redirect_uri=" + url_for("index", _external=True))
 
 @app.route("/charters/createInvoice", methods = ['POST', 'GET'])
+@_require_role('CharterInvoice.Create')
 def createCharterInvoice():
-    token = _get_token_from_cache(passportConfig['permissionScope'])
-    if not token:
-        return redirect(url_for("login"))
-    if not 'CharterInvoice.Create' in session['user']['roles']:
-        return redirect(url_for("index"))
     if request.method == 'POST':
         result = msmcharters.processCharterInvoiceForm(request.form)
         return render_template('charterInvoiceCreated.html', user=session["user"], result=result)
@@ -88,12 +144,8 @@ def createCharterInvoice():
         return render_template('charterInvoiceForm.html', user=session["user"], locations=msmcharters.getCharterLocations())
     
 @app.route("/events/customers", methods = ['POST', 'GET'])
+@_require_role('SpecialEvents.Purcases.Get')
 def eventCustomers():
-    token = _get_token_from_cache(passportConfig['permissionScope'])
-    if not token:
-        return redirect(url_for("login"))
-    if not 'SpecialEvents.Purcases.Get' in session['user']['roles']:
-        return redirect(url_for("index"))
     if request.method == 'POST':
         data = msmevents.processEventCustomersForm(request.form)
         return render_template('eventList.html', eventDetails=data['eventDetails'], customers=data['customers'])
@@ -101,50 +153,63 @@ def eventCustomers():
         return render_template('eventListForm.html', user=session["user"], events=msmevents.getEventList(), urls=msmevents.getURLs())
     
 @app.route("/events/ajax", methods = ['POST'])
+@_require_role('SpecialEvents.Purcases.Get')
 def eventAjax():
-    token = _get_token_from_cache(passportConfig['permissionScope'])
-    if not token:
-        return redirect(url_for("login"))
-    if not 'SpecialEvents.Purcases.Get' in session['user']['roles']:
-        return redirect(url_for("index"))
-    else:
-        return render_template('eventVariations.html', variations=msmevents.getVariations(request.form))
+    return render_template('eventVariations.html', variations=msmevents.getVariations(request.form))
 
 @app.route("/square/reports", methods = ['GET'])
+@_require_role('Square.DailyReports.Get')
 def squareReports():
-    token = _get_token_from_cache(passportConfig['permissionScope'])
-    if not token:
-        return redirect(url_for("login"))
-    if not 'Square.DailyReports.Get' in session['user']['roles']:
-        return redirect(url_for("index"))
+    if 'async' in request.args:
+        # Render the report in the background with msmsquarereportworker.py, the caller polls the status URL
+        jobID = msmsquareweb.enqueueReportJob(request, _report_job_user())
+        return jsonify({'jobID': jobID, 'status': url_for('squareReportJob', jobID=jobID), 'download': url_for('squareReportJobDownload', jobID=jobID)})
     elif 'pdf' in request.args:
         return Response(msmsquareweb.getReport(request), mimetype="application/pdf")
     else:
-        return Response(msmsquareweb.getReport(request), mimetype="text/html")
+        return Response(stream_with_context(msmsquareweb.streamReport(request)), mimetype="text/html")
     
+@app.route("/square/reports.csv", methods = ['GET'])
+@_require_role('Square.DailyReports.Get')
+def squareReportsCSV():
+    return msmsquareweb.exportReport(request, 'csv')
+
+@app.route("/square/reports.json", methods = ['GET'])
+@_require_role('Square.DailyReports.Get')
+def squareReportsJSON():
+    return msmsquareweb.exportReport(request, 'json')
+
+@app.route("/square/reports/jobs/<jobID>", methods = ['GET'])
+@_require_role('Square.DailyReports.Get')
+def squareReportJob(jobID):
+    job = msmsquareweb.getReportJob(jobID, _report_job_user())
+    if job is None:
+        return jsonify({'error': 'No such report job'}), 404
+    return jsonify(job)
+
+@app.route("/square/reports/jobs/<jobID>/download", methods = ['GET'])
+@_require_role('Square.DailyReports.Get')
+def squareReportJobDownload(jobID):
+    result = msmsquareweb.getReportJobResult(jobID, _report_job_user())
+    if result is None:
+        return jsonify({'error': 'Report job is not done'}), 404
+    if result.startswith(b'%PDF'):
+        return Response(result, mimetype="application/pdf")
+    return Response(result, mimetype="text/html")
+
 @app.route("/square/reports/select", methods = ['GET'])
+@_require_role('Square.DailyReports.Get')
 def squareReportsSelect():
-    token = _get_token_from_cache(passportConfig['permissionScope'])
-    if not token:
-        return redirect(url_for("login"))
-    if not 'Square.DailyReports.Get' in session['user']['roles']:
-        return redirect(url_for("index"))
-    else:
-        return render_template('squareReportsSelect.html', user=session["user"])
+    return render_template('squareReportsSelect.html', user=session["user"])
     
 @app.route("/memberdb/tclmailing", methods = ['GET'])
+@_require_role('MembershipDB.TCLAddresses.Get')
 def getTCLMailingList():
-    token = _get_token_from_cache(passportConfig['permissionScope'])
-    if not token:
-        return redirect(url_for("login"))
-    if not 'MembershipDB.TCLAddresses.Get' in session['user']['roles']:
-        return redirect(url_for("index"))
-    else:
-        #Generate the list and return it as a CSV
-        csvData = msmmembership.getTCLAllAddressesCSV()
-        tclFile = Response(csvData, mimetype='text/csv', headers={'Content-disposition': 'attachment; filename=TCLAddresses.csv'})
-        #return render_template('squareReportsSelect.html', user=session["user"])
-        return tclFile
+    #Generate the list and return it as a CSV
+    csvData = msmmembership.getTCLAllAddressesCSV()
+    tclFile = Response(csvData, mimetype='text/csv', headers={'Content-disposition': 'attachment; filename=TCLAddresses.csv'})
+    #return render_template('squareReportsSelect.html', user=session["user"])
+    return tclFile
 
 def _load_cache():
     cache = msal.SerializableTokenCache()
@@ -153,13 +218,31 @@ def _load_cache():
     return cache
 
 def _save_cache(cache):
+    # Only a changed cache is saved, so the session is not rewritten on every request
     if cache.has_state_changed:
         session["token_cache"] = cache.serialize()
 
+def _save_token_expiry(result):
+    # Remember when the access token runs out so _require_role knows when to refresh it
+    if result and "expires_in" in result:
+        expiresAt = int(time()) + int(result["expires_in"])
+        if abs(session.get("token_expires_at", 0) - expiresAt) > 60:
+            session["token_expires_at"] = expiresAt
+
 def _build_msal_app(cache=None, authority=None):
     return msal.ConfidentialClientApplication(
         passportConfig['clientID'], authority=authority or passportConfig['authorityURI'],
-        client_credential=passportConfig['clientSecret'], token_cache=cache)
+        client_credential=passportConfig['clientSecret'], token_cache=cache,
+        http_client=_msal_http_client(), http_cache=msalHTTPCache)
+
+def _msal_http_client():
+    # One requests session per worker, made after uWSGI forks so workers do not share its connections
+    global msalHTTPClient, msalHTTPClientPID
+    with msalHTTPClientLock:
+        if msalHTTPClient is None or msalHTTPClientPID != os.getpid():
+            msalHTTPClient = requests.Session()
+            msalHTTPClientPID = os.getpid()
+    return msalHTTPClient
 
 def _build_auth_code_flow(authority=None, scopes=None):
     return _build_msal_app(authority=authority).initiate_auth_code_flow(
@@ -173,6 +256,7 @@ def _get_token_from_cache(scope=None):
     if accounts:  # So all account(s) belong to the current signed-in user
         result = cca.acquire_token_silent(scope, account=accounts[0])
         _save_cache(cache)
+        _save_token_expiry(result)
         return result
 
 app.jinja_env.globals.update(_build_auth_code_flow=_build_auth_code_flow)  # Used in template
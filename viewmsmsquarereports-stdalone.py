@@ -1,6 +1,7 @@
 #! /usr/bin/python3
 import logging
 import msmsquare
+import msmsquareweb
 from collections import Counter
 from pprint import pprint
 from datetime import datetime, timedelta, date, time, timezone
@@ -10,19 +11,12 @@ import weasyprint
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy import create_engine
 
-import yaml
+import msmconfig
 
 logging.basicConfig(level=logging.INFO)
 
 # Load configuration
-try:
-    with open("config-msmsquare.yaml", 'r') as stream:
-        try:
-            msmSquareConfig=yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-except IOError:
-    print("Could not read config-msmsquare.yaml file")
+msmSquareConfig = msmconfig.loadConfig('msmsquare')
 
 applicationID = msmSquareConfig['squareApplicationID']
 accessToken = msmSquareConfig['squareApplicationAccessToken']
@@ -102,7 +96,7 @@ def index():
     beginDate=date(beginYear,beginMonth,beginDay)
     endDate=date(endYear,endMonth,endDay)
     reportData=msmsquare.getReportDataForDatesFromDBAllLocations(beginDate,endDate, db_session, headers)
-    myHTML = render_template('dailyreport.html', reportData=reportData, LOCAL_tzone = tz.gettz('America/Chicago'))
+    myHTML = msmsquareweb.renderReportHTML(reportData)
     weasyCSS='@page {size: letter; margin: .5in;}'
     if 'pdf' in request.args:
         return Response(weasyprint.HTML(string=myHTML).write_pdf(stylesheets=[weasyprint.CSS(string=weasyCSS)]), mimetype="application/pdf")
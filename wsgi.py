@@ -1,4 +1,10 @@
+import logging
+from time import perf_counter
+
+# Every uWSGI worker pays this on spawn, keep it low by leaving subsystem imports to passport's LazyModule
+started = perf_counter()
 from passport import app
+logging.info('Loaded passport in %.3f seconds', perf_counter() - started)
 
 if __name__ == "__main__":
     app.run()
\ No newline at end of file